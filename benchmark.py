@@ -0,0 +1,584 @@
+# ==============================================================================
+# === FOX-IA BENCHMARK - GENERADOR DE CARGA PARA EL NODO DE INFERENCIA ========
+# ==============================================================================
+#
+# Reproduce historiales de chat como los que envía bin/ai-processor.php (ventanas
+# de hasta 10 mensajes) contra /v1/chat/completions o /generar, con concurrencia y
+# tasa de llegada configurables, en streaming y sin streaming. Mide TTFT, latencia
+# entre tokens, p50/p95/p99 y tokens/s, y guarda el resultado en JSON.
+#
+# En streaming la latencia entre tokens (itl_s) se mide entre fragmentos SSE: el
+# servidor agrupa tokens según stream_coalesce_ms/stream_coalesce_tokens.
+#
+# Con --rate (lazo abierto) TTFT y latencia se miden desde la llegada prevista de
+# cada solicitud, no desde que obtiene hueco de concurrencia; queue_wait_s muestra
+# cuánto esperó en el cliente.
+#
+# Uso:
+#   # Nodo ya desplegado
+#   python benchmark.py run --url http://127.0.0.1:8000 --api-key KEY --stream --out run.json
+#
+#   # Sin GPU: levanta server.py en CPU con un modelo diminuto de pesos aleatorios
+#   python benchmark.py run --tiny --concurrency 8 --requests 200 --out base.json
+#
+#   # Comparar dos ejecuciones (código de salida 1 si hay regresión)
+#   python benchmark.py diff base.json nuevo.json --threshold 0.10
+#
+# ==============================================================================
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+DEFAULT_API_KEY = "foxia-default-key"
+HISTORY_WINDOW = 10  # Mensajes que ai-processor.php envía por solicitud
+
+# ==============================================================================
+# === CARGA DE TRABAJO ========================================================
+# ==============================================================================
+
+WORDS = (
+    "hola gracias por favor necesito ayuda con mi pedido cuando llega el envío "
+    "puedes explicarme cómo funciona la factura quiero cambiar mi contraseña "
+    "el servidor no responde desde ayer tengo un error al subir archivos "
+    "qué opinas de este código python función clase variable lista diccionario "
+    "resumen del documento reunión mañana proyecto cliente presupuesto fecha "
+    "base de datos consulta tabla índice rendimiento memoria usuario grupo chat"
+).split()
+
+def synthetic_text(rng: random.Random, min_words: int, max_words: int) -> str:
+    words = [rng.choice(WORDS) for _ in range(rng.randint(min_words, max_words))]
+    return " ".join(words).capitalize() + rng.choice([".", "?", "!"])
+
+def synthetic_history(rng: random.Random) -> List[Dict[str, str]]:
+    """
+    Historial con la forma de getChatHistory(): hasta 10 mensajes de texto en orden
+    cronológico, mayormente alternados y terminando en un mensaje del usuario. En
+    chats de grupo pueden llegar varios mensajes de usuario seguidos.
+    """
+    length = rng.randint(1, HISTORY_WINDOW)
+    history = []
+    role = "user" if length % 2 else "assistant"
+    for _ in range(length):
+        if role == "assistant":
+            # Respuestas de la IA: más largas, a veces de varios párrafos
+            content = synthetic_text(rng, 20, 120 if rng.random() < 0.8 else 300)
+        else:
+            # Mensajes de usuario: cortos, con alguno largo (código, texto pegado)
+            content = synthetic_text(rng, 3, 30 if rng.random() < 0.9 else 150)
+        history.append({"rol": role, "contenido": content})
+        role = "user" if role == "assistant" or rng.random() < 0.15 else "assistant"
+    if history[-1]["rol"] != "user":
+        history.append({"rol": "user", "contenido": synthetic_text(rng, 3, 30)})
+    return history[-HISTORY_WINDOW:]
+
+def load_histories(path: str) -> List[List[Dict[str, str]]]:
+    """JSONL con un historial por línea: una lista de mensajes o {"mensajes": [...]}"""
+    histories = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            item = json.loads(line)
+            messages = item["mensajes"] if isinstance(item, dict) else item
+            histories.append(messages[-HISTORY_WINDOW:])
+    if not histories:
+        raise ValueError(f"{path} no contiene historiales")
+    return histories
+
+def build_body(args, history: List[Dict[str, str]], index: int) -> Dict[str, Any]:
+    """Cuerpo de la solicitud para el endpoint elegido"""
+    if args.endpoint == "generar":
+        last_user = next((m["contenido"] for m in reversed(history) if m["rol"] == "user"), history[-1]["contenido"])
+        body = {"message": last_user, "stream": args.stream, "temperature": args.temperature, "cache": False}
+    else:
+        body = {
+            "mensajes": history,
+            "stream": args.stream,
+            "max_tokens": args.max_tokens,
+            "temperature": args.temperature,
+            "cache": False
+        }
+        if args.priority:
+            body["priority"] = args.priority
+    body["seed"] = args.seed + index
+    body["user"] = f"bench-chat-{index % args.users}"
+    return body
+
+# ==============================================================================
+# === CLIENTE Y MEDICIÓN ======================================================
+# ==============================================================================
+
+async def send_request(
+    client,
+    url: str,
+    headers: Dict[str, str],
+    body: Dict[str, Any],
+    stream: bool,
+    scheduled_at: Optional[float] = None
+) -> Dict[str, Any]:
+    """
+    Envía una solicitud y devuelve sus tiempos. En lazo abierto se miden desde
+    `scheduled_at` (la llegada prevista) y no desde el envío: si el cliente no pudo
+    enviarla a tiempo porque todas las conexiones estaban ocupadas, esa espera también
+    es latencia para el usuario (omisión coordinada).
+    """
+    sample = {"status": None, "ttft": None, "latency": None, "queue_wait": 0.0, "itl": [], "completion_tokens": None, "error": None}
+    started = time.perf_counter()
+    if scheduled_at is not None:
+        sample["queue_wait"] = max(0.0, started - scheduled_at)
+        started = min(started, scheduled_at)
+    try:
+        if not stream:
+            response = await client.post(url, json=body, headers=headers)
+            sample["latency"] = time.perf_counter() - started
+            sample["status"] = response.status_code
+            if response.status_code == 200:
+                # Sin streaming el primer token llega con la respuesta completa
+                sample["ttft"] = sample["latency"]
+                usage = response.json().get("usage") or {}
+                sample["completion_tokens"] = usage.get("completion_tokens")
+            else:
+                sample["error"] = response.text[:200]
+            return sample
+
+        async with client.stream("POST", url, json=body, headers=headers) as response:
+            sample["status"] = response.status_code
+            if response.status_code != 200:
+                sample["error"] = (await response.aread()).decode(errors="replace")[:200]
+                sample["latency"] = time.perf_counter() - started
+                return sample
+
+            last_chunk_at = None
+            chunks = 0
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    break
+                event = json.loads(data)
+                now = time.perf_counter()
+                if event.get("usage"):
+                    sample["completion_tokens"] = event["usage"].get("completion_tokens")
+                delta = (event.get("choices") or [{}])[0].get("delta", {})
+                if not delta.get("content"):
+                    continue
+                chunks += 1
+                if last_chunk_at is None:
+                    sample["ttft"] = now - started
+                else:
+                    sample["itl"].append(now - last_chunk_at)
+                last_chunk_at = now
+            sample["latency"] = time.perf_counter() - started
+            if sample["completion_tokens"] is None:
+                sample["completion_tokens"] = chunks
+            return sample
+    except Exception as e:
+        sample["latency"] = time.perf_counter() - started
+        sample["error"] = f"{type(e).__name__}: {e}"
+        return sample
+
+async def run_workload(args, base_url: str) -> Dict[str, Any]:
+    """Lanza la carga (lazo abierto con llegadas de Poisson o lazo cerrado) y agrega los resultados"""
+    import httpx
+
+    rng = random.Random(args.seed)
+    histories = load_histories(args.histories) if args.histories else None
+    path = "/generar" if args.endpoint == "generar" else "/v1/chat/completions"
+    url = base_url.rstrip("/") + path
+    headers = {"x-api-key": args.api_key}
+    total = args.warmup + args.requests
+
+    bodies = []
+    for index in range(total):
+        history = histories[index % len(histories)] if histories else synthetic_history(rng)
+        bodies.append(build_body(args, history, index))
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    samples: List[Dict[str, Any]] = [None] * total
+    timeout = httpx.Timeout(args.timeout, connect=10.0)
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+
+    async with httpx.AsyncClient(timeout=timeout, limits=limits) as client:
+        async def one(index: int, scheduled_at: Optional[float] = None):
+            async with semaphore:
+                samples[index] = await send_request(client, url, headers, bodies[index], args.stream, scheduled_at)
+
+        # Calentamiento fuera de la medición
+        await asyncio.gather(*(one(index) for index in range(args.warmup)))
+
+        started = time.perf_counter()
+        tasks = []
+        if args.rate > 0:
+            # Lazo abierto: las llegadas siguen un calendario fijo (Poisson) que no se
+            # retrasa aunque el servidor vaya lento; cada muestra guarda su llegada prevista
+            arrival = started
+            for index in range(args.warmup, total):
+                await asyncio.sleep(max(0.0, arrival - time.perf_counter()))
+                tasks.append(asyncio.ensure_future(one(index, arrival)))
+                arrival += rng.expovariate(args.rate)
+        else:
+            tasks = [asyncio.ensure_future(one(index)) for index in range(args.warmup, total)]
+        await asyncio.gather(*tasks)
+        duration = time.perf_counter() - started
+
+        server = {}
+        try:
+            health = (await client.get(base_url.rstrip("/") + "/health")).json()
+            server = {"scheduler": health.get("scheduler"), "startup": health.get("startup")}
+        except Exception as e:
+            server = {"error": str(e)}
+
+    return summarize(samples[args.warmup:], duration, server)
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """Percentil con interpolación lineal (como numpy.percentile)"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q / 100.0
+    low = int(position)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (position - low)
+
+def distribution(values: List[float]) -> Dict[str, Optional[float]]:
+    if not values:
+        return {"count": 0, "mean": None, "p50": None, "p95": None, "p99": None, "max": None}
+    return {
+        "count": len(values),
+        "mean": round(sum(values) / len(values), 6),
+        "p50": round(percentile(values, 50), 6),
+        "p95": round(percentile(values, 95), 6),
+        "p99": round(percentile(values, 99), 6),
+        "max": round(max(values), 6)
+    }
+
+def summarize(samples: List[Dict[str, Any]], duration: float, server: Dict[str, Any]) -> Dict[str, Any]:
+    ok, errors = [], {}
+    for s in samples:
+        if s["status"] == 200 and s["error"] is None:
+            ok.append(s)
+        else:
+            key = str(s["status"] or s["error"].split(":")[0])
+            errors[key] = errors.get(key, 0) + 1
+
+    tokens = [s["completion_tokens"] for s in ok if s["completion_tokens"]]
+    per_request_tps = [
+        s["completion_tokens"] / (s["latency"] - s["ttft"])
+        for s in ok
+        if s["completion_tokens"] and s["completion_tokens"] > 1 and s["latency"] > s["ttft"]
+    ]
+    return {
+        "summary": {
+            "requests": len(samples),
+            "ok": len(ok),
+            "errors": errors,
+            "duration_s": round(duration, 3),
+            "requests_per_s": round(len(ok) / duration, 3) if duration else None,
+            "output_tokens": sum(tokens),
+            "output_tokens_per_s": round(sum(tokens) / duration, 3) if duration and tokens else None,
+            "ttft_s": distribution([s["ttft"] for s in ok if s["ttft"] is not None]),
+            "itl_s": distribution([gap for s in ok for gap in s["itl"]]),
+            "latency_s": distribution([s["latency"] for s in ok]),
+            "queue_wait_s": distribution([s["queue_wait"] for s in ok]),
+            "tokens_per_s_per_request": distribution(per_request_tps)
+        },
+        "server": server
+    }
+
+# ==============================================================================
+# === NODO LOCAL EN CPU CON UN MODELO DIMINUTO ================================
+# ==============================================================================
+
+def make_tiny_model(path: str, seed: int = 0) -> str:
+    """
+    Crea (una sola vez) un modelo Llama de pesos aleatorios con un tokenizer BPE
+    propio y plantilla de chat. No descarga nada: sirve para detectar regresiones
+    del servidor (planificador, tokenización, streaming), no de calidad.
+    """
+    if os.path.exists(os.path.join(path, "config.json")):
+        return path
+
+    import torch
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+    from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+
+    print(f"🧪 Creando modelo diminuto en {path}...")
+    bpe = Tokenizer(models.BPE())
+    bpe.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    bpe.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=2000,
+        special_tokens=["<|endoftext|>", "<|im_start|>", "<|im_end|>"],
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet()
+    )
+    corpus_rng = random.Random(seed)
+    bpe.train_from_iterator([synthetic_text(corpus_rng, 20, 200) for _ in range(500)], trainer)
+
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=bpe,
+        eos_token="<|im_end|>",
+        pad_token="<|endoftext|>",
+        model_input_names=["input_ids", "attention_mask"]
+    )
+    tokenizer.chat_template = (
+        "{% for m in messages %}<|im_start|>{{ m['role'] }}\n{{ m['content'] }}<|im_end|>\n{% endfor %}"
+        "{% if add_generation_prompt %}<|im_start|>assistant\n{% endif %}"
+    )
+
+    torch.manual_seed(seed)
+    config = LlamaConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=128,
+        intermediate_size=256,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=8192,
+        eos_token_id=tokenizer.eos_token_id,
+        pad_token_id=tokenizer.pad_token_id
+    )
+    model = LlamaForCausalLM(config)
+    model.save_pretrained(path)
+    tokenizer.save_pretrained(path)
+    return path
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def tiny_overrides(args, model_path: str) -> Dict[str, Any]:
+    overrides = {
+        "model_id": model_path,
+        "draft_model_id": "",
+        "semantic_cache_enabled": False,
+        "exact_cache_path": "",
+        "quantized_snapshot_enabled": "0",
+        "max_context_tokens": 4096
+    }
+    if args.server_config:
+        overrides.update(json.loads(args.server_config))
+    return overrides
+
+def start_tiny_server(args) -> Tuple[subprocess.Popen, str, str]:
+    """Lanza server.py en un subproceso (CPU) y espera a que /ready responda 200"""
+    import httpx
+
+    workdir = tempfile.mkdtemp(prefix="foxia-bench-")
+    model_path = make_tiny_model(args.tiny_model or os.path.join(os.path.expanduser("~/.cache/foxia"), "bench-tiny"))
+    port = free_port()
+    env = {
+        **os.environ,
+        "CUDA_VISIBLE_DEVICES": "",
+        "FOXIA_REMOTE_CONFIG": "0",
+        "FOXIA_CACHE_DIR": workdir,
+        "FOXIA_CONFIG_OVERRIDES": json.dumps(tiny_overrides(args, model_path)),
+        "TOKENIZERS_PARALLELISM": "false"
+    }
+    log_path = os.path.join(workdir, "server.log")
+    log = open(log_path, "w")
+    process = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "serve", "--port", str(port)],
+        env=env, stdout=log, stderr=subprocess.STDOUT, cwd=os.path.dirname(os.path.abspath(__file__))
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    print(f"🧪 Nodo local en {base_url} (log: {log_path})")
+
+    deadline = time.time() + args.ready_timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"el servidor terminó durante el arranque; ver {log_path}")
+        try:
+            if httpx.get(base_url + "/ready", timeout=2).status_code == 200:
+                return process, base_url, log_path
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    process.terminate()
+    raise RuntimeError(f"el servidor no estuvo listo en {args.ready_timeout}s; ver {log_path}")
+
+def serve(args):
+    """Subproceso: importa server.py, lo arranca y lo sirve sin Ngrok ni registro central"""
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import threading
+    import uvicorn
+    import server
+
+    threading.Thread(target=server.bootstrap, daemon=True).start()
+    uvicorn.run(server.app, host="127.0.0.1", port=args.port, log_level="warning")
+
+# ==============================================================================
+# === COMPARACIÓN DE EJECUCIONES ==============================================
+# ==============================================================================
+
+# (métrica, campo, True si más alto es mejor)
+DIFF_METRICS = [
+    ("requests_per_s", None, True),
+    ("output_tokens_per_s", None, True),
+    ("ttft_s", "p50", False),
+    ("ttft_s", "p95", False),
+    ("ttft_s", "p99", False),
+    ("itl_s", "p50", False),
+    ("itl_s", "p95", False),
+    ("itl_s", "p99", False),
+    ("latency_s", "p50", False),
+    ("latency_s", "p95", False),
+    ("latency_s", "p99", False),
+    ("tokens_per_s_per_request", "p50", True)
+]
+
+def diff_runs(base: Dict[str, Any], new: Dict[str, Any], threshold: float) -> Dict[str, Any]:
+    """Cambio relativo por métrica; regresión si empeora más que el umbral"""
+    rows = []
+    for metric, field, higher_is_better in DIFF_METRICS:
+        old_value = base["summary"].get(metric)
+        new_value = new["summary"].get(metric)
+        if field:
+            old_value = (old_value or {}).get(field)
+            new_value = (new_value or {}).get(field)
+        name = f"{metric}.{field}" if field else metric
+        if old_value is None or new_value is None or old_value == 0:
+            rows.append({"metric": name, "base": old_value, "new": new_value, "change": None, "regression": False})
+            continue
+        change = (new_value - old_value) / old_value
+        worse = -change if higher_is_better else change
+        rows.append({
+            "metric": name,
+            "base": old_value,
+            "new": new_value,
+            "change": round(change, 4),
+            "regression": worse > threshold
+        })
+
+    # Parámetros de carga distintos hacen que la comparación no sea válida
+    mismatched = [
+        key for key in ("endpoint", "stream", "concurrency", "rate", "max_tokens", "histories")
+        if base.get("meta", {}).get(key) != new.get("meta", {}).get(key)
+    ]
+
+    new_errors = sum(new["summary"].get("errors", {}).values())
+    old_errors = sum(base["summary"].get("errors", {}).values())
+    return {
+        "threshold": threshold,
+        "metrics": rows,
+        "errors": {"base": old_errors, "new": new_errors},
+        "mismatched_settings": mismatched,
+        "regression": any(row["regression"] for row in rows) or new_errors > old_errors
+    }
+
+def print_diff(result: Dict[str, Any]):
+    print(f"{'métrica':34} {'base':>12} {'nuevo':>12} {'cambio':>9}")
+    for row in result["metrics"]:
+        change = f"{row['change'] * 100:+.1f}%" if row["change"] is not None else "-"
+        flag = "  ❌" if row["regression"] else ""
+        base = f"{row['base']:.4f}" if row["base"] is not None else "-"
+        new = f"{row['new']:.4f}" if row["new"] is not None else "-"
+        print(f"{row['metric']:34} {base:>12} {new:>12} {change:>9}{flag}")
+    print(f"errores: {result['errors']['base']} → {result['errors']['new']}")
+    if result["mismatched_settings"]:
+        print(f"⚠️  Las ejecuciones usan parámetros distintos: {', '.join(result['mismatched_settings'])}")
+    print("❌ REGRESIÓN" if result["regression"] else "✅ Sin regresiones")
+
+# ==============================================================================
+# === LÍNEA DE COMANDOS =======================================================
+# ==============================================================================
+
+def run(args):
+    process = None
+    base_url = args.url
+    if args.tiny:
+        process, base_url, _ = start_tiny_server(args)
+    try:
+        print(f"🚀 {args.requests} solicitudes a {args.endpoint} "
+              f"(concurrencia {args.concurrency}, tasa {args.rate or 'lazo cerrado'}, stream={args.stream})")
+        result = asyncio.run(run_workload(args, base_url))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=30)
+
+    result["meta"] = {
+        "url": "tiny" if args.tiny else base_url,
+        "endpoint": args.endpoint,
+        "stream": args.stream,
+        "concurrency": args.concurrency,
+        "rate": args.rate,
+        "requests": args.requests,
+        "max_tokens": args.max_tokens,
+        "temperature": args.temperature,
+        "seed": args.seed,
+        "histories": args.histories,
+        "timestamp": time.time()
+    }
+    output = json.dumps(result, indent=2, ensure_ascii=False)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(output)
+        print(f"💾 Resultado guardado en {args.out}")
+    print(output)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark del nodo de inferencia Fox-IA")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="Genera carga y mide latencias")
+    run_parser.add_argument("--url", default="http://127.0.0.1:8000")
+    run_parser.add_argument("--api-key", default=os.environ.get("FOXIA_API_KEY", DEFAULT_API_KEY))
+    run_parser.add_argument("--endpoint", choices=["chat", "generar"], default="chat")
+    run_parser.add_argument("--stream", action="store_true", help="Usar streaming (SSE)")
+    run_parser.add_argument("--concurrency", type=int, default=4)
+    run_parser.add_argument("--rate", type=float, default=0.0, help="Llegadas por segundo (Poisson); 0 = lazo cerrado")
+    run_parser.add_argument("--requests", type=int, default=50)
+    run_parser.add_argument("--warmup", type=int, default=2, help="Solicitudes previas no medidas")
+    run_parser.add_argument("--max-tokens", type=int, default=64)
+    run_parser.add_argument("--temperature", type=float, default=0.7)
+    run_parser.add_argument("--priority", choices=["interactive", "background", "bulk"])
+    run_parser.add_argument("--users", type=int, default=32, help="Chats distintos entre los que se reparten las solicitudes")
+    run_parser.add_argument("--histories", help="JSONL con historiales reales en lugar de los sintéticos")
+    run_parser.add_argument("--seed", type=int, default=1234)
+    run_parser.add_argument("--timeout", type=float, default=600.0)
+    run_parser.add_argument("--out", help="Fichero JSON de salida")
+    run_parser.add_argument("--tiny", action="store_true", help="Levantar server.py en CPU con un modelo diminuto aleatorio")
+    run_parser.add_argument("--tiny-model", help="Directorio del modelo diminuto (se crea si no existe)")
+    run_parser.add_argument("--server-config", help="JSON con ajustes extra para el nodo local (--tiny)")
+    run_parser.add_argument("--ready-timeout", type=float, default=300.0)
+
+    diff_parser = commands.add_parser("diff", help="Compara dos resultados JSON")
+    diff_parser.add_argument("base")
+    diff_parser.add_argument("new")
+    diff_parser.add_argument("--threshold", type=float, default=0.10, help="Empeoramiento relativo tolerado")
+    diff_parser.add_argument("--json", action="store_true", help="Imprimir la comparación en JSON")
+
+    serve_parser = commands.add_parser("serve", help=argparse.SUPPRESS)
+    serve_parser.add_argument("--port", type=int, required=True)
+
+    args = parser.parse_args(argv)
+    if args.command == "run":
+        run(args)
+    elif args.command == "diff":
+        with open(args.base, encoding="utf-8") as f:
+            base = json.load(f)
+        with open(args.new, encoding="utf-8") as f:
+            new = json.load(f)
+        result = diff_runs(base, new, args.threshold)
+        if args.json:
+            print(json.dumps(result, indent=2, ensure_ascii=False))
+        else:
+            print_diff(result)
+        sys.exit(1 if result["regression"] else 0)
+    elif args.command == "serve":
+        serve(args)
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,9 @@
 <?php
 // bin/ai-processor.php
 // Este script es llamado por ChatController para procesar la IA en segundo plano.
+// Con ai_dispatch_mode = 'queue' los nodos toman los trabajos de Redis y este script
+// corre como proceso permanente que guarda y publica sus resultados:
+//   php bin/ai-processor.php --consume
 
 // 1. Cargar el entorno y el autoloader
 require __DIR__ . '/../vendor/autoload.php';
@@ -28,15 +31,17 @@ class AIProcessor
     // Argumentos de entrada
     private $chatId;
     private $messageId;
+    private $consume;
 
     public function __construct()
     {
         // 1. Parsear argumentos de la línea de comandos (ej. --chat_id=123)
-        $args = getopt(null, ["chat_id::", "message_id::"]);
+        $args = getopt(null, ["chat_id::", "message_id::", "consume"]);
         $this->chatId = $args['chat_id'] ?? null;
         $this->messageId = $args['message_id'] ?? null;
+        $this->consume = isset($args['consume']);
 
-        if (!$this->chatId || !$this->messageId) {
+        if (!$this->consume && (!$this->chatId || !$this->messageId)) {
             error_log("❌ AI-Processor: Faltan --chat_id o --message_id. Script llamado incorrectamente.");
             echo "Error: Faltan argumentos --chat_id o --message_id.\n";
             exit(1); // Salir si no hay argumentos
@@ -44,7 +49,12 @@ class AIProcessor
 
         // 2. Inicializar servicios
         $this->db = (new Database())->getConnection();
-        $this->redis = new RedisClient(['host' => ConfigService::get('REDIS_HOST') ?? '127.0.0.1']);
+        $redisParams = ['host' => ConfigService::get('REDIS_HOST') ?? '127.0.0.1'];
+        if ($this->consume) {
+            // El consumidor espera en BRPOP: sin timeout de lectura
+            $redisParams['read_write_timeout'] = 0;
+        }
+        $this->redis = new RedisClient($redisParams);
         $this->aiService = new AIService();
     }
 
@@ -53,20 +63,29 @@ class AIProcessor
      */
     public function run()
     {
+        if ($this->consume) {
+            $this->consumeResults();
+            return;
+        }
+
         echo "============================================\n";
         echo "Iniciando AI Processor - " . date('Y-m-d H:i:s') . "\n";
         echo "Procesando Job: ChatID={$this->chatId}, MessageID={$this->messageId}\n";
 
         try {
             // 3. Obtener el historial del chat
-            $history = $this->getChatHistory($this->chatId);
+            $history = $this->aiService->getChatHistory($this->chatId);
             if (empty($history)) {
                 throw new Exception("El historial para el chat {$this->chatId} está vacío.");
             }
 
-            // 4. Llamar a la IA (Esta es la parte LENTA)
+            // 4. Llamar a la IA (Esta es la parte LENTA); el nodo publica los tokens
+            // en vivo en el canal del chat mientras genera
             error_log("🤖 AI-Processor: [Chat {$this->chatId}] Llamando a la IA...");
-            $aiResponse = $this->aiService->generateResponse($history); // $aiResponse es un array
+            $uuidStmt = $this->db->prepare("SELECT uuid FROM chats WHERE id = ?");
+            $uuidStmt->execute([$this->chatId]);
+            $chatUuid = $uuidStmt->fetchColumn() ?: null;
+            $aiResponse = $this->aiService->generateResponse($history, $chatUuid, (int)$this->chatId); // $aiResponse es un array
 
             if (!$aiResponse || empty($aiResponse['content'])) {
                 throw new Exception("La IA no devolvió contenido válido.");
@@ -86,25 +105,54 @@ class AIProcessor
     }
 
     /**
-     * Obtiene el historial reciente de un chat para la IA
+     * Modo cola: espera los resultados que publican los nodos y los guarda uno a uno.
+     * Un único proceso permanente en lugar de un proceso PHP por mensaje. Entre
+     * resultados pasa a modo spawn los trabajos que ningún nodo tomó a tiempo.
      */
-    private function getChatHistory(int $chatId, int $limit = 10): array
+    private function consumeResults()
     {
-        $query = "SELECT user_id, content FROM messages
-                  WHERE chat_id = :chat_id AND deleted = FALSE AND message_type = 'text'
-                  ORDER BY created_at DESC LIMIT :limit";
-        $stmt = $this->db->prepare($query);
-        $stmt->execute([':chat_id' => $chatId, ':limit' => $limit]);
-        $messages = array_reverse($stmt->fetchAll(PDO::FETCH_ASSOC));
-
-        $history = [];
-        foreach ($messages as $msg) {
-            $history[] = [
-                'rol' => $msg['user_id'] ? 'user' : 'assistant',
-                'contenido' => $msg['content']
-            ];
+        echo "============================================\n";
+        echo "AI Processor en modo cola - " . date('Y-m-d H:i:s') . "\n";
+        echo "Esperando resultados en " . AIService::RESULTS_QUEUE_KEY . "\n";
+
+        $lastExpiryCheck = 0;
+        while (true) {
+            try {
+                if (time() - $lastExpiryCheck >= 5) {
+                    $lastExpiryCheck = time();
+                    $this->aiService->expireStaleJobs($this->redis);
+                }
+                $item = $this->redis->brpop([AIService::RESULTS_QUEUE_KEY], 5);
+                if (!$item) {
+                    continue;
+                }
+                $result = json_decode($item[1], true);
+                if (!is_array($result) || empty($result['chat_id'])) {
+                    error_log("❌ AI-Processor: Resultado ilegible en la cola: " . substr($item[1], 0, 200));
+                    continue;
+                }
+
+                $chatId = (int)$result['chat_id'];
+                $messageId = (int)($result['message_id'] ?? 0);
+                if ($messageId && !$this->aiService->claimReply($this->redis, $messageId)) {
+                    echo "↩️  Resultado duplicado (ChatID $chatId, MessageID $messageId): el mensaje ya tiene respuesta.\n";
+                    continue;
+                }
+                try {
+                    $this->saveAndPublishResponse($chatId, $this->aiService->responseFromResult($result));
+                } catch (Exception $e) {
+                    if ($messageId) {
+                        $this->aiService->releaseReply($this->redis, $messageId);
+                    }
+                    throw $e;
+                }
+                $latency = $result['queue_s'] ?? $result['latency_s'] ?? '?';
+                echo "✅ Resultado (ChatID $chatId, MessageID " . ($messageId ?: '?') . ") guardado en {$latency}s.\n";
+            } catch (Exception $e) {
+                error_log("❌ AI-Processor: Error procesando resultado de la cola: " . $e->getMessage());
+                sleep(1);
+            }
         }
-        return $history;
     }
 
     /**
@@ -159,6 +207,8 @@ class AIProcessor
                 'user_uuid' => null
             ],
             'sender_id' => null,
+            // Borrador en vivo (ai_stream_delta) que este mensaje sustituye
+            'stream_id' => $aiResponse['stream_id'] ?? null,
             'timestamp' => date('Y-m-d H:i:s')
         ];
         $this->redis->publish('canal-chat', json_encode($redisAiPayload));
@@ -143,6 +143,15 @@ class RedisConnectionManager {
                 return;
             }
 
+            // Tokens en vivo de la IA: se reenvían sin registrar cada fragmento
+            if (in_array($data['type'], ['ai_stream_delta', 'ai_stream_end'], true)) {
+                $chatServer->processRedisMessage($data);
+                if ($this->metrics) {
+                    $this->metrics->incrementRedisMessages();
+                }
+                return;
+            }
+
             // Procesar mensaje válido
             if (isset($data['type']) && in_array($data['type'], ['new_message', 'new_notification'])) {
                 echo "🔄 Procesando mensaje Redis para chat: " . ($data['chat_uuid'] ?? 'notification') . "\n";
@@ -193,6 +202,11 @@ class RedisConnectionManager {
                     }
                     break;
 
+                case 'ai_stream_delta':
+                case 'ai_stream_end':
+                    if (!isset($message['chat_uuid'], $message['stream_id'])) return false;
+                    break;
+
                 case 'new_notification':
                     if (!isset($message['notification']) || !is_array($message['notification'])) return false;
 
@@ -133,7 +133,11 @@ CREATE TABLE `ai_nodes` (
   `id` int(11) NOT NULL,
   `node_url` varchar(255) NOT NULL,
   `is_active` tinyint(1) DEFAULT 1,
-  `last_health_check` timestamp NULL DEFAULT current_timestamp()
+  `last_health_check` timestamp NULL DEFAULT current_timestamp(),
+  `model_id` varchar(255) DEFAULT NULL,
+  `load_score` float DEFAULT NULL,
+  `node_stats` longtext CHARACTER SET utf8mb4 COLLATE utf8mb4_bin DEFAULT NULL CHECK (json_valid(`node_stats`)),
+  `last_heartbeat` timestamp NULL DEFAULT NULL
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;
 
 -- --------------------------------------------------------
@@ -620,7 +624,12 @@ INSERT INTO `system_settings` (`id`, `setting_key`, `setting_value`, `setting_ty
 (34, 'ai_model_id', 'deepseek-ai/DeepSeek-R1-Distill-Qwen-7B', 'string', 'ID del modelo de Hugging Face a utilizar para la IA.', 0, '2025-11-05 14:55:37', NULL),
 (35, 'ai_temperature', '0.2', 'string', 'Controla la aleatoriedad de la respuesta de la IA (ej. 0.2).', 0, '2025-10-10 09:28:02', NULL),
 (36, 'ai_top_p', '0.9', 'string', 'Parámetro Top-P para el muestreo del núcleo de la IA (ej. 0.9).', 0, '2025-10-10 09:28:02', NULL),
-(37, 'ai_max_new_tokens', '1024', 'number', 'Número máximo de tokens a generar en una respuesta de la IA.', 0, '2025-10-10 09:28:02', NULL);
+(37, 'ai_max_new_tokens', '1024', 'number', 'Número máximo de tokens a generar en una respuesta de la IA.', 0, '2025-10-10 09:28:02', NULL),
+(38, 'ai_dispatch_mode', 'spawn', 'string', 'Envío de mensajes a la IA: spawn (un proceso por mensaje) o queue (cola de Redis que toman los nodos).', 0, '2025-10-10 09:28:02', NULL),
+(39, 'ai_worker_queue', 'redis://127.0.0.1:6379/0', 'string', 'URL de Redis que usan los nodos de IA en modo queue.', 0, '2025-10-10 09:28:02', NULL),
+(40, 'ai_reasoning_budget', '512', 'number', 'Tokens máximos de razonamiento (<think>) por respuesta antes de forzar la respuesta; debe quedar por debajo de ai_max_new_tokens para dejar sitio a la respuesta. 0 = sin límite.', 0, '2025-10-10 09:28:02', NULL),
+(41, 'ai_job_ttl_s', '120', 'number', 'Segundos que un trabajo puede esperar en la cola sin que lo tome un nodo; después se procesa en modo spawn. 0 = sin límite.', 0, '2025-10-10 09:28:02', NULL),
+(42, 'ai_chat_stream_redis', '', 'string', 'URL de Redis donde los nodos publican los tokens en vivo (en cualquier modo de envío); vacío = ai_worker_queue.', 0, '2025-10-10 09:28:02', NULL);
 
 -- --------------------------------------------------------
 
@@ -1005,7 +1014,7 @@ ALTER TABLE `system_logs`
 -- AUTO_INCREMENT de la tabla `system_settings`
 --
 ALTER TABLE `system_settings`
-  MODIFY `id` int(11) NOT NULL AUTO_INCREMENT, AUTO_INCREMENT=38;
+  MODIFY `id` int(11) NOT NULL AUTO_INCREMENT, AUTO_INCREMENT=43;
 
 --
 -- AUTO_INCREMENT de la tabla `uploaded_files`
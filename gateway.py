@@ -0,0 +1,604 @@
+# ==============================================================================
+# === FOX-IA GATEWAY - BALANCEADOR ENTRE NODOS DE INFERENCIA ==================
+# ==============================================================================
+#
+# Expone la misma API que server.py (/v1/chat/completions, /generar y
+# DELETE /v1/requests/{id}) delante de varios nodos y reparte las solicitudes:
+#
+#   • Menos tokens pendientes: cada solicitud se estima como tokens del prompt +
+#     max_tokens × n, y va al nodo sano con menos tokens en curso.
+#   • Afinidad por conversación: los turnos de un chat (system prompt + chat_id,
+#     user o, en su defecto, el primer mensaje) vuelven al nodo que tiene su prefijo
+#     en la caché KV, salvo que ese nodo vaya más cargado que el mejor por más de
+#     --affinity-slack tokens.
+#   • Conmutación: un error de conexión, 502/503/504 (o 404 de un modelo que ese
+#     nodo no tiene) antes del primer byte se reintenta en otro nodo.
+#   • Solicitudes duplicadas (hedging) sin streaming: si la respuesta tarda más que el
+#     p95 reciente, se lanza una copia en otro nodo y gana la primera; la otra se
+#     cancela con DELETE /v1/requests/{id}. Las copias se limitan a --hedge-budget
+#     de las solicitudes.
+#   • El X-Request-Id del cliente (o uno nuevo) se reenvía a los nodos, así que las
+#     copias comparten id y la cancelación llega a todas. Si el cliente se desconecta,
+#     la generación se cancela también en los nodos.
+#
+# Cada nodo tiene su cliente HTTP con conexiones persistentes. El estado de los
+# nodos se sondea en /ready.
+#
+# Uso:
+#   python gateway.py --nodes http://10.0.0.1:8000,http://10.0.0.2:8000 --api-key KEY --port 8080
+#
+#   # Sin GPU: levanta N nodos server.py en CPU con un modelo diminuto (ver benchmark.py)
+#   python gateway.py --tiny 3 --port 8080
+#
+# ==============================================================================
+
+import argparse
+import asyncio
+import collections
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import sys
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+import uvicorn
+from fastapi import FastAPI, Header, HTTPException, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
+
+DEFAULT_API_KEY = "foxia-default-key"
+DEFAULT_MAX_TOKENS = 1024  # Igual que ChatCompletionRequest/max_new_tokens en server.py
+RETRYABLE_STATUS = {502, 503, 504}
+CLIENT_CLOSED_STATUS = 499  # Convención de nginx: el cliente cerró antes de la respuesta
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - [%(levelname)s] - %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S'
+)
+logger = logging.getLogger("FoxiaGateway")
+# httpx registra cada solicitud reenviada en INFO
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+# ==============================================================================
+# === NODOS ===================================================================
+# ==============================================================================
+
+class Node:
+    """Nodo de inferencia: cliente con conexiones persistentes y carga en curso"""
+
+    def __init__(self, url: str, api_key: str, max_connections: int, timeout_s: float):
+        self.url = url.rstrip("/")
+        self.client = httpx.AsyncClient(
+            base_url=self.url,
+            headers={"x-api-key": api_key},
+            timeout=httpx.Timeout(timeout_s, connect=5.0),
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        )
+        self.healthy = False
+        self.outstanding_tokens = 0
+        self.in_flight = 0
+        self.last_error: Optional[str] = None
+        self.stats = {"requests": 0, "errors": 0}
+
+    def acquire(self, tokens: int):
+        self.outstanding_tokens += tokens
+        self.in_flight += 1
+        self.stats["requests"] += 1
+
+    def release(self, tokens: int):
+        self.outstanding_tokens -= tokens
+        self.in_flight -= 1
+
+    def mark_down(self, error: str):
+        """Error de transporte: fuera del reparto hasta que /ready vuelva a responder"""
+        if self.healthy:
+            logger.warning(f"⚠️  Nodo {self.url} fuera de servicio: {error}")
+        self.healthy = False
+        self.last_error = error
+        self.stats["errors"] += 1
+
+    async def probe(self):
+        try:
+            response = await self.client.get("/ready", timeout=5.0)
+            healthy = response.status_code == 200
+            self.last_error = None if healthy else f"/ready {response.status_code}"
+        except httpx.HTTPError as e:
+            healthy = False
+            self.last_error = f"{type(e).__name__}: {e}"
+        if healthy != self.healthy:
+            logger.info(f"{'✅' if healthy else '⚠️ '} Nodo {self.url} {'disponible' if healthy else 'no disponible'}")
+        self.healthy = healthy
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "outstanding_tokens": self.outstanding_tokens,
+            "in_flight": self.in_flight,
+            "last_error": self.last_error,
+            **self.stats
+        }
+
+# ==============================================================================
+# === ENRUTADO ================================================================
+# ==============================================================================
+
+def estimate_tokens(body: Dict[str, Any]) -> int:
+    """Tokens que ocupará la solicitud: prompt (~4 caracteres por token) + salida máxima"""
+    messages = body.get("mensajes") or body.get("messages")
+    prompt_chars = len(json.dumps(messages, ensure_ascii=False)) if messages else len(str(body.get("message", "")))
+    max_tokens = int(body.get("max_tokens") or DEFAULT_MAX_TOKENS)
+    return prompt_chars // 4 + max_tokens * int(body.get("n") or 1)
+
+def affinity_key(body: Dict[str, Any]) -> Optional[str]:
+    """
+    Identidad del prefijo que el nodo tiene en caché: el system prompt (y el modelo)
+    más la conversación (chat_id, user o, en su defecto, el primer mensaje que no es
+    de sistema). Dos chats con distinto system prompt no comparten prefijo aunque
+    vengan del mismo usuario.
+    """
+    messages = body.get("mensajes") or body.get("messages") or []
+    role = lambda message: message.get("rol", message.get("role")) if isinstance(message, dict) else None
+    system = [message for message in messages if role(message) == "system"]
+
+    conversation = None
+    for field in ("chat_id", "user"):
+        if body.get(field) not in (None, ""):
+            conversation = f"{field}:{body[field]}"
+            break
+    if conversation is None:
+        first = next((message for message in messages if role(message) != "system"), None)
+        if first is not None:
+            conversation = "first:" + json.dumps(first, sort_keys=True, ensure_ascii=False)
+    if conversation is None and not system:
+        return None
+
+    identity = json.dumps({"model": body.get("model"), "system": system, "conversation": conversation},
+                          sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(identity.encode("utf-8")).hexdigest()
+
+async def wait_disconnect(http_request: Request, interval_s: float = 1.0):
+    """Termina cuando el cliente HTTP cierra la conexión (como cancel_on_disconnect en server.py)"""
+    while not await http_request.is_disconnected():
+        await asyncio.sleep(interval_s)
+
+class Gateway:
+    """Reparto de solicitudes entre nodos con afinidad, conmutación y hedging"""
+
+    def __init__(
+        self,
+        nodes: List[Node],
+        affinity_slack: int,
+        affinity_ttl_s: float,
+        affinity_max_entries: int,
+        hedge_after_s: Optional[float],
+        hedge_min_s: float,
+        hedge_budget: float,
+        health_interval_s: float
+    ):
+        self.nodes = nodes
+        self.affinity_slack = affinity_slack
+        self.affinity_ttl_s = affinity_ttl_s
+        self.affinity_max_entries = affinity_max_entries
+        self.hedge_after_s = hedge_after_s
+        self.hedge_min_s = hedge_min_s
+        self.hedge_budget = hedge_budget
+        self.health_interval_s = health_interval_s
+
+        # clave de conversación -> (nodo, última vez usada)
+        self.affinity: "collections.OrderedDict[str, Tuple[Node, float]]" = collections.OrderedDict()
+        # X-Request-Id -> nodos que la atienden (varios si hay copia), para reenviar las cancelaciones
+        self.request_nodes: Dict[str, List[Node]] = {}
+        self.latencies = collections.deque(maxlen=256)
+        self.stats = {
+            "requests": 0, "affinity_hits": 0, "affinity_spills": 0,
+            "failovers": 0, "hedges": 0, "hedge_wins": 0, "unavailable": 0,
+            "client_disconnects": 0, "node_cancels": 0
+        }
+
+    # --- Salud --------------------------------------------------------------
+
+    async def health_loop(self):
+        while True:
+            await asyncio.gather(*(node.probe() for node in self.nodes))
+            await asyncio.sleep(self.health_interval_s)
+
+    # --- Elección de nodo ---------------------------------------------------
+
+    def pick(self, key: Optional[str], exclude: set) -> Optional[Node]:
+        """Nodo sano con menos tokens pendientes, o el de la conversación si no va mucho peor"""
+        candidates = [node for node in self.nodes if node.healthy and node not in exclude]
+        if not candidates:
+            return None
+        best = min(candidates, key=lambda node: (node.outstanding_tokens, node.in_flight))
+
+        entry = self.affinity.get(key) if key else None
+        if entry is not None and time.time() - entry[1] <= self.affinity_ttl_s:
+            sticky = entry[0]
+            if sticky in candidates:
+                if sticky.outstanding_tokens <= best.outstanding_tokens + self.affinity_slack:
+                    self.stats["affinity_hits"] += 1
+                    return sticky
+                self.stats["affinity_spills"] += 1
+        return best
+
+    def bind(self, key: Optional[str], node: Node):
+        """La conversación queda en el nodo que acaba de procesarla (tiene su prefijo KV)"""
+        if not key:
+            return
+        self.affinity[key] = (node, time.time())
+        self.affinity.move_to_end(key)
+        while len(self.affinity) > self.affinity_max_entries:
+            self.affinity.popitem(last=False)
+
+    # --- Hedging ------------------------------------------------------------
+
+    def hedge_delay(self) -> Optional[float]:
+        """Espera antes de duplicar: fija, o el p95 de las latencias recientes"""
+        if self.hedge_after_s is not None:
+            return self.hedge_after_s if self.hedge_after_s > 0 else None
+        if len(self.latencies) < 20:
+            return None
+        ordered = sorted(self.latencies)
+        return max(self.hedge_min_s, ordered[int(len(ordered) * 0.95) - 1])
+
+    def hedge_allowed(self) -> bool:
+        return self.stats["hedges"] < self.hedge_budget * max(1, self.stats["requests"])
+
+    # --- Reenvío ------------------------------------------------------------
+
+    @staticmethod
+    def retryable(status: int, body: Dict[str, Any]) -> bool:
+        # 404 con "model": ese nodo no tiene el modelo, otro puede tenerlo
+        return status in RETRYABLE_STATUS or (status == 404 and bool(body.get("model")))
+
+    async def _send(self, node: Node, path: str, body: Dict[str, Any], tokens: int, request_id: str) -> httpx.Response:
+        """POST sin streaming con la carga contabilizada mientras dura"""
+        node.acquire(tokens)
+        try:
+            response = await node.client.post(path, json=body, headers={"x-request-id": request_id})
+            await response.aread()
+            return response
+        except httpx.TransportError as e:
+            node.mark_down(f"{type(e).__name__}: {e}")
+            raise
+        finally:
+            node.release(tokens)
+
+    def _relay(self, node: Node, response: httpx.Response) -> Response:
+        headers = {"X-Foxia-Node": node.url}
+        for name in ("x-request-id", "retry-after"):
+            if name in response.headers:
+                headers[name] = response.headers[name]
+        return Response(
+            content=response.content,
+            status_code=response.status_code,
+            media_type=response.headers.get("content-type"),
+            headers=headers
+        )
+
+    async def _cancel_on(self, nodes: List[Node], request_id: str):
+        """Cancela la generación en los nodos indicados (copias perdedoras o cliente desconectado)"""
+        results = await asyncio.gather(
+            *(node.client.delete(f"/v1/requests/{request_id}", timeout=5.0) for node in nodes),
+            return_exceptions=True
+        )
+        self.stats["node_cancels"] += sum(
+            1 for result in results if isinstance(result, httpx.Response) and result.status_code == 200
+        )
+
+    def cancel_in_background(self, nodes: List[Node], request_id: str):
+        if nodes:
+            asyncio.ensure_future(self._cancel_on(nodes, request_id))
+
+    async def forward(
+        self,
+        path: str,
+        body: Dict[str, Any],
+        request_id: Optional[str] = None,
+        http_request: Optional[Request] = None
+    ) -> Response:
+        """Sin streaming: conmutación entre nodos y copia duplicada si tarda demasiado"""
+        key, tokens = affinity_key(body), estimate_tokens(body)
+        request_id = request_id or f"chatcmpl-{uuid.uuid4()}"
+        self.stats["requests"] += 1
+        started = time.perf_counter()
+        tried: set = set()
+        running: Dict[asyncio.Task, Node] = {}
+        last_response: Optional[Tuple[Node, httpx.Response]] = None
+        hedged = False
+
+        def launch(node: Node):
+            tried.add(node)
+            self.request_nodes.setdefault(request_id, []).append(node)
+            running[asyncio.ensure_future(self._send(node, path, body, tokens, request_id))] = node
+
+        first = self.pick(key, tried)
+        if first is None:
+            self.stats["unavailable"] += 1
+            raise HTTPException(status_code=503, detail="Ningún nodo disponible", headers={"Retry-After": "10"})
+        launch(first)
+        disconnect = asyncio.ensure_future(wait_disconnect(http_request)) if http_request is not None else None
+
+        try:
+            while running:
+                delay = None if hedged else self.hedge_delay()
+                waiting = set(running) | ({disconnect} if disconnect is not None else set())
+                done, _ = await asyncio.wait(waiting, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+                if disconnect is not None and disconnect in done:
+                    # Nadie va a leer la respuesta: se libera la GPU de los nodos
+                    self.stats["client_disconnects"] += 1
+                    return Response(status_code=CLIENT_CLOSED_STATUS)
+                if not done:
+                    hedged = True
+                    other = self.pick(None, tried)
+                    if other is not None and self.hedge_allowed():
+                        self.stats["hedges"] += 1
+                        launch(other)
+                    continue
+
+                for task in done:
+                    node = running.pop(task)
+                    if task.exception() is not None:
+                        continue
+                    response = task.result()
+                    if self.retryable(response.status_code, body):
+                        last_response = (node, response)
+                        continue
+                    if node is not first:
+                        self.stats["hedge_wins" if hedged else "failovers"] += 1
+                    if response.status_code == 200:
+                        self.latencies.append(time.perf_counter() - started)
+                        self.bind(key, node)
+                    return self._relay(node, response)
+
+                if not running:
+                    # Todos los intentos en curso fallaron: siguiente nodo
+                    node = self.pick(key, tried)
+                    if node is not None:
+                        launch(node)
+        finally:
+            if disconnect is not None:
+                disconnect.cancel()
+            # Las copias que siguen en curso (perdedora del hedging o cliente ido) se
+            # cancelan en su nodo: cerrar la conexión no basta para liberar el batch
+            for task in running:
+                task.cancel()
+            self.cancel_in_background(list(running.values()), request_id)
+            self.request_nodes.pop(request_id, None)
+
+        if last_response is not None:
+            return self._relay(*last_response)
+        self.stats["unavailable"] += 1
+        raise HTTPException(status_code=503, detail="Ningún nodo pudo atender la solicitud", headers={"Retry-After": "10"})
+
+    async def forward_stream(self, path: str, body: Dict[str, Any], request_id: Optional[str] = None) -> Response:
+        """Streaming: se conmuta de nodo solo antes del primer byte (sin hedging)"""
+        key, tokens = affinity_key(body), estimate_tokens(body)
+        request_id = request_id or f"chatcmpl-{uuid.uuid4()}"
+        self.stats["requests"] += 1
+        tried: set = set()
+        last_error: Optional[Response] = None
+
+        while True:
+            node = self.pick(key, tried)
+            if node is None:
+                break
+            if tried:
+                self.stats["failovers"] += 1
+            tried.add(node)
+
+            node.acquire(tokens)
+            try:
+                request = node.client.build_request("POST", path, json=body, headers={"x-request-id": request_id})
+                response = await node.client.send(request, stream=True)
+            except httpx.TransportError as e:
+                node.release(tokens)
+                node.mark_down(f"{type(e).__name__}: {e}")
+                continue
+
+            if response.status_code != 200:
+                await response.aread()
+                await response.aclose()
+                node.release(tokens)
+                last_error = self._relay(node, response)
+                if self.retryable(response.status_code, body):
+                    continue
+                return last_error
+
+            request_id = response.headers.get("x-request-id", request_id)
+            self.request_nodes[request_id] = [node]
+            self.bind(key, node)
+            state = {"finished": False, "released": False}
+
+            async def cleanup(node=node, response=response, request_id=request_id, state=state):
+                """
+                Libera la carga del nodo una sola vez. Se llama desde el generador y
+                como tarea de fondo de la respuesta: si el cliente se va antes de que
+                empiece la iteración, el `finally` del generador nunca se ejecuta.
+                """
+                if state["released"]:
+                    return
+                state["released"] = True
+                await response.aclose()
+                node.release(tokens)
+                self.request_nodes.pop(request_id, None)
+                if not state["finished"]:
+                    self.stats["client_disconnects"] += 1
+                    self.cancel_in_background([node], request_id)
+
+            async def relay(response=response, state=state):
+                try:
+                    async for chunk in response.aiter_raw():
+                        yield chunk
+                    state["finished"] = True
+                finally:
+                    await cleanup()
+
+            headers = {"X-Foxia-Node": node.url, "Cache-Control": "no-cache", "X-Request-Id": request_id}
+            return StreamingResponse(
+                relay(),
+                media_type=response.headers.get("content-type"),
+                headers=headers,
+                background=BackgroundTask(cleanup)
+            )
+
+        if last_error is not None:
+            return last_error
+        self.stats["unavailable"] += 1
+        raise HTTPException(status_code=503, detail="Ningún nodo disponible", headers={"Retry-After": "10"})
+
+    async def cancel(self, request_id: str) -> Response:
+        """Reenvía la cancelación al nodo que atiende la solicitud (o a todos si no se sabe)"""
+        targets = self.request_nodes.get(request_id) or [n for n in self.nodes if n.healthy]
+        responses = await asyncio.gather(
+            *(target.client.delete(f"/v1/requests/{request_id}") for target in targets),
+            return_exceptions=True
+        )
+        for target, response in zip(targets, responses):
+            if isinstance(response, httpx.Response) and response.status_code == 200:
+                return self._relay(target, response)
+        raise HTTPException(status_code=404, detail="Solicitud no encontrada o ya terminada")
+
+    def snapshot(self) -> Dict[str, Any]:
+        delay = self.hedge_delay()
+        return {
+            "status": "healthy" if any(node.healthy for node in self.nodes) else "unavailable",
+            "nodes": [node.snapshot() for node in self.nodes],
+            "affinity_entries": len(self.affinity),
+            "hedge_after_s": round(delay, 3) if delay is not None else None,
+            **self.stats
+        }
+
+    async def close(self):
+        await asyncio.gather(*(node.client.aclose() for node in self.nodes))
+
+# ==============================================================================
+# === APLICACIÓN ==============================================================
+# ==============================================================================
+
+def create_app(gateway: Gateway, api_key: str) -> FastAPI:
+    @contextlib.asynccontextmanager
+    async def lifespan(app: FastAPI):
+        await asyncio.gather(*(node.probe() for node in gateway.nodes))
+        health_task = asyncio.create_task(gateway.health_loop())
+        yield
+        health_task.cancel()
+        await gateway.close()
+
+    app = FastAPI(title="Fox-IA Gateway", docs_url=None, redoc_url=None, lifespan=lifespan)
+
+    def verify_api_key(key: Optional[str]):
+        if key != api_key:
+            raise HTTPException(status_code=401, detail="API Key inválida")
+
+    async def proxy(path: str, request: Request, key: Optional[str]) -> Response:
+        verify_api_key(key)
+        request_id = request.headers.get("x-request-id")
+        try:
+            body = await request.json()
+        except ValueError:
+            raise HTTPException(status_code=400, detail="JSON inválido")
+        if not isinstance(body, dict):
+            raise HTTPException(status_code=400, detail="Se esperaba un objeto JSON")
+        if body.get("stream"):
+            return await gateway.forward_stream(path, body, request_id)
+        return await gateway.forward(path, body, request_id, request)
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request, x_api_key: Optional[str] = Header(None)):
+        return await proxy("/v1/chat/completions", request, x_api_key)
+
+    @app.post("/generar")
+    async def generar(request: Request, x_api_key: Optional[str] = Header(None)):
+        return await proxy("/generar", request, x_api_key)
+
+    @app.delete("/v1/requests/{request_id}")
+    async def cancel_request(request_id: str, x_api_key: Optional[str] = Header(None)):
+        verify_api_key(x_api_key)
+        return await gateway.cancel(request_id)
+
+    @app.get("/health")
+    async def health():
+        return gateway.snapshot()
+
+    @app.get("/ready")
+    async def ready():
+        ok = any(node.healthy for node in gateway.nodes)
+        return JSONResponse(status_code=200 if ok else 503, content={"ready": ok})
+
+    return app
+
+def start_tiny_nodes(count: int, args) -> Tuple[List[Any], List[str]]:
+    """Levanta `count` nodos server.py en CPU con el modelo diminuto de benchmark.py"""
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from concurrent.futures import ThreadPoolExecutor
+    import benchmark
+
+    tiny = argparse.Namespace(tiny_model=args.tiny_model, server_config=args.server_config, ready_timeout=300.0)
+    # Se crea una vez antes de lanzar los nodos en paralelo
+    tiny.tiny_model = benchmark.make_tiny_model(
+        args.tiny_model or os.path.join(os.path.expanduser("~/.cache/foxia"), "bench-tiny")
+    )
+    with ThreadPoolExecutor(max_workers=count) as pool:
+        started = list(pool.map(lambda _: benchmark.start_tiny_server(tiny), range(count)))
+    return [process for process, _, _ in started], [url for _, url, _ in started]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Gateway Fox-IA: balanceo entre nodos de inferencia")
+    parser.add_argument("--nodes", default=os.environ.get("FOXIA_GATEWAY_NODES", ""),
+                        help="URLs de los nodos separadas por comas")
+    parser.add_argument("--api-key", default=os.environ.get("FOXIA_API_KEY", DEFAULT_API_KEY),
+                        help="API key de los nodos (también la exige el gateway)")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--max-connections", type=int, default=64, help="Conexiones persistentes por nodo")
+    parser.add_argument("--timeout", type=float, default=600.0)
+    parser.add_argument("--health-interval", type=float, default=5.0)
+    parser.add_argument("--affinity-slack", type=int, default=4096,
+                        help="Tokens pendientes de más que se toleran para mantener la afinidad")
+    parser.add_argument("--affinity-ttl", type=float, default=1800.0)
+    parser.add_argument("--affinity-max-entries", type=int, default=100000)
+    parser.add_argument("--hedge-after-ms", type=float, default=None,
+                        help="Espera antes de duplicar (por defecto el p95 reciente; 0 = sin hedging)")
+    parser.add_argument("--hedge-min-ms", type=float, default=500.0)
+    parser.add_argument("--hedge-budget", type=float, default=0.1, help="Fracción máxima de solicitudes duplicadas")
+    parser.add_argument("--tiny", type=int, default=0, help="Levantar N nodos locales en CPU con un modelo diminuto")
+    parser.add_argument("--tiny-model", help="Directorio del modelo diminuto (se crea si no existe)")
+    parser.add_argument("--server-config", help="JSON con ajustes extra para los nodos locales (--tiny)")
+    args = parser.parse_args(argv)
+
+    processes = []
+    urls = [url.strip() for url in args.nodes.split(",") if url.strip()]
+    if args.tiny:
+        processes, tiny_urls = start_tiny_nodes(args.tiny, args)
+        urls += tiny_urls
+    if not urls:
+        parser.error("indica al menos un nodo con --nodes o --tiny")
+
+    gateway = Gateway(
+        [Node(url, args.api_key, args.max_connections, args.timeout) for url in urls],
+        affinity_slack=args.affinity_slack,
+        affinity_ttl_s=args.affinity_ttl,
+        affinity_max_entries=args.affinity_max_entries,
+        hedge_after_s=args.hedge_after_ms / 1000 if args.hedge_after_ms is not None else None,
+        hedge_min_s=args.hedge_min_ms / 1000,
+        hedge_budget=args.hedge_budget,
+        health_interval_s=args.health_interval
+    )
+    logger.info(f"🚦 Gateway en :{args.port} delante de {len(urls)} nodos: {', '.join(urls)}")
+    try:
+        uvicorn.run(create_app(gateway, args.api_key), host=args.host, port=args.port, log_level="warning")
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait(timeout=30)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,14 @@
+-- ==============================================================================
+-- Migración: columnas del latido de los nodos de IA en `ai_nodes`
+-- ==============================================================================
+--
+-- foxia.sql ya las incluye para instalaciones nuevas; este script actualiza bases
+-- existentes. Es idempotente (MariaDB >= 10.0: ADD COLUMN IF NOT EXISTS).
+--
+--   mysql -u USER -p foxia < migrations/001_ai_nodes_heartbeat.sql
+
+ALTER TABLE `ai_nodes`
+  ADD COLUMN IF NOT EXISTS `model_id` varchar(255) DEFAULT NULL AFTER `last_health_check`,
+  ADD COLUMN IF NOT EXISTS `load_score` float DEFAULT NULL AFTER `model_id`,
+  ADD COLUMN IF NOT EXISTS `node_stats` longtext CHARACTER SET utf8mb4 COLLATE utf8mb4_bin DEFAULT NULL CHECK (json_valid(`node_stats`)) AFTER `load_score`,
+  ADD COLUMN IF NOT EXISTS `last_heartbeat` timestamp NULL DEFAULT NULL AFTER `node_stats`;
@@ -10,6 +10,8 @@ let webSocketManager = null;
 // CORRECCIÓN: Estado unificado de conexión
 let connectionState = 'disconnected';
 let subscriptionQueue = new Set(); // Cola de suscripciones pendientes
+// Respuestas de IA en vivo: stream_id -> texto recibido hasta ahora
+const aiStreamDrafts = new Map();
 
 /**
  * Inicializa y conecta el WebSocketManager de forma controlada
@@ -125,12 +127,14 @@ function setupWebSocketHandlers() {
     webSocketManager.onMessage('new_notification', handleNewNotification);
     webSocketManager.onMessage('chat_notification', handleChatNotification);
     webSocketManager.onMessage('new_chat', handleNewChat);
+    webSocketManager.onMessage('ai_stream_delta', handleAIStreamDelta);
+    webSocketManager.onMessage('ai_stream_end', handleAIStreamEnd);
     webSocketManager.onMessage('pong', handlePong);
     webSocketManager.onMessage('error', handleWebSocketError);
 
     // Handler global para logging
     webSocketManager.onMessage('*', (data) => {
-        if (!['pong', 'ping'].includes(data.type)) {
+        if (!['pong', 'ping', 'ai_stream_delta'].includes(data.type)) {
             console.log('📨 Mensaje WebSocket recibido:', data);
         }
     });
@@ -250,6 +254,11 @@ function handleNewMessage(data) {
 
     const messageChatUuid = data.chat_uuid;
     const state = stateManager.getState();
+
+    // El mensaje guardado sustituye al borrador en vivo de la IA
+    if (data.stream_id) {
+        removeAIStreamDraft(data.stream_id);
+    }
     const currentChat = state.currentChat;
     const currentChatUuid = currentChat ? currentChat.uuid : null;
     const isForCurrentChat = currentChatUuid && messageChatUuid === currentChatUuid;
@@ -293,6 +302,66 @@ function handleNewMessage(data) {
     }
 }
 
+/**
+ * Indica si un evento es del chat abierto
+ */
+function isCurrentChat(chatUuid) {
+    const currentChat = stateManager.getState().currentChat;
+    return Boolean(currentChat && currentChat.uuid === chatUuid);
+}
+
+/**
+ * Muestra (o actualiza) el borrador de la respuesta de IA mientras se genera
+ */
+function renderAIStreamDraft(streamId, content, createdAt) {
+    // Igual que AIService::parseAIContent: solo lo que sigue al razonamiento
+    const parts = content.split(/<\/think>/i);
+    addMessageToChat({
+        uuid: `stream-${streamId}`,
+        user_id: null,
+        content: (parts.length > 1 ? parts[parts.length - 1] : content).trim(),
+        message_type: 'text',
+        ai_model: 'streaming',
+        created_at: createdAt,
+        user_name: 'Fox-IA',
+        user_uuid: null
+    });
+}
+
+/**
+ * Elimina el borrador en vivo de una respuesta de IA
+ */
+function removeAIStreamDraft(streamId) {
+    aiStreamDrafts.delete(streamId);
+    document.querySelector(`[data-uuid="stream-${streamId}"]`)?.remove();
+}
+
+/**
+ * Maneja un fragmento de la respuesta de IA en vivo
+ */
+function handleAIStreamDelta(data) {
+    if (!isCurrentChat(data.chat_uuid)) return;
+
+    const content = (aiStreamDrafts.get(data.stream_id) || '') + data.delta;
+    aiStreamDrafts.set(data.stream_id, content);
+    renderAIStreamDraft(data.stream_id, content, data.timestamp);
+}
+
+/**
+ * Maneja el final de la respuesta de IA en vivo: el borrador queda con el texto
+ * final hasta que llegue el mensaje guardado (new_message)
+ */
+function handleAIStreamEnd(data) {
+    if (data.error || !isCurrentChat(data.chat_uuid)) {
+        removeAIStreamDraft(data.stream_id);
+        return;
+    }
+    if (data.content) {
+        renderAIStreamDraft(data.stream_id, data.content, data.timestamp);
+    }
+    aiStreamDrafts.delete(data.stream_id);
+}
+
 /**
  * Maneja nueva notificación
  */
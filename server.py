@@ -11,10 +11,42 @@ print("🚀 INICIANDO FOX-IA SERVER - VERSIÓN COLAB OPTIMIZADA CON 4-BIT")
 import subprocess
 import sys
 import importlib
+import importlib.metadata
 import time
 import os
+import json
+import shutil
 from typing import Dict, List, Tuple, Dict, Any, Optional, Literal
 
+# Directorio persistente para los artefactos de arranque (sello de dependencias,
+# estrategia de carga y pesos ya cuantizados)
+STARTUP_CACHE_DIR = os.environ.get("FOXIA_CACHE_DIR", os.path.expanduser("~/.cache/foxia"))
+
+class StartupProfile:
+    """Tiempos de cada fase del arranque (desde el lanzamiento del proceso)"""
+
+    def __init__(self):
+        self.started_at = time.time()
+        self._last = self.started_at
+        self.phases: Dict[str, float] = {}
+        self.details: Dict[str, Any] = {}
+
+    def mark(self, phase: str):
+        """Cierra la fase en curso y la registra con su duración"""
+        now = time.time()
+        self.phases[phase] = round(now - self._last, 2)
+        self._last = now
+        print(f"⏱️  {phase}: {self.phases[phase]:.2f}s (total {now - self.started_at:.1f}s)")
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "phases_s": dict(self.phases),
+            "total_s": round(self._last - self.started_at, 2),
+            **self.details
+        }
+
+startup_profile = StartupProfile()
+
 class ColabDependencyManager:
     """Gestor especializado para entornos Colab con CUDA"""
 
@@ -35,7 +67,8 @@ class ColabDependencyManager:
                 "fastapi": "0.109.0",
                 "uvicorn": "0.25.0",
                 "python-multipart": "latest",
-                "pyngrok": "7.0.0"
+                "pyngrok": "7.0.0",
+                "redis": "latest"
             },
             "rag": {
                 "faiss-cpu": "latest",  # Usar CPU para evitar problemas CUDA
@@ -116,6 +149,11 @@ class ColabDependencyManager:
         """Configura PyTorch optimizado para Colab"""
         self.installation_log.append("🔥 Configurando PyTorch para Colab...")
 
+        pinned = self.required_packages["core_ml"]
+        if all(self.is_installed(pkg, pinned[pkg]) for pkg in ("torch", "torchvision", "torchaudio")):
+            self.installation_log.append("✅ PyTorch ya instalado en la versión fijada")
+            return True
+
         # Instalar PyTorch con CUDA 12.1 (compatible con la mayoría de Colab)
         torch_commands = [
             "pip uninstall -y torch torchvision torchaudio",
@@ -157,6 +195,49 @@ class ColabDependencyManager:
 
         return False
 
+    # ------------------------------------------------------------------
+    # Sello de dependencias verificadas
+    # ------------------------------------------------------------------
+
+    STAMP_PATH = os.path.join(STARTUP_CACHE_DIR, "dependencies.json")
+
+    def installed_versions(self) -> Dict[str, Optional[str]]:
+        """Versión instalada de cada paquete requerido (None si falta)"""
+        packages = ["bitsandbytes"] + [pkg for group in self.required_packages.values() for pkg in group]
+        versions = {}
+        for package in packages:
+            try:
+                versions[package] = importlib.metadata.version(package)
+            except importlib.metadata.PackageNotFoundError:
+                versions[package] = None
+        return versions
+
+    def is_installed(self, package: str, version: str) -> bool:
+        """True si el paquete ya está instalado en la versión pedida"""
+        try:
+            installed = importlib.metadata.version(package)
+        except importlib.metadata.PackageNotFoundError:
+            return False
+        return version == "latest" or installed == version
+
+    def verified_stamp_matches(self) -> bool:
+        """True si las versiones instaladas son las que ya pasaron la verificación"""
+        try:
+            with open(self.STAMP_PATH) as f:
+                stamp = json.load(f)
+        except (OSError, ValueError):
+            return False
+        return stamp.get("cuda") == self.cuda_version and stamp.get("versions") == self.installed_versions()
+
+    def write_verified_stamp(self):
+        try:
+            os.makedirs(STARTUP_CACHE_DIR, exist_ok=True)
+            with open(self.STAMP_PATH, "w") as f:
+                json.dump({"cuda": self.cuda_version, "versions": self.installed_versions(), "verified_at": time.time()}, f)
+            self.installation_log.append("✅ Sello de dependencias guardado")
+        except OSError as e:
+            self.installation_log.append(f"⚠️  No se pudo guardar el sello de dependencias: {e}")
+
     def install_package_safe(self, package_spec: str) -> bool:
         """Instala un paquete de forma segura"""
         if "==" in package_spec:
@@ -200,6 +281,9 @@ class ColabDependencyManager:
         for package, version in packages.items():
             if package in ["torch", "torchvision", "torchaudio"]:
                 continue  # Ya instalados
+            if version != "latest" and self.is_installed(package, version):
+                results[package] = True
+                continue  # Versión fijada ya presente
 
             if version == "latest":
                 install_cmd = f"pip install -q {package}"
@@ -298,7 +382,7 @@ class ColabDependencyManager:
 
         return critical_success, results
 
-def main_installation():
+def main_installation(force: bool = False):
     """Instalación principal optimizada para Colab"""
     print("🚀 INICIANDO INSTALACIÓN OPTIMIZADA PARA COLAB...")
 
@@ -308,6 +392,11 @@ def main_installation():
     print("⚙️  Configurando entorno...")
     manager.setup_environment()
 
+    # Si nada cambió desde la última instalación verificada, no se reinstala
+    if not force and manager.verified_stamp_matches():
+        print("⏭️  Dependencias ya verificadas en este host: se omite la instalación")
+        return True, manager.installation_log
+
     # 2. Instalar PyTorch primero
     print("🔥 Instalando PyTorch con CUDA...")
     if not manager.setup_pytorch_colab():
@@ -342,6 +431,9 @@ def main_installation():
 
     print(f"\n📈 ESTADO: {'✅ ÉXITO' if critical_ok else '⚠️  ADVERTENCIA'}")
 
+    if critical_ok:
+        manager.write_verified_stamp()
+
     if not critical_ok:
         print("\n❌ Módulos críticos faltantes:")
         for mod, status in results.items():
@@ -353,7 +445,7 @@ def main_installation():
 # Ejecutar instalación
 if __name__ == "__main__":
     print("🔧 Iniciando instalación optimizada...")
-    success, log = main_installation()
+    success, log = main_installation(force=os.environ.get("FOXIA_FORCE_INSTALL") == "1")
 
     if success:
         print("\n🎉 ¡Instalación completada! El servidor debería funcionar.")
@@ -367,45 +459,52 @@ if __name__ == "__main__":
     print("   - FAISS: Usando versión CPU para estabilidad")
     print("   - Modelos: Funcionarán con o sin cuantización")
 
+startup_profile.mark("instalacion")
+
 # ==============================================================================
 # === SECCIÓN 1: IMPORTACIONES Y CONFIGURACIÓN ================================
 # ==============================================================================
 
 print("\n--- [SECCIÓN 1] IMPORTANDO BIBLIOTECAS ---")
 
-import json
 import re
+import math
 import asyncio
 import threading
 import uuid
+import random
+import collections
+import hashlib
+import sqlite3
+import socket
+import functools
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
 import numpy as np
 from io import BytesIO
 import torch
-import faiss
 import uvicorn
 from fastapi import FastAPI, UploadFile, File, HTTPException, Request, Header, Depends
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import StreamingResponse, JSONResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field
-from sentence_transformers import SentenceTransformer
 from transformers import (
     AutoTokenizer,
     AutoModelForCausalLM,
     BitsAndBytesConfig,
-    TextIteratorStreamer
+    TextStreamer
 )
-from pyngrok import ngrok
 from threading import Thread
 import gc
 import requests
 import logging
 import logging
 import psutil
-import pynvml
 import nest_asyncio
 from sse_starlette.sse import EventSourceResponse
 
+# faiss, sentence_transformers, pyngrok y pynvml se importan en su primer uso
 print("📥 IMPORTACIONES COMPLETADAS")
+startup_profile.mark("importaciones")
 
 # Aplica nest_asyncio para Colab
 nest_asyncio.apply()
@@ -438,25 +537,114 @@ DEFAULT_CONFIG = {
     "model_id": "deepseek-ai/DeepSeek-R1-Distill-Qwen-7B",
     "temperature": 0.2,
     "top_p": 0.9,
-    "max_new_tokens": 1024
+    "max_new_tokens": 1024,
+    # Límites de admisión del planificador de generación (continuous batching)
+    "max_batch_size": 16,
+    "max_batch_tokens": 32768,
+    # Latido al servidor central con la carga del nodo (segundos; 0 = desactivado)
+    "heartbeat_endpoint": "https://foxia.duckdns.org:4430/public/api/ai/node-heartbeat",
+    "heartbeat_interval_s": 10,
+    "heartbeat_max_backoff_s": 120,
+    # URL pública fija del nodo (IP o dominio propio): se usa en lugar del túnel ngrok
+    "node_url": "",
+    # Modo worker: tomar trabajos de chat de una cola (redis://host:6379/0 o sqlite:///ruta)
+    "worker_queue": "",
+    "worker_jobs_key": "foxia:ai-jobs",
+    "worker_results_key": "foxia:ai-results",
+    "worker_concurrency": 0,  # 0 = max_batch_size
+    "worker_id": "",  # vacío = nombre del host (en Colab cambia en cada sesión)
+    # Un trabajo en proceso cuyo worker deja de renovar su concesión durante este tiempo
+    # vuelve a la cola (nodo caído), aunque el worker no vuelva a arrancar con el mismo id
+    "worker_visibility_timeout_s": 120,
+    # Tokens en vivo al canal pub/sub del chat (solicitudes con chat_uuid)
+    "chat_stream_redis": "",  # redis://... o memory://; vacío = el Redis de worker_queue (lo entrega /api/ai/config en ambos modos)
+    "chat_stream_channel": "canal-chat",
+    "chat_stream_coalesce_ms": 100,
+    "chat_stream_coalesce_tokens": 16,
+    "max_queue_size": 128,
+    # Caché de prefijos KV entre turnos de una misma conversación
+    "prefix_cache_max_mb": 1024,
+    "prefix_cache_max_entries": 256,
+    # Agrupación de tokens en los chunks SSE (ventana de tiempo / número de tokens)
+    "stream_coalesce_ms": 30,
+    "stream_coalesce_tokens": 4,
+    # Razonamiento <think> de los modelos R1: presupuesto de tokens (0 = sin límite),
+    # tokens de max_tokens que siempre quedan para la respuesta, texto con el que se
+    # fuerza el paso a la respuesta y si se emite en los streams
+    "reasoning_budget": 512,
+    "reasoning_answer_reserve": 256,
+    "reasoning_close_text": "\n</think>\n\n",
+    "stream_reasoning": True,
+    # Tiempo máximo de una generación antes de cancelarla (segundos)
+    "request_timeout_s": 600,
+    # Caché semántica de respuestas (SentenceTransformer + FAISS), opcional
+    "semantic_cache_enabled": False,
+    "semantic_cache_model": "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2",
+    "semantic_cache_threshold": 0.95,
+    "semantic_cache_ttl_s": 3600,
+    "semantic_cache_max_entries": 2048,
+    "semantic_cache_max_user_turns": 1,
+    # RAG sobre tripletas de conocimiento (FAISS en proceso), opcional.
+    # Origen: URL del feed de exportación, o ruta a un .json / .db (SQLite) local
+    "rag_enabled": False,
+    "rag_source": "",
+    "rag_embedding_model": "",  # vacío = el mismo de la caché semántica
+    "rag_top_k": 5,
+    "rag_min_score": 0.35,
+    "rag_timeout_ms": 50,
+    "rag_refresh_s": 300,
+    "rag_ivf_threshold": 20000,
+    # Caché exacta de respuestas deterministas (temperature 0 o seed)
+    "exact_cache_max_mb": 64,
+    "exact_cache_path": "",
+    "exact_cache_disk_max_mb": 512,
+    # Decodificación especulativa con un modelo borrador del mismo tokenizer (vacío = desactivada)
+    "draft_model_id": "",
+    "speculative_tokens": 4,
+    # Contexto máximo (prompt + respuesta); el historial antiguo se descarta para no excederlo
+    "max_context_tokens": 8192,
+    # Intervalo del muestreo de CPU/RAM/VRAM en segundo plano (segundos)
+    "system_sample_interval_s": 1.0,
+    # Hilos para el trabajo de CPU fuera del event loop (tokenización, embeddings, SQLite)
+    "cpu_workers": 4,
+    # Clases de prioridad: peso en el reparto justo (WFQ) y objetivo de time-to-first-token
+    "priority_weights": {"interactive": 8, "background": 2, "bulk": 1},
+    "priority_ttft_targets_s": {"interactive": 2.0, "background": 30.0, "bulk": 120.0},
+    # Solicitudes simultáneas (en cola o generando) por chat/usuario; 0 = sin límite
+    "max_inflight_per_user": 4,
+    # Máximo de prompts por llamada a /v1/batch/completions
+    "batch_max_items": 64,
+    # Memoria máxima para modelos residentes (GB); se descargan los menos usados. 0 = sin límite
+    "model_memory_budget_gb": 0,
+    "quantized_snapshot_enabled": True  # Guardar en disco los pesos ya cuantizados para el siguiente arranque
 }
 
-try:
-    print(f"--> Obteniendo configuración desde: {CONFIG_ENDPOINT}")
-    config_response = requests.get(CONFIG_ENDPOINT, verify=False, timeout=15)
+if os.environ.get("FOXIA_REMOTE_CONFIG") == "0":
+    print("--> Configuración remota desactivada (FOXIA_REMOTE_CONFIG=0)")
+    REMOTE_CONFIG = DEFAULT_CONFIG.copy()
+else:
+    try:
+        print(f"--> Obteniendo configuración desde: {CONFIG_ENDPOINT}")
+        config_response = requests.get(CONFIG_ENDPOINT, verify=False, timeout=15)
 
-    if config_response.status_code == 200:
-        REMOTE_CONFIG = config_response.json()
-        print("✅ Configuración remota recibida")
-    else:
-        print(f"⚠️  Servidor central respondió con código {config_response.status_code}")
+        if config_response.status_code == 200:
+            REMOTE_CONFIG = config_response.json()
+            print("✅ Configuración remota recibida")
+        else:
+            print(f"⚠️  Servidor central respondió con código {config_response.status_code}")
+            print("⚠️  Usando configuración por defecto")
+            REMOTE_CONFIG = DEFAULT_CONFIG.copy()
+
+    except Exception as e:
+        print(f"⚠️  Error obteniendo configuración: {e}")
         print("⚠️  Usando configuración por defecto")
         REMOTE_CONFIG = DEFAULT_CONFIG.copy()
 
-except Exception as e:
-    print(f"⚠️  Error obteniendo configuración: {e}")
-    print("⚠️  Usando configuración por defecto")
-    REMOTE_CONFIG = DEFAULT_CONFIG.copy()
+# Ajustes locales por encima de la configuración remota (JSON en FOXIA_CONFIG_OVERRIDES),
+# p. ej. para ejecutar benchmark.py contra un modelo pequeño en CPU
+if os.environ.get("FOXIA_CONFIG_OVERRIDES"):
+    REMOTE_CONFIG = {**REMOTE_CONFIG, **json.loads(os.environ["FOXIA_CONFIG_OVERRIDES"])}
+    print(f"--> Ajustes locales aplicados: {', '.join(json.loads(os.environ['FOXIA_CONFIG_OVERRIDES']))}")
 
 # Asignar configuración
 NGROK_TOKEN = REMOTE_CONFIG.get("ngrok_token", DEFAULT_CONFIG["ngrok_token"])
@@ -465,6 +653,66 @@ TEMPERATURE = float(REMOTE_CONFIG.get("temperature", DEFAULT_CONFIG["temperature
 TOP_P = float(REMOTE_CONFIG.get("top_p", DEFAULT_CONFIG["top_p"]))
 MAX_NEW_TOKENS = int(REMOTE_CONFIG.get("max_new_tokens", DEFAULT_CONFIG["max_new_tokens"]))
 API_KEY = REMOTE_CONFIG.get("api_key", "foxia-default-key")
+MAX_BATCH_SIZE = int(REMOTE_CONFIG.get("max_batch_size", DEFAULT_CONFIG["max_batch_size"]))
+MAX_BATCH_TOKENS = int(REMOTE_CONFIG.get("max_batch_tokens", DEFAULT_CONFIG["max_batch_tokens"]))
+HEARTBEAT_ENDPOINT = REMOTE_CONFIG.get("heartbeat_endpoint", DEFAULT_CONFIG["heartbeat_endpoint"])
+HEARTBEAT_INTERVAL_S = float(REMOTE_CONFIG.get("heartbeat_interval_s", DEFAULT_CONFIG["heartbeat_interval_s"]))
+HEARTBEAT_MAX_BACKOFF_S = float(REMOTE_CONFIG.get("heartbeat_max_backoff_s", DEFAULT_CONFIG["heartbeat_max_backoff_s"]))
+NODE_URL = REMOTE_CONFIG.get("node_url", DEFAULT_CONFIG["node_url"])
+WORKER_QUEUE = REMOTE_CONFIG.get("worker_queue", DEFAULT_CONFIG["worker_queue"])
+WORKER_JOBS_KEY = REMOTE_CONFIG.get("worker_jobs_key", DEFAULT_CONFIG["worker_jobs_key"])
+WORKER_RESULTS_KEY = REMOTE_CONFIG.get("worker_results_key", DEFAULT_CONFIG["worker_results_key"])
+WORKER_CONCURRENCY = int(REMOTE_CONFIG.get("worker_concurrency", DEFAULT_CONFIG["worker_concurrency"]))
+WORKER_ID = REMOTE_CONFIG.get("worker_id", DEFAULT_CONFIG["worker_id"]) or socket.gethostname()
+WORKER_VISIBILITY_TIMEOUT_S = float(REMOTE_CONFIG.get("worker_visibility_timeout_s", DEFAULT_CONFIG["worker_visibility_timeout_s"]))
+CHAT_STREAM_REDIS = REMOTE_CONFIG.get("chat_stream_redis", DEFAULT_CONFIG["chat_stream_redis"])
+CHAT_STREAM_CHANNEL = REMOTE_CONFIG.get("chat_stream_channel", DEFAULT_CONFIG["chat_stream_channel"])
+CHAT_STREAM_COALESCE_MS = float(REMOTE_CONFIG.get("chat_stream_coalesce_ms", DEFAULT_CONFIG["chat_stream_coalesce_ms"]))
+CHAT_STREAM_COALESCE_TOKENS = int(REMOTE_CONFIG.get("chat_stream_coalesce_tokens", DEFAULT_CONFIG["chat_stream_coalesce_tokens"]))
+MAX_QUEUE_SIZE = int(REMOTE_CONFIG.get("max_queue_size", DEFAULT_CONFIG["max_queue_size"]))
+PREFIX_CACHE_MAX_MB = int(REMOTE_CONFIG.get("prefix_cache_max_mb", DEFAULT_CONFIG["prefix_cache_max_mb"]))
+PREFIX_CACHE_MAX_ENTRIES = int(REMOTE_CONFIG.get("prefix_cache_max_entries", DEFAULT_CONFIG["prefix_cache_max_entries"]))
+STREAM_COALESCE_MS = float(REMOTE_CONFIG.get("stream_coalesce_ms", DEFAULT_CONFIG["stream_coalesce_ms"]))
+STREAM_COALESCE_TOKENS = int(REMOTE_CONFIG.get("stream_coalesce_tokens", DEFAULT_CONFIG["stream_coalesce_tokens"]))
+REASONING_BUDGET = int(REMOTE_CONFIG.get("reasoning_budget", DEFAULT_CONFIG["reasoning_budget"]))
+REASONING_ANSWER_RESERVE = int(REMOTE_CONFIG.get("reasoning_answer_reserve", DEFAULT_CONFIG["reasoning_answer_reserve"]))
+REASONING_CLOSE_TEXT = REMOTE_CONFIG.get("reasoning_close_text", DEFAULT_CONFIG["reasoning_close_text"])
+REQUEST_TIMEOUT_S = float(REMOTE_CONFIG.get("request_timeout_s", DEFAULT_CONFIG["request_timeout_s"]))
+
+def config_flag(key: str) -> bool:
+    """Lee un flag booleano de la configuración (acepta 1/0, true/false, on/off)"""
+    value = REMOTE_CONFIG.get(key, DEFAULT_CONFIG[key])
+    return str(value).strip().lower() in ("1", "true", "yes", "on")
+
+STREAM_REASONING = config_flag("stream_reasoning")
+SEMANTIC_CACHE_ENABLED = config_flag("semantic_cache_enabled")
+SEMANTIC_CACHE_MODEL = REMOTE_CONFIG.get("semantic_cache_model", DEFAULT_CONFIG["semantic_cache_model"])
+SEMANTIC_CACHE_THRESHOLD = float(REMOTE_CONFIG.get("semantic_cache_threshold", DEFAULT_CONFIG["semantic_cache_threshold"]))
+SEMANTIC_CACHE_TTL_S = float(REMOTE_CONFIG.get("semantic_cache_ttl_s", DEFAULT_CONFIG["semantic_cache_ttl_s"]))
+SEMANTIC_CACHE_MAX_ENTRIES = int(REMOTE_CONFIG.get("semantic_cache_max_entries", DEFAULT_CONFIG["semantic_cache_max_entries"]))
+SEMANTIC_CACHE_MAX_USER_TURNS = int(REMOTE_CONFIG.get("semantic_cache_max_user_turns", DEFAULT_CONFIG["semantic_cache_max_user_turns"]))
+RAG_ENABLED = config_flag("rag_enabled")
+RAG_SOURCE = REMOTE_CONFIG.get("rag_source", DEFAULT_CONFIG["rag_source"])
+RAG_EMBEDDING_MODEL = REMOTE_CONFIG.get("rag_embedding_model", DEFAULT_CONFIG["rag_embedding_model"]) or SEMANTIC_CACHE_MODEL
+RAG_TOP_K = int(REMOTE_CONFIG.get("rag_top_k", DEFAULT_CONFIG["rag_top_k"]))
+RAG_MIN_SCORE = float(REMOTE_CONFIG.get("rag_min_score", DEFAULT_CONFIG["rag_min_score"]))
+RAG_TIMEOUT_MS = float(REMOTE_CONFIG.get("rag_timeout_ms", DEFAULT_CONFIG["rag_timeout_ms"]))
+RAG_REFRESH_S = float(REMOTE_CONFIG.get("rag_refresh_s", DEFAULT_CONFIG["rag_refresh_s"]))
+RAG_IVF_THRESHOLD = int(REMOTE_CONFIG.get("rag_ivf_threshold", DEFAULT_CONFIG["rag_ivf_threshold"]))
+EXACT_CACHE_MAX_MB = float(REMOTE_CONFIG.get("exact_cache_max_mb", DEFAULT_CONFIG["exact_cache_max_mb"]))
+EXACT_CACHE_PATH = REMOTE_CONFIG.get("exact_cache_path", DEFAULT_CONFIG["exact_cache_path"])
+EXACT_CACHE_DISK_MAX_MB = float(REMOTE_CONFIG.get("exact_cache_disk_max_mb", DEFAULT_CONFIG["exact_cache_disk_max_mb"]))
+DRAFT_MODEL_ID = REMOTE_CONFIG.get("draft_model_id", DEFAULT_CONFIG["draft_model_id"])
+SPECULATIVE_TOKENS = int(REMOTE_CONFIG.get("speculative_tokens", DEFAULT_CONFIG["speculative_tokens"]))
+MAX_CONTEXT_TOKENS = int(REMOTE_CONFIG.get("max_context_tokens", DEFAULT_CONFIG["max_context_tokens"]))
+SYSTEM_SAMPLE_INTERVAL_S = float(REMOTE_CONFIG.get("system_sample_interval_s", DEFAULT_CONFIG["system_sample_interval_s"]))
+CPU_WORKERS = int(REMOTE_CONFIG.get("cpu_workers", DEFAULT_CONFIG["cpu_workers"]))
+PRIORITY_WEIGHTS = {**DEFAULT_CONFIG["priority_weights"], **REMOTE_CONFIG.get("priority_weights", {})}
+PRIORITY_TTFT_TARGETS_S = {**DEFAULT_CONFIG["priority_ttft_targets_s"], **REMOTE_CONFIG.get("priority_ttft_targets_s", {})}
+MAX_INFLIGHT_PER_USER = int(REMOTE_CONFIG.get("max_inflight_per_user", DEFAULT_CONFIG["max_inflight_per_user"]))
+BATCH_MAX_ITEMS = int(REMOTE_CONFIG.get("batch_max_items", DEFAULT_CONFIG["batch_max_items"]))
+MODEL_MEMORY_BUDGET_GB = float(REMOTE_CONFIG.get("model_memory_budget_gb", DEFAULT_CONFIG["model_memory_budget_gb"]))
+QUANTIZED_SNAPSHOT_ENABLED = config_flag("quantized_snapshot_enabled")
 
 # Verificar token de Ngrok
 if not NGROK_TOKEN:
@@ -475,6 +723,8 @@ os.environ["NGROK_AUTHTOKEN"] = NGROK_TOKEN
 
 print(f"--> Modelo: {MODEL_ID}")
 print(f"--> Parámetros: temp={TEMPERATURE}, top_p={TOP_P}, tokens={MAX_NEW_TOKENS}")
+print(f"--> Planificador: batch={MAX_BATCH_SIZE}, tokens={MAX_BATCH_TOKENS}, cola={MAX_QUEUE_SIZE}")
+startup_profile.mark("configuracion")
 
 # CONFIGURACIÓN DE 4-BIT QUANTIZATION
 def create_4bit_config():
@@ -487,17 +737,123 @@ def create_4bit_config():
         bnb_4bit_quant_storage=torch.bfloat16
     )
 
+def model_footprint_bytes(model_instance) -> int:
+    """Memoria ocupada por los pesos de un modelo (0 si no se puede medir)"""
+    if model_instance is None or not hasattr(model_instance, 'get_memory_footprint'):
+        return 0
+    try:
+        return int(model_instance.get_memory_footprint())
+    except Exception:
+        return 0
+
+class ModelLoadCache:
+    """
+    Caché de arranque por modelo y host.
+
+    Guarda qué estrategia de carga funcionó y, si cuantizó, una copia de los pesos
+    ya cuantizados (safetensors) que los siguientes arranques mapean directamente
+    sin volver a cuantizar. La huella del host (GPU y versiones de torch,
+    transformers y bitsandbytes) invalida la caché cuando cambia el entorno.
+    """
+
+    def __init__(self, model_id: str):
+        self.model_id = model_id
+        self.fingerprint = self.host_fingerprint()
+        key = hashlib.sha256(json.dumps([model_id, self.fingerprint]).encode()).hexdigest()[:16]
+        self.root = os.path.join(STARTUP_CACHE_DIR, "models", key)
+        self.manifest_path = os.path.join(self.root, "manifest.json")
+        self.snapshot_dir = os.path.join(self.root, "weights")
+
+    @staticmethod
+    def host_fingerprint() -> Dict[str, Optional[str]]:
+        versions = {}
+        for package in ("torch", "transformers", "bitsandbytes"):
+            try:
+                versions[package] = importlib.metadata.version(package)
+            except importlib.metadata.PackageNotFoundError:
+                versions[package] = None
+        versions["gpu"] = torch.cuda.get_device_name(0) if torch.cuda.is_available() else None
+        return versions
+
+    def manifest(self) -> Dict[str, Any]:
+        try:
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return manifest if manifest.get("fingerprint") == self.fingerprint else {}
+
+    def has_snapshot(self) -> bool:
+        return bool(self.manifest().get("snapshot")) and os.path.isdir(self.snapshot_dir)
+
+    def record(self, strategy: str, snapshot: bool = False, dtype: Optional[str] = None):
+        os.makedirs(self.root, exist_ok=True)
+        manifest = {
+            "model_id": self.model_id,
+            "fingerprint": self.fingerprint,
+            "strategy": strategy,
+            "snapshot": snapshot,
+            "dtype": dtype,
+            "recorded_at": time.time()
+        }
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, self.manifest_path)
+
+    def save_snapshot(self, model_instance, tokenizer_instance) -> bool:
+        """Serializa el modelo cuantizado; se escribe en un temporal y se publica con un rename"""
+        needed = model_footprint_bytes(model_instance) * 1.2
+        os.makedirs(self.root, exist_ok=True)
+        free = shutil.disk_usage(self.root).free
+        if needed > free:
+            logger.warning(f"⚠️  Sin espacio para guardar los pesos cuantizados ({needed / 1024**3:.1f} GB necesarios)")
+            return False
+
+        tmp_dir = self.snapshot_dir + ".tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        try:
+            model_instance.save_pretrained(tmp_dir, safe_serialization=True)
+            tokenizer_instance.save_pretrained(tmp_dir)
+        except Exception as e:
+            logger.warning(f"⚠️  No se pudieron serializar los pesos cuantizados: {e}")
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return False
+        shutil.rmtree(self.snapshot_dir, ignore_errors=True)
+        os.replace(tmp_dir, self.snapshot_dir)
+        return True
+
+    def discard_snapshot(self):
+        shutil.rmtree(self.snapshot_dir, ignore_errors=True)
+
 class ModelLoader4Bit:
     """Cargador especializado para modelos en 4-bit"""
 
-    def __init__(self):
+    # Estrategias cuyo resultado vale la pena guardar en disco (las demás ya leen pesos locales sin cuantizar)
+    SNAPSHOT_STRATEGIES = {"_load_4bit_optimized", "_load_4bit_basic", "_load_8bit_fallback"}
+
+    def __init__(self, model_id: Optional[str] = None):
+        self.model_id = model_id or MODEL_ID
         self.model = None
         self.tokenizer = None
+        self.strategy = None
+        self.cache = ModelLoadCache(self.model_id)
 
     def load_model_4bit(self):
         """Carga el modelo en 4-bit con múltiples estrategias de fallback"""
         print("🎯 CARGANDO MODELO EN 4-BIT...")
 
+        # Camino rápido: pesos ya cuantizados en un arranque anterior
+        if self.cache.has_snapshot():
+            try:
+                self.model, self.tokenizer = self._load_snapshot()
+                self.strategy = "_load_snapshot"
+                print(f"✅ Éxito con: pesos cuantizados en caché ({self.cache.snapshot_dir})")
+                return
+            except Exception as e:
+                print(f"❌ Falló la carga desde la caché de pesos: {str(e)}")
+                self.cache.discard_snapshot()
+
         strategies = [
             self._load_4bit_optimized,
             self._load_4bit_basic,
@@ -506,11 +862,19 @@ class ModelLoader4Bit:
             self._load_basic_fallback
         ]
 
+        # La estrategia que ya funcionó en este host se prueba primero
+        preferred = self.cache.manifest().get("strategy")
+        strategies.sort(key=lambda strategy: strategy.__name__ != preferred)
+        if preferred:
+            print(f"💡 Estrategia recordada para este host: {preferred}")
+
         for i, strategy in enumerate(strategies):
             try:
                 print(f"🔄 Intentando estrategia {i+1}/{len(strategies)}...")
                 self.model, self.tokenizer = strategy()
+                self.strategy = strategy.__name__
                 print(f"✅ Éxito con: {strategy.__name__}")
+                self._remember()
                 return
             except Exception as e:
                 print(f"❌ Falló {strategy.__name__}: {str(e)}")
@@ -518,19 +882,47 @@ class ModelLoader4Bit:
 
         raise RuntimeError("Todas las estrategias de carga fallaron")
 
+    def _remember(self):
+        """Registra la estrategia ganadora y, si cuantizó, guarda los pesos para el siguiente arranque"""
+        try:
+            snapshot = False
+            if QUANTIZED_SNAPSHOT_ENABLED and self.strategy in self.SNAPSHOT_STRATEGIES:
+                started = time.time()
+                snapshot = self.cache.save_snapshot(self.model, self.tokenizer)
+                if snapshot:
+                    print(f"💾 Pesos cuantizados guardados en {time.time() - started:.1f}s")
+            dtype = str(next(self.model.parameters()).dtype).replace("torch.", "")
+            self.cache.record(self.strategy, snapshot=snapshot, dtype=dtype)
+        except Exception as e:
+            logger.warning(f"⚠️  No se pudo actualizar la caché de arranque: {e}")
+
+    def _load_snapshot(self):
+        """Pesos ya cuantizados: la configuración de cuantización viaja en config.json"""
+        print("⚡ Cargando pesos cuantizados desde disco...")
+        dtype = self.cache.manifest().get("dtype")
+        model = AutoModelForCausalLM.from_pretrained(
+            self.cache.snapshot_dir,
+            device_map="auto",
+            trust_remote_code=True,
+            torch_dtype=getattr(torch, dtype) if dtype else "auto"
+        )
+        tokenizer = AutoTokenizer.from_pretrained(self.cache.snapshot_dir)
+        self._setup_tokenizer(tokenizer)
+        return model, tokenizer
+
     def _load_4bit_optimized(self):
         """4-bit optimizado con NF4 y double quantization"""
         print("⚡ 4-bit optimizado (NF4 + double quant)...")
         quantization_config = create_4bit_config()
 
         model = AutoModelForCausalLM.from_pretrained(
-            MODEL_ID,
+            self.model_id,
             quantization_config=quantization_config,
             device_map="auto",
             trust_remote_code=True,
             torch_dtype=torch.bfloat16
         )
-        tokenizer = AutoTokenizer.from_pretrained(MODEL_ID)
+        tokenizer = AutoTokenizer.from_pretrained(self.model_id)
         self._setup_tokenizer(tokenizer)
         return model, tokenizer
 
@@ -543,12 +935,12 @@ class ModelLoader4Bit:
         )
 
         model = AutoModelForCausalLM.from_pretrained(
-            MODEL_ID,
+            self.model_id,
             quantization_config=quantization_config,
             device_map="auto",
             trust_remote_code=True
         )
-        tokenizer = AutoTokenizer.from_pretrained(MODEL_ID)
+        tokenizer = AutoTokenizer.from_pretrained(self.model_id)
         self._setup_tokenizer(tokenizer)
         return model, tokenizer
 
@@ -558,12 +950,12 @@ class ModelLoader4Bit:
         quantization_config = BitsAndBytesConfig(load_in_8bit=True)
 
         model = AutoModelForCausalLM.from_pretrained(
-            MODEL_ID,
+            self.model_id,
             quantization_config=quantization_config,
             device_map="auto",
             trust_remote_code=True
         )
-        tokenizer = AutoTokenizer.from_pretrained(MODEL_ID)
+        tokenizer = AutoTokenizer.from_pretrained(self.model_id)
         self._setup_tokenizer(tokenizer)
         return model, tokenizer
 
@@ -571,12 +963,12 @@ class ModelLoader4Bit:
         """Fallback a FP16"""
         print("🎯 Fallback a FP16...")
         model = AutoModelForCausalLM.from_pretrained(
-            MODEL_ID,
+            self.model_id,
             device_map="auto",
             trust_remote_code=True,
             torch_dtype=torch.float16
         )
-        tokenizer = AutoTokenizer.from_pretrained(MODEL_ID)
+        tokenizer = AutoTokenizer.from_pretrained(self.model_id)
         self._setup_tokenizer(tokenizer)
         return model, tokenizer
 
@@ -584,11 +976,11 @@ class ModelLoader4Bit:
         """Fallback básico sin optimizaciones"""
         print("🔰 Fallback básico...")
         model = AutoModelForCausalLM.from_pretrained(
-            MODEL_ID,
+            self.model_id,
             device_map="auto",
             trust_remote_code=True
         )
-        tokenizer = AutoTokenizer.from_pretrained(MODEL_ID)
+        tokenizer = AutoTokenizer.from_pretrained(self.model_id)
         self._setup_tokenizer(tokenizer)
         return model, tokenizer
 
@@ -597,21 +989,23 @@ class ModelLoader4Bit:
         if tokenizer.pad_token is None:
             tokenizer.pad_token = tokenizer.eos_token
 
-# Cargar modelo en 4-bit
-try:
-    model_loader = ModelLoader4Bit()
-    model_loader.load_model_4bit()
-    model = model_loader.model
-    tokenizer = model_loader.tokenizer
-
-    print(f"\n🎉 MODELO CARGADO EN 4-BIT EXITOSAMENTE")
-    print(f"📊 Dispositivo: {model.device}")
-    print(f"💾 Dtype: {next(model.parameters()).dtype}")
-    print(f"🔧 Quantization: 4-bit activada")
+def load_initial_model():
+    """Carga el modelo por defecto en 4-bit (con carga de emergencia sin cuantizar)"""
+    try:
+        model_loader = ModelLoader4Bit()
+        model_loader.load_model_4bit()
+        model, tokenizer = model_loader.model, model_loader.tokenizer
+        startup_profile.details["load_strategy"] = model_loader.strategy
+
+        print("\n🎉 MODELO CARGADO EN 4-BIT EXITOSAMENTE")
+        print(f"📊 Dispositivo: {model.device}")
+        print(f"💾 Dtype: {next(model.parameters()).dtype}")
+        print("🔧 Quantization: 4-bit activada")
+        return model, tokenizer
 
-except Exception as e:
-    print(f"❌ ERROR CARGANDO MODELO 4-BIT: {e}")
-    print("🔄 Intentando carga de emergencia...")
+    except Exception as e:
+        print(f"❌ ERROR CARGANDO MODELO 4-BIT: {e}")
+        print("🔄 Intentando carga de emergencia...")
 
     # Carga de emergencia sin quantization
     try:
@@ -623,10 +1017,92 @@ except Exception as e:
         tokenizer = AutoTokenizer.from_pretrained(MODEL_ID)
         if tokenizer.pad_token is None:
             tokenizer.pad_token = tokenizer.eos_token
+        startup_profile.details["load_strategy"] = "emergency"
         print("✅ Modelo cargado en modo emergencia (sin 4-bit)")
+        return model, tokenizer
     except Exception as emergency_error:
         print(f"❌ Carga de emergencia falló: {emergency_error}")
-        raise SystemExit("No se pudo cargar ningún modelo")
+        raise RuntimeError("No se pudo cargar ningún modelo")
+
+# Modelo borrador para decodificación especulativa (opcional)
+draft_model = None
+
+def load_draft_model(tokenizer):
+    """Carga el modelo borrador si está configurado y comparte vocabulario"""
+    if not DRAFT_MODEL_ID:
+        return None
+    try:
+        print(f"--> Cargando modelo borrador: {DRAFT_MODEL_ID}")
+        draft_tokenizer = AutoTokenizer.from_pretrained(DRAFT_MODEL_ID)
+        if draft_tokenizer.get_vocab() != tokenizer.get_vocab():
+            raise ValueError("el modelo borrador no comparte vocabulario con el modelo principal")
+
+        draft = AutoModelForCausalLM.from_pretrained(
+            DRAFT_MODEL_ID,
+            device_map="auto",
+            trust_remote_code=True,
+            torch_dtype=torch.float16 if torch.cuda.is_available() else torch.float32
+        )
+        draft.eval()
+        print(f"✅ Modelo borrador cargado ({SPECULATIVE_TOKENS} tokens especulativos por paso)")
+        return draft
+    except Exception as e:
+        print(f"⚠️  Decodificación especulativa desactivada: {e}")
+        return None
+    finally:
+        startup_profile.mark("modelo_borrador")
+
+# ==============================================================================
+# === ESTADO DE ARRANQUE ======================================================
+# ==============================================================================
+
+class ServerReadiness:
+    """
+    Etapas del arranque en segundo plano.
+
+    El servidor escucha desde el primer momento; /health informa de la etapa en
+    curso y /ready solo responde 200 cuando el modelo por defecto está cargado y
+    caliente. El registro en el servidor central espera a este estado.
+    """
+
+    def __init__(self):
+        self.stage = "iniciando"
+        self.error: Optional[str] = None
+        self.ready_at: Optional[float] = None
+        self._done = threading.Event()  # Listo o fallido
+
+    @property
+    def ready(self) -> bool:
+        return self.ready_at is not None
+
+    def advance(self, stage: str):
+        self.stage = stage
+        logger.info(f"🔄 Etapa de arranque: {stage}")
+
+    def set_ready(self):
+        self.stage = "listo"
+        self.ready_at = time.time()
+        self._done.set()
+
+    def fail(self, error: Exception):
+        self.stage = "error"
+        self.error = str(error)
+        self._done.set()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Espera a que el arranque termine; True si el nodo quedó listo"""
+        self._done.wait(timeout)
+        return self.ready
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "ready": self.ready,
+            "stage": self.stage,
+            "error": self.error,
+            "uptime_s": round(time.time() - startup_profile.started_at, 1)
+        }
+
+server_readiness = ServerReadiness()
 
 # ==============================================================================
 # === APLICACIÓN FASTAPI ======================================================
@@ -677,10 +1153,31 @@ class ChatCompletionRequest(BaseModel):
     temperature: Optional[float] = Field(default=0.7, ge=0.0, le=1.0)
     top_p: Optional[float] = Field(default=0.9, ge=0.0, le=1.0)
     repetition_penalty: Optional[float] = Field(default=1.1, ge=1.0, le=2.0)
+    seed: Optional[int] = Field(default=None)
+    cache: Optional[bool] = Field(True)  # False para no usar las cachés de respuestas
+    priority: Optional[Literal["interactive", "background", "bulk"]] = Field(default=None)
+    user: Optional[str] = Field(default=None)  # Id de chat/usuario para el reparto justo
+    n: Optional[int] = Field(default=1, ge=1, le=8)  # Número de respuestas alternativas
+    model: Optional[str] = Field(default=None)  # Id de un modelo residente; vacío = el por defecto
+    chat_id: Optional[int] = Field(default=None)  # Chat de origen: habilita sus tripletas de contexto (RAG)
+    chat_uuid: Optional[str] = Field(default=None)  # Publica los tokens en vivo en el canal de este chat
+    reasoning_budget: Optional[int] = Field(default=None, ge=0)  # Tokens de <think>; vacío = el del nodo, 0 = sin límite
+    include_reasoning: Optional[bool] = Field(default=None)  # False = el stream solo lleva la respuesta
+
+class BatchCompletionRequest(BaseModel):
+    requests: List[ChatCompletionRequest] = Field(..., alias="solicitudes")
+    model: Optional[str] = Field(default=None)
+    priority: Optional[Literal["interactive", "background", "bulk"]] = Field(default="bulk")
+    user: Optional[str] = Field(default=None)
 
 class UserRequest(BaseModel):
     message: str
     stream: Optional[bool] = False
+    temperature: Optional[float] = Field(default=0.7, ge=0.0, le=1.0)
+    seed: Optional[int] = None
+    cache: Optional[bool] = True
+    priority: Optional[Literal["interactive", "background", "bulk"]] = "background"
+    user: Optional[str] = None
 
 class ClientConfig(BaseModel):
     settings: dict
@@ -706,15 +1203,38 @@ ROLE_PROMPTS = {
     "Especialista en Programación": f"Eres Foxia, un **Especialista en Programación experto**. Te especializas en desarrollo de software, algoritmos, arquitectura de sistemas y mejores prácticas de coding.{BASE_DIRECTIVES}",
 }
 
+DEFAULT_ROLE = "Asistente General"
+
 # ==============================================================================
 # === MOTOR DE GENERACIÓN CON 4-BIT ===========================================
 # ==============================================================================
 
+class PromptTooLong(Exception):
+    """El último mensaje no cabe en el contexto disponible ni descartando el historial"""
+
 class FoxiaGenerationEngine:
     """Motor de generación optimizado para 4-bit"""
 
-    def __init__(self):
-        self.model, self.tokenizer = model, tokenizer
+    # Entradas máximas de los cachés por mensaje (tokens y conteos)
+    TOKEN_COUNT_CACHE_SIZE = 4096
+
+    def __init__(self, model_instance, tokenizer_instance):
+        self.model = model_instance
+        self.tokenizer = tokenizer_instance
+
+        # Conteo de tokens por mensaje (hash de rol + contenido) y del system prompt por rol
+        self._token_counts = collections.OrderedDict()
+        self._token_counts_lock = threading.Lock()
+        self._system_tokens: Dict[str, int] = {}
+        self._message_overhead: Optional[int] = None
+
+        # Tokens por segmento de la plantilla: cabecera por rol, mensaje y prompt de generación
+        self._segments = collections.OrderedDict()
+        self._segments_lock = threading.Lock()
+        self._role_heads: Dict[str, List[int]] = {}
+        self._anchor_text: Optional[str] = None
+        self._generation_suffix: Optional[List[int]] = None
+        self.segmented_prompts = self.verify_segmented_prompts()
 
     def clean_content(self, text: str) -> str:
         """Limpia el contenido de caracteres especiales y artefactos"""
@@ -732,9 +1252,35 @@ class FoxiaGenerationEngine:
 
         return cleaned
 
-    def format_messages(self, messages: List[Message], role: str = "Asistente General") -> str:
+    @staticmethod
+    def system_prompt(role: str) -> str:
+        """System prompt del rol"""
+        return ROLE_PROMPTS.get(role, ROLE_PROMPTS[DEFAULT_ROLE])
+
+    @staticmethod
+    def with_knowledge(messages: List[Message], knowledge: Optional[List[Dict[str, Any]]] = None) -> List[Message]:
+        """
+        Antepone las tripletas recuperadas al último turno del usuario. Cambian en cada
+        solicitud: fuera del system prompt y del historial, la conversación anterior
+        sigue siendo un prefijo exacto y el turno siguiente reutiliza su caché KV.
+        """
+        if not knowledge:
+            return messages
+        last = max((i for i, msg in enumerate(messages) if msg.role == "user"), default=None)
+        if last is None:
+            return messages
+        turn = Message(rol="user", contenido=f"{format_knowledge(knowledge)}\n\n{messages[last].content}")
+        return messages[:last] + [turn] + messages[last + 1:]
+
+    def format_messages(
+        self,
+        messages: List[Message],
+        role: str = "Asistente General",
+        knowledge: Optional[List[Dict[str, Any]]] = None
+    ) -> str:
         """Formatea los mensajes usando el template de chat"""
-        system_prompt = ROLE_PROMPTS.get(role, ROLE_PROMPTS["Asistente General"])
+        system_prompt = self.system_prompt(role)
+        messages = self.with_knowledge(messages, knowledge)
 
         # Crear mensajes en formato para el template
         formatted_messages = [{"role": "system", "content": system_prompt}]
@@ -761,246 +1307,3675 @@ class FoxiaGenerationEngine:
             conversation += "Asistente:"
             return conversation
 
-# Inicializar motor de generación
-generation_engine = FoxiaGenerationEngine()
+    def role_prefix_ids(self, role: str) -> List[int]:
+        """Tokens iniciales (plantilla + system prompt) comunes a todos los prompts de un rol"""
+        # Tokenizar dos prompts que solo difieren en el mensaje del usuario garantiza
+        # obtener el prefijo tal y como se tokeniza dentro del prompt completo
+        first, second = (
+            self.tokenizer(self.format_messages([Message(rol="user", contenido=text)], role=role))["input_ids"]
+            for text in ("a", "b")
+        )
 
-# ==============================================================================
-# === ENDPOINTS PRINCIPALES ===================================================
-# ==============================================================================
+        length = 0
+        while length < min(len(first), len(second)) and first[length] == second[length]:
+            length += 1
+        return first[:length]
+
+    # --- Presupuesto de contexto ---------------------------------------------
+
+    def context_window(self) -> int:
+        """Tokens de contexto utilizables: el mínimo entre la configuración y el modelo"""
+        model_limit = getattr(self.model.config, "max_position_embeddings", None) or MAX_CONTEXT_TOKENS
+        return min(MAX_CONTEXT_TOKENS, model_limit)
+
+    def _template_overhead(self) -> int:
+        """Tokens que añade la plantilla de chat alrededor de cada mensaje (estimación)"""
+        if self._message_overhead is None:
+            empty = len(self.tokenizer(self.format_messages([]))["input_ids"])
+            single = len(self.tokenizer(self.format_messages([Message(rol="user", contenido="a")]))["input_ids"])
+            self._message_overhead = max(0, single - empty - 1)
+        return self._message_overhead
+
+    def count_message_tokens(self, message: Message) -> int:
+        """Tokens que ocupa un mensaje dentro del prompt (cacheado por hash)"""
+        if self.segmented_prompts:
+            return len(self.message_ids(message))
+
+        # Sin segmentos verificados: estimación (contenido + plantilla)
+        key = hashlib.sha1(f"{message.role}\x00{message.content}".encode("utf-8")).digest()
+        with self._token_counts_lock:
+            count = self._token_counts.get(key)
+            if count is not None:
+                self._token_counts.move_to_end(key)
+                return count
+
+        count = len(self.tokenizer(message.content, add_special_tokens=False)["input_ids"]) + self._template_overhead()
+
+        with self._token_counts_lock:
+            self._token_counts[key] = count
+            while len(self._token_counts) > self.TOKEN_COUNT_CACHE_SIZE:
+                self._token_counts.popitem(last=False)
+        return count
+
+    def system_prompt_tokens(self, role: str) -> int:
+        """Tokens del system prompt (y cabecera de plantilla) de un rol"""
+        if role not in self._system_tokens:
+            self._system_tokens[role] = len(self.role_prefix_ids(role))
+        return self._system_tokens[role]
+
+    @staticmethod
+    def _drop_leading_assistant(messages: List[Message]) -> List[Message]:
+        """El historial recortado debe empezar por un turno del usuario"""
+        while len(messages) > 1 and messages[0].role == "assistant":
+            messages = messages[1:]
+        return messages
+
+    def fit_messages(
+        self,
+        messages: List[Message],
+        max_new_tokens: int,
+        role: str = DEFAULT_ROLE,
+        knowledge: Optional[List[Dict[str, Any]]] = None
+    ) -> List[Message]:
+        """
+        Conserva los turnos más recientes que caben en el presupuesto de contexto
+        (ventana del modelo - max_new_tokens - system prompt). El último mensaje se
+        conserva siempre; si ni él cabe, `build_prompt` lo rechaza.
+        """
+        conversation = [msg for msg in messages if msg.role in ["user", "assistant"]]
+        available = self.context_window() - max_new_tokens - self.system_prompt_tokens(role)
+        if knowledge:
+            available -= len(self.tokenizer(format_knowledge(knowledge), add_special_tokens=False)["input_ids"])
+
+        kept, used = [], 0
+        for msg in reversed(conversation):
+            tokens = self.count_message_tokens(msg)
+            if kept and used + tokens > available:
+                break
+            kept.append(msg)
+            used += tokens
+        kept.reverse()
+
+        return self._drop_leading_assistant(kept)
+
+    def retrieve_knowledge(self, messages: List[Message], chat_id: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Tripletas relevantes para el último turno del usuario (vacío si no hay RAG)"""
+        if knowledge_base is None:
+            return []
+        query = next((msg.content for msg in reversed(messages) if msg.role == "user"), None)
+        if not query:
+            return []
+        return knowledge_base.retrieve(query, chat_id)
+
+    def build_prompt(
+        self,
+        messages: List[Message],
+        max_new_tokens: int,
+        role: str = DEFAULT_ROLE,
+        chat_id: Optional[int] = None
+    ) -> Tuple[List[int], int]:
+        """
+        Construye los input_ids del prompt dentro del presupuesto de contexto,
+        con el conocimiento recuperado delante del último turno del usuario.
+        Devuelve (input_ids, mensajes descartados del historial).
+        """
+        knowledge = self.retrieve_knowledge(messages, chat_id)
+        budget = self.context_window() - max_new_tokens
+        total = sum(1 for msg in messages if msg.role in ["user", "assistant"])
+        kept = self.fit_messages(messages, max_new_tokens, role, knowledge)
 
-@app.get("/", response_model=StatusResponse)
-async def read_root():
-    """Endpoint de estado principal"""
-    return {
-        "status": "ok",
-        "message": "Fox-IA Server con 4-bit quantization está funcionando correctamente",
-        "version": "4.1-4bit"
-    }
+        # Con segmentos el conteo es exacto; si no, es aproximado y se verifica con el prompt real
+        while True:
+            input_ids = self.prompt_ids(kept, role=role, knowledge=knowledge)
+            if len(input_ids) <= budget:
+                break
+            if knowledge and len(kept) <= 1:
+                # Antes de rechazar el prompt se sacrifica el conocimiento
+                knowledge = []
+                continue
+            if len(kept) <= 1:
+                raise PromptTooLong(
+                    f"El prompt ocupa {len(input_ids)} tokens y el presupuesto es {budget} "
+                    f"(contexto {self.context_window()} - max_tokens {max_new_tokens})"
+                )
+            kept = self._drop_leading_assistant(kept[1:])
 
-@app.get("/health")
-async def health_check():
-    """Health check completo del sistema"""
-    cpu_percent = psutil.cpu_percent(interval=0.5)
-    ram_stats = psutil.virtual_memory()
+        dropped = total - len(kept)
+        if dropped:
+            logger.info(f"✂️  Historial recortado: {dropped} mensajes antiguos fuera del presupuesto de {budget} tokens")
+        return input_ids, dropped
 
-    gpu_metrics = {"status": "GPU no detectada"}
-    try:
-        pynvml.nvmlInit()
-        handle = pynvml.nvmlDeviceGetHandleByIndex(0)
-        mem_info = pynvml.nvmlDeviceGetMemoryInfo(handle)
-        gpu_metrics = {
-            "status": "OK",
-            "vram_total_gb": round(mem_info.total / (1024**3), 2),
-            "vram_used_gb": round(mem_info.used / (1024**3), 2),
-            "vram_percent_used": round((mem_info.used / mem_info.total) * 100, 2)
-        }
-        pynvml.nvmlShutdown()
-    except Exception as e:
-        gpu_metrics["error"] = str(e)
+    # --- Tokenización incremental por segmentos ------------------------------
 
-    # Verificar memoria del modelo
-    model_memory = "Desconocido"
-    try:
-        if hasattr(model, 'get_memory_footprint'):
-            model_memory_gb = model.get_memory_footprint() / (1024**3)
-            model_memory = f"{model_memory_gb:.2f} GB"
-    except:
-        model_memory = "No disponible"
+    def _render(self, messages: List[Dict[str, str]], add_generation_prompt: bool) -> str:
+        return self.tokenizer.apply_chat_template(
+            messages, tokenize=False, add_generation_prompt=add_generation_prompt
+        )
 
-    # Verificar quantization
-    quantization_status = "4-bit activado"
-    try:
-        if hasattr(model, 'quantization_method'):
-            quantization_status = f"{model.quantization_method}"
-        else:
-            quantization_status = "No quantization"
-    except:
-        quantization_status = "Desconocido"
+    def _role_head(self, role: str) -> List[int]:
+        """Tokens de la cabecera de la plantilla con el system prompt del rol"""
+        if role not in self._role_heads:
+            text = self._render([{"role": "system", "content": self.system_prompt(role)}], add_generation_prompt=False)
+            self._role_heads[role] = self.tokenizer(text)["input_ids"]
+        return self._role_heads[role]
+
+    def _segment_text(self, message: Dict[str, str], add_generation_prompt: bool = False) -> str:
+        """Texto que añade un mensaje a la plantilla, renderizado tras un system prompt fijo"""
+        anchor = [{"role": "system", "content": ROLE_PROMPTS[DEFAULT_ROLE]}]
+        if self._anchor_text is None:
+            self._anchor_text = self._render(anchor, add_generation_prompt=False)
+
+        text = self._render(anchor + [message], add_generation_prompt=add_generation_prompt)
+        if not text.startswith(self._anchor_text):
+            raise ValueError("la plantilla de chat no es incremental")
+        return text[len(self._anchor_text):]
+
+    def message_ids(self, message: Message) -> List[int]:
+        """Tokens del segmento de un mensaje, cacheados por (rol, hash del contenido)"""
+        key = (message.role, hashlib.sha1(message.content.encode("utf-8")).digest())
+        with self._segments_lock:
+            ids = self._segments.get(key)
+            if ids is not None:
+                self._segments.move_to_end(key)
+                return ids
+
+        text = self._segment_text({"role": message.role, "content": message.content})
+        ids = self.tokenizer(text, add_special_tokens=False)["input_ids"]
+
+        with self._segments_lock:
+            self._segments[key] = ids
+            while len(self._segments) > self.TOKEN_COUNT_CACHE_SIZE:
+                self._segments.popitem(last=False)
+        return ids
+
+    def _generation_prompt_ids(self) -> List[int]:
+        """Tokens que añade add_generation_prompt al final del prompt"""
+        if self._generation_suffix is None:
+            probe = {"role": "user", "content": "a"}
+            closed = self._segment_text(probe)
+            opened = self._segment_text(probe, add_generation_prompt=True)
+            if not opened.startswith(closed):
+                raise ValueError("el prompt de generación no es un sufijo de la plantilla")
+            self._generation_suffix = self.tokenizer(opened[len(closed):], add_special_tokens=False)["input_ids"]
+        return self._generation_suffix
+
+    def _segmented_ids(
+        self,
+        messages: List[Message],
+        role: str,
+        knowledge: Optional[List[Dict[str, Any]]] = None
+    ) -> List[int]:
+        """Concatena cabecera del rol + segmentos cacheados + prompt de generación"""
+        input_ids = list(self._role_head(role))
+        for msg in self.with_knowledge(messages, knowledge):
+            if msg.role in ["user", "assistant"]:
+                input_ids.extend(self.message_ids(msg))
+        input_ids.extend(self._generation_prompt_ids())
+        return input_ids
+
+    def prompt_ids(
+        self,
+        messages: List[Message],
+        role: str = DEFAULT_ROLE,
+        knowledge: Optional[List[Dict[str, Any]]] = None
+    ) -> List[int]:
+        """input_ids del prompt: por segmentos si la plantilla lo permite, si no completo"""
+        if self.segmented_prompts:
+            return self._segmented_ids(messages, role, knowledge)
+        return self.tokenizer(self.format_messages(messages, role=role, knowledge=knowledge))["input_ids"]
+
+    def verify_segmented_prompts(self) -> bool:
+        """
+        Comprueba que concatenar segmentos da exactamente los mismos tokens que
+        tokenizar la plantilla completa. Si alguna conversación de prueba difiere
+        (plantillas con estado, fusiones BPE entre mensajes) se usa la ruta completa.
+        """
+        probe = [
+            Message(rol="user", contenido="Hola, ¿qué tal?"),
+            Message(rol="assistant", contenido="¡Bien, gracias!\n\n¿En qué puedo ayudarte?"),
+            Message(rol="user", contenido="Explica `def foo(): return 1` en Python."),
+            Message(rol="assistant", contenido="Es una función que devuelve 1.  "),
+            Message(rol="user", contenido="  Gracias\n"),
+        ]
+        try:
+            for role in ROLE_PROMPTS:
+                for length in range(1, len(probe) + 1):
+                    expected = self.tokenizer(self.format_messages(probe[:length], role=role))["input_ids"]
+                    if self._segmented_ids(probe[:length], role) != expected:
+                        raise ValueError(f"tokens distintos para el rol '{role}' con {length} mensajes")
+        except Exception as e:
+            logger.warning(f"⚠️  Tokenización por segmentos desactivada: {e}")
+            return False
 
-    return {
-        "status": "healthy",
-        "system_metrics": {
-            "cpu_used": cpu_percent,
-            "ram_used": ram_stats.percent,
-            "gpu": gpu_metrics,
-            "model_memory": model_memory
-        },
-        "model_loaded": model is not None,
-        "quantization": quantization_status,
-        "timestamp": time.time()
-    }
+        with self._segments_lock:
+            self._segments.clear()
+        logger.info("✅ Tokenización incremental por segmentos verificada")
+        return True
 
-@app.post("/v1/chat/completions")
-async def create_chat_completion(
-    request: ChatCompletionRequest,
-    api_key: str = Depends(verify_api_key)
-):
-    """Endpoint profesional de chat completions con streaming"""
+# ==============================================================================
+# === MÉTRICAS Y MUESTREO DEL SISTEMA =========================================
+# ==============================================================================
 
-    if request.stream:
-        return await handle_streaming_request(request)
-    else:
-        return await handle_standard_request(request)
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Histogram:
+    """Histograma acumulativo con etiquetas, en formato de exposición de Prometheus"""
+
+    def __init__(self, name: str, help_text: str, buckets: Tuple[float, ...], label_names: Tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(sorted(buckets))
+        self.label_names = label_names
+        self._series: Dict[Tuple[str, ...], List[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels: str):
+        if value is None or value < 0:
+            return
+        with self._lock:
+            # [conteo por bucket..., suma, total]
+            series = self._series.setdefault(labels, [0] * len(self.buckets) + [0.0, 0])
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[index] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {labels: list(values) for labels, values in self._series.items()}
+
+        for labels, values in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, values):
+                cumulative += count
+                bucket_labels = _format_labels(self.label_names, labels, 'le="%s"' % bound)
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            bucket_labels = _format_labels(self.label_names, labels, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{bucket_labels} {values[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, labels)} {values[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, labels)} {values[-1]}")
+        return lines
+
+class Counter:
+    """Contador monótono con etiquetas"""
+
+    def __init__(self, name: str, help_text: str, label_names: Tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels: str, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = dict(self._values)
+        for labels, value in sorted(values.items()):
+            lines.append(f"{self.name}{_format_labels(self.label_names, labels)} {value}")
+        return lines
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+TOKEN_LATENCY_BUCKETS = (0.005, 0.01, 0.02, 0.035, 0.05, 0.075, 0.1, 0.15, 0.25, 0.5, 1.0, 2.5)
+THROUGHPUT_BUCKETS = (1, 2, 5, 10, 15, 20, 30, 50, 75, 100, 200, 500)
+
+class FoxiaMetrics:
+    """Métricas por solicitud (etiquetadas por endpoint y streaming) para /metrics"""
 
-async def handle_streaming_request(request: ChatCompletionRequest):
-    """Maneja requests con streaming"""
+    def __init__(self):
+        labels = ("endpoint", "stream")
+        self.queue_wait = Histogram("foxia_queue_wait_seconds", "Espera en la cola del planificador", LATENCY_BUCKETS, labels)
+        self.tokenization = Histogram("foxia_tokenization_seconds", "Construcción y tokenización del prompt", LATENCY_BUCKETS, labels)
+        self.prefill = Histogram("foxia_prefill_seconds", "Prefill del prompt en el modelo", LATENCY_BUCKETS, labels)
+        self.time_to_first_token = Histogram("foxia_time_to_first_token_seconds", "Desde la llegada hasta el primer token", LATENCY_BUCKETS, labels)
+        self.inter_token = Histogram("foxia_inter_token_latency_seconds", "Tiempo entre tokens consecutivos", TOKEN_LATENCY_BUCKETS, labels)
+        self.total = Histogram("foxia_request_duration_seconds", "Duración total de la solicitud", LATENCY_BUCKETS, labels)
+        self.tokens_per_second = Histogram("foxia_tokens_per_second", "Velocidad de decodificación por solicitud", THROUGHPUT_BUCKETS, labels)
+        self.requests = Counter("foxia_requests_total", "Solicitudes de generación terminadas", labels + ("finish_reason",))
+        self.cache_hits = Counter("foxia_cache_hits_total", "Respuestas servidas desde caché", labels + ("cache",))
+        self.rag_retrieval = Histogram("foxia_rag_retrieval_seconds", "Recuperación de tripletas (embedding + búsqueda)", LATENCY_BUCKETS)
+        self.rag_queries = Counter("foxia_rag_queries_total", "Consultas de conocimiento por resultado", ("outcome",))
+
+    def observe_generation(self, labels: Tuple[str, str], generation_request, received_at: float):
+        """Registra el desglose de latencias de una solicitud terminada"""
+        now = time.time()
+        if generation_request.started_at is not None:
+            self.queue_wait.observe(generation_request.started_at - generation_request.enqueued_at, *labels)
+            if generation_request.prefilled_at is not None:
+                self.prefill.observe(generation_request.prefilled_at - generation_request.started_at, *labels)
+        if generation_request.first_token_at is not None:
+            self.time_to_first_token.observe(generation_request.first_token_at - received_at, *labels)
+
+        decode_s = (generation_request.finished_at or now) - (generation_request.prefilled_at or now)
+        if decode_s > 0 and generation_request.output_ids:
+            self.tokens_per_second.observe(len(generation_request.output_ids) / decode_s, *labels)
+
+        self.total.observe(now - received_at, *labels)
+        self.requests.inc(*labels, generation_request.finish_reason or "unknown")
+
+    def render(self) -> List[str]:
+        lines = []
+        for metric in (
+            self.queue_wait, self.tokenization, self.prefill, self.time_to_first_token,
+            self.inter_token, self.total, self.tokens_per_second, self.requests, self.cache_hits,
+            self.rag_retrieval, self.rag_queries
+        ):
+            lines.extend(metric.render())
+        return lines
+
+def metric_labels(http_request: Optional[Request], stream: bool) -> Tuple[str, str]:
+    """Etiquetas (endpoint, stream) de una solicitud"""
+    endpoint = http_request.url.path if http_request is not None else "internal"
+    return endpoint, "true" if stream else "false"
+
+class SystemSampler:
+    """
+    Muestrea CPU, RAM, VRAM y memoria del modelo en un hilo de fondo. NVML se
+    inicializa una sola vez y las lecturas de /health y /metrics no bloquean el
+    event loop: el último resumen (muestra actual + ventanas) ya está calculado.
+    """
+
+    # Ventanas de agregación (segundos)
+    WINDOWS = {"1m": 60, "5m": 300}
+    FIELDS = ("cpu_percent", "ram_percent", "vram_used_gb", "vram_percent", "model_memory_gb")
+
+    def __init__(self, interval_s: float = 1.0, footprint_fn=None):
+        self.interval_s = max(0.1, interval_s)
+        self.footprint_fn = footprint_fn  # Bytes ocupados por los modelos cargados
+        self._samples = collections.deque(maxlen=int(max(self.WINDOWS.values()) / self.interval_s) + 1)
+        self._latest: Dict[str, Any] = {}
+        self._summary: Dict[str, Any] = {}
+        self._nvml = None
+        self._nvml_handle = None
+        self._nvml_error: Optional[str] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        try:
+            import pynvml
+            pynvml.nvmlInit()
+            self._nvml = pynvml
+            self._nvml_handle = pynvml.nvmlDeviceGetHandleByIndex(0)
+        except Exception as e:
+            self._nvml_error = str(e)
 
-    # Formatear prompt
-    formatted_prompt = generation_engine.format_messages(request.messages)
+        # La primera llamada de cpu_percent(None) solo fija la referencia
+        psutil.cpu_percent(interval=None)
+        self._sample()
+        self._thread = threading.Thread(target=self._run, name="foxia-system-sampler", daemon=True)
+        self._thread.start()
 
-    # Preparar inputs
-    inputs = tokenizer(
-        formatted_prompt,
-        return_tensors="pt",
-        truncation=True,
-        max_length=4096
-    ).to(model.device)
+    def stop(self):
+        self._stop.set()
+        if self._nvml_handle is not None:
+            try:
+                self._nvml.nvmlShutdown()
+            except Exception:
+                pass
+
+    def latest(self) -> Dict[str, Any]:
+        return self._latest
+
+    def summary(self) -> Dict[str, Any]:
+        """Última muestra y min/avg/max por ventana (precalculados en el hilo de fondo)"""
+        return self._summary
+
+    def _aggregate(self) -> Dict[str, Any]:
+        now = time.time()
+        samples = list(self._samples)
+        windows = {}
+        for name, seconds in self.WINDOWS.items():
+            recent = [sample for sample in samples if now - sample["timestamp"] <= seconds]
+            stats = {"samples": len(recent)}
+            for field in self.FIELDS:
+                values = [sample[field] for sample in recent if sample.get(field) is not None]
+                if values:
+                    stats[field] = {
+                        "min": round(min(values), 2),
+                        "avg": round(sum(values) / len(values), 2),
+                        "max": round(max(values), 2)
+                    }
+            windows[name] = stats
+        return {"latest": self._latest, "windows": windows, "interval_s": self.interval_s}
+
+    def _run(self):
+        while not self._stop.wait(self.interval_s):
+            try:
+                self._sample()
+            except Exception as e:
+                logger.warning(f"⚠️  Error muestreando el sistema: {e}")
+
+    def _sample(self):
+        sample = {
+            "timestamp": time.time(),
+            "cpu_percent": psutil.cpu_percent(interval=None),
+            "ram_percent": psutil.virtual_memory().percent,
+            "vram_used_gb": None,
+            "vram_total_gb": None,
+            "vram_percent": None
+        }
+        if self._nvml_handle is not None:
+            mem_info = self._nvml.nvmlDeviceGetMemoryInfo(self._nvml_handle)
+            sample["vram_used_gb"] = round(mem_info.used / (1024**3), 2)
+            sample["vram_total_gb"] = round(mem_info.total / (1024**3), 2)
+            sample["vram_percent"] = round((mem_info.used / mem_info.total) * 100, 2)
+        if self._nvml_error is not None:
+            sample["gpu_error"] = self._nvml_error
+
+        sample["model_memory_gb"] = None
+        if self.footprint_fn is not None:
+            try:
+                sample["model_memory_gb"] = round(self.footprint_fn() / (1024**3), 2)
+            except Exception:
+                pass
 
-    # Configurar streamer
-    streamer = TextIteratorStreamer(
-        tokenizer,
-        skip_prompt=True,
-        timeout=60.0,
-        skip_special_tokens=True
-    )
+        self._latest = sample
+        self._samples.append(sample)
+        self._summary = self._aggregate()
 
-    # Configuración de generación optimizada para 4-bit
-    generation_kwargs = {
-        "input_ids": inputs.input_ids,
-        "attention_mask": inputs.attention_mask,
-        "streamer": streamer,
-        "max_new_tokens": request.max_tokens,
-        "temperature": request.temperature,
-        "top_p": request.top_p,
-        "repetition_penalty": request.repetition_penalty,
-        "do_sample": True,
-        "pad_token_id": tokenizer.eos_token_id,
-        "eos_token_id": tokenizer.eos_token_id,
-    }
+metrics = FoxiaMetrics()
+system_sampler = SystemSampler(
+    SYSTEM_SAMPLE_INTERVAL_S,
+    footprint_fn=lambda: model_registry.footprint_bytes() if model_registry is not None else 0
+)
+system_sampler.start()
 
-    # Función para generar en segundo plano
-    def generate_in_thread():
-        model.generate(**generation_kwargs)
+# ==============================================================================
+# === PLANIFICADOR DE GENERACIÓN (CONTINUOUS BATCHING) ========================
+# ==============================================================================
 
-    # Iniciar generación en hilo separado
-    thread = Thread(target=generate_in_thread)
-    thread.start()
+try:
+    from transformers import DynamicCache
+except ImportError:
+    DynamicCache = None  # transformers < 4.36: el modelo acepta tuplas directamente
+
+def _cache_to_legacy(past):
+    """Convierte la caché KV devuelta por el modelo a tuplas (key, value) por capa"""
+    if past is not None and hasattr(past, "to_legacy_cache"):
+        return past.to_legacy_cache()
+    return past
+
+def _cache_from_legacy(past):
+    """Prepara una caché KV en formato de tuplas para pasarla al modelo"""
+    if past is not None and DynamicCache is not None:
+        return DynamicCache.from_legacy_cache(past)
+    return past
+
+def _pad_past_left(past, pad: int):
+    """Añade `pad` posiciones vacías a la izquierda del eje temporal de la caché KV"""
+    if pad <= 0:
+        return past
+    padded = []
+    for key, value in past:
+        key_pad = key.new_zeros(key.shape[:2] + (pad,) + key.shape[3:])
+        value_pad = value.new_zeros(value.shape[:2] + (pad,) + value.shape[3:])
+        padded.append((torch.cat([key_pad, key], dim=2), torch.cat([value_pad, value], dim=2)))
+    return tuple(padded)
+
+def _select_past(past, rows, start: int = 0):
+    """Selecciona filas del batch y descarta las primeras `start` posiciones de la caché KV"""
+    return tuple((key[rows, :, start:], value[rows, :, start:]) for key, value in past)
+
+def _concat_past(first, second):
+    """Concatena dos cachés KV alineadas a lo largo del eje del batch"""
+    return tuple(
+        (torch.cat([key_a, key_b], dim=0), torch.cat([value_a, value_b], dim=0))
+        for (key_a, value_a), (key_b, value_b) in zip(first, second)
+    )
 
-    # Generador de eventos SSE
-    async def event_generator():
-        full_response = ""
-        for token in streamer:
-            if not token or not token.strip():
-                continue
+def _past_nbytes(past) -> int:
+    """Bytes ocupados por una caché KV en formato de tuplas"""
+    return sum(key.numel() * key.element_size() + value.numel() * value.element_size() for key, value in past)
+
+class PrefixKVCache:
+    """
+    Caché LRU de estados KV indexada por prefijo de tokens.
+
+    Cada turno de una conversación reenvía el historial completo, así que el prompt
+    nuevo comparte casi todo su prefijo con el del turno anterior. Guardando la caché
+    KV del prompt tras el prefill, el siguiente turno solo necesita procesar los
+    mensajes añadidos. Las entradas se expulsan por LRU al superar el presupuesto de
+    memoria o de número de entradas, salvo las fijadas (prefijos de ROLE_PROMPTS).
+    """
+
+    def __init__(self, max_bytes: int, max_entries: int):
+        self.max_bytes = max(0, max_bytes)
+        self.max_entries = max(1, max_entries)
+        self.entries: "collections.OrderedDict[int, Dict[str, Any]]" = collections.OrderedDict()
+        self.total_bytes = 0
+        self._lock = threading.Lock()
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "tokens_reused": 0,
+            "evictions": 0,
+            "system_prompt_hits": 0,
+            "system_prompt_tokens_saved": 0,
+        }
 
-            full_response += token
-            clean_token = generation_engine.clean_content(token)
-
-            if clean_token:
-                event_data = {
-                    "id": f"chatcmpl-{uuid.uuid4()}",
-                    "object": "chat.completion.chunk",
-                    "created": int(time.time()),
-                    "model": MODEL_ID,
-                    "choices": [{
-                        "index": 0,
-                        "delta": {"content": clean_token},
-                        "finish_reason": None
-                    }]
-                }
-                yield {"event": "message", "data": json.dumps(event_data)}
+    @staticmethod
+    def _common_prefix(cached: np.ndarray, query: np.ndarray) -> int:
+        """Longitud del prefijo común entre dos secuencias de tokens"""
+        n = min(len(cached), len(query))
+        if n == 0:
+            return 0
+        equal = cached[:n] == query[:n]
+        return n if equal.all() else int(equal.argmin())
 
-            await asyncio.sleep(0.01)
+    def lookup(self, input_ids: List[int]) -> Tuple[int, Any]:
+        """
+        Busca la entrada con el prefijo común más largo.
+        Devuelve (tokens reutilizables, caché KV recortada) o (0, None).
+        Siempre deja al menos un token sin cachear para obtener los logits.
+        """
+        query = np.asarray(input_ids, dtype=np.int64)
+        best_key, best_length = None, 0
+
+        with self._lock:
+            for key, entry in self.entries.items():
+                length = min(self._common_prefix(entry["tokens"], query), len(input_ids) - 1)
+                if length > best_length:
+                    best_key, best_length = key, length
+
+            if best_key is None:
+                self.stats["misses"] += 1
+                return 0, None
+
+            entry = self.entries[best_key]
+            self.entries.move_to_end(best_key)
+            self.stats["hits"] += 1
+            self.stats["tokens_reused"] += best_length
+            if entry["pinned"]:
+                self.stats["system_prompt_hits"] += 1
+                self.stats["system_prompt_tokens_saved"] += best_length
+            past = tuple((key[:, :, :best_length], value[:, :, :best_length]) for key, value in entry["past"])
+            return best_length, past
+
+    def store(self, input_ids: List[int], past, pinned: bool = False):
+        """
+        Guarda la caché KV de un prompt recién procesado (batch de tamaño 1).
+        Las entradas fijadas (`pinned`) nunca se expulsan.
+        """
+        tokens = np.asarray(input_ids, dtype=np.int64)
+        nbytes = _past_nbytes(past)
+        if nbytes > self.max_bytes and not pinned:
+            return
+
+        with self._lock:
+            key = hash(tokens.tobytes())
+            if key in self.entries and self.entries[key]["pinned"]:
+                return
 
-        # Evento de finalización
-        event_data = {
-            "id": f"chatcmpl-{uuid.uuid4()}",
-            "object": "chat.completion.chunk",
-            "created": int(time.time()),
-            "model": MODEL_ID,
-            "choices": [{
-                "index": 0,
-                "delta": {},
-                "finish_reason": "stop"
-            }]
+            # Una entrada que es prefijo exacto del prompt nuevo queda obsoleta:
+            # es el turno anterior de la misma conversación
+            for other in list(self.entries.keys()):
+                entry = self.entries[other]
+                if entry["pinned"] or len(entry["tokens"]) > len(tokens):
+                    continue
+                if self._common_prefix(entry["tokens"], tokens) == len(entry["tokens"]):
+                    self._remove(other)
+
+            self.entries[key] = {"tokens": tokens, "past": past, "nbytes": nbytes, "pinned": pinned}
+            self.total_bytes += nbytes
+
+            while self.total_bytes > self.max_bytes or len(self.entries) > self.max_entries:
+                oldest = next((k for k, e in self.entries.items() if not e["pinned"]), None)
+                if oldest is None:
+                    break
+                self._remove(oldest)
+                self.stats["evictions"] += 1
+
+    def _remove(self, key: int):
+        entry = self.entries.pop(key)
+        self.total_bytes -= entry["nbytes"]
+
+    def clear(self):
+        """Vacía la caché (p. ej. al cambiar de modelo)"""
+        with self._lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Estado de la caché para /health"""
+        return {
+            "entries": len(self.entries),
+            "pinned_entries": sum(1 for e in list(self.entries.values()) if e["pinned"]),
+            "memory_mb": round(self.total_bytes / (1024**2), 2),
+            "max_memory_mb": round(self.max_bytes / (1024**2), 2),
+            **self.stats
         }
-        yield {"event": "message", "data": json.dumps(event_data)}
-        yield {"event": "complete", "data": "[DONE]"}
 
-    return EventSourceResponse(event_generator())
+class AsyncTextStreamer(TextStreamer):
+    """
+    Streamer que entrega el texto generado a un asyncio.Queue.
 
-async def handle_standard_request(request: ChatCompletionRequest):
-    """Maneja requests estándar (sin streaming)"""
+    El planificador llama a put()/end() desde su hilo; el texto se agrupa en una
+    ventana de tiempo/tokens y se publica en el event loop con call_soon_threadsafe,
+    de modo que el generador SSE solo hace `await queue.get()` sin bloquear el loop.
+    La ventana de tokens cuenta ids generados (no trozos de texto) y la de tiempo se
+    cierra con un temporizador en el loop, así que un token lento o una pausa no
+    retienen el texto ya listo. Un `None` en la cola marca el final del stream.
+    """
+
+    def __init__(
+        self,
+        tokenizer,
+        loop: Optional[asyncio.AbstractEventLoop],
+        coalesce_ms: float = 30.0,
+        coalesce_tokens: int = 4,
+        **decode_kwargs
+    ):
+        super().__init__(tokenizer, skip_prompt=True, **decode_kwargs)
+        self.loop = loop
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.coalesce_s = max(0.0, coalesce_ms) / 1000.0
+        self.coalesce_tokens = max(1, coalesce_tokens)
+        self._pending = ""
+        self._pending_tokens = 0
+        self._last_flush = time.monotonic()
+        self._timer_armed = False
+        self._lock = threading.Lock()  # El temporizador envía desde el hilo del loop
+
+    def put(self, value):
+        if not (self.skip_prompt and self.next_tokens_are_prompt):
+            with self._lock:
+                self._pending_tokens += int(value.numel())
+        super().put(value)
+
+    def on_finalized_text(self, text: str, stream_end: bool = False):
+        with self._lock:
+            self._pending += text
+            if (
+                stream_end
+                or self._pending_tokens >= self.coalesce_tokens
+                or time.monotonic() - self._last_flush >= self.coalesce_s
+            ):
+                self._flush()
+            elif self._pending and not self._timer_armed:
+                self._arm_timer()
+
+        if stream_end:
+            self._publish(None)
+
+    def _arm_timer(self):
+        """Programa en el loop el envío de lo pendiente al cerrarse la ventana de tiempo"""
+        if self.loop is None:
+            return
+        delay = max(0.0, self.coalesce_s - (time.monotonic() - self._last_flush))
+        try:
+            self.loop.call_soon_threadsafe(self.loop.call_later, delay, self._flush_due)
+            self._timer_armed = True
+        except RuntimeError:
+            pass  # El event loop ya se cerró
+
+    def _flush_due(self):
+        with self._lock:
+            self._timer_armed = False
+            if not self._pending:
+                return
+            if time.monotonic() - self._last_flush >= self.coalesce_s:
+                self._flush()
+            else:
+                self._arm_timer()  # Hubo un envío después de programarlo: esperar al nuevo plazo
+
+    def _flush(self):
+        """Publica el texto pendiente (llamar con el lock tomado)"""
+        if not self._pending:
+            return
+        self._publish(self._pending)
+        self._pending = ""
+        self._pending_tokens = 0
+        self._last_flush = time.monotonic()
+
+    def _publish(self, item: Optional[str]):
+        try:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, item)
+        except RuntimeError:
+            pass  # El event loop ya se cerró
+
+class MemoryPubSub:
+    """Pub/sub en memoria con la interfaz publish() de redis.Redis (pruebas y nodos sin Redis)"""
 
+    def __init__(self):
+        self._subscribers: Dict[str, List[collections.deque]] = collections.defaultdict(list)
+        self._lock = threading.Lock()
+
+    def subscribe(self, channel: str) -> collections.deque:
+        """Buzón que recibe los mensajes publicados en el canal desde ahora"""
+        mailbox = collections.deque()
+        with self._lock:
+            self._subscribers[channel].append(mailbox)
+        return mailbox
+
+    def publish(self, channel: str, message: str) -> int:
+        with self._lock:
+            mailboxes = list(self._subscribers.get(channel, ()))
+        for mailbox in mailboxes:
+            mailbox.append(message)
+        return len(mailboxes)
+
+    def close(self):
+        pass
+
+class ChatEventPublisher:
+    """
+    Publica eventos de chat (deltas de tokens y mensaje final) en un canal pub/sub.
+
+    Los eventos se envían desde un hilo propio: el planificador solo encola y
+    nunca espera a Redis. Si la cola se llena (Redis caído o lento) se descartan
+    deltas, pero nunca el evento final: lleva el texto completo, así que el cliente
+    se recupera. Un solo hilo publica en orden de llegada.
+    """
+
+    def __init__(self, client, channel: str, max_pending: int = 10000):
+        self.client = client
+        self.channel = channel
+        self.max_pending = max_pending
+        self.stats = {"published": 0, "dropped": 0, "errors": 0}
+        self._pending: collections.deque = collections.deque()
+        self._wakeup = threading.Event()
+        self._running = True
+        self._thread = Thread(target=self._run, name="foxia-chat-publisher", daemon=True)
+        self._thread.start()
+
+    def publish(self, event: Dict[str, Any]):
+        if len(self._pending) >= self.max_pending and event.get("type") != "ai_stream_end":
+            self.stats["dropped"] += 1
+            return
+        self._pending.append(event)
+        self._wakeup.set()
+
+    def _run(self):
+        while self._running or self._pending:
+            if not self._pending:
+                self._wakeup.wait(1.0)
+                self._wakeup.clear()
+                continue
+            event = self._pending.popleft()
+            try:
+                self.client.publish(self.channel, json.dumps(event, ensure_ascii=False))
+                self.stats["published"] += 1
+            except Exception as e:
+                self.stats["errors"] += 1
+                if self.stats["errors"] == 1 or self.stats["errors"] % 100 == 0:
+                    logger.warning(f"⚠️  No se pudo publicar en '{self.channel}' ({self.stats['errors']} errores): {e}")
+
+    def close(self, timeout: float = 5.0):
+        """Termina de enviar lo pendiente y cierra el cliente"""
+        self._running = False
+        self._wakeup.set()
+        self._thread.join(timeout)
+        self.client.close()
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"enabled": True, "channel": self.channel, "pending": len(self._pending), **self.stats}
+
+class ChatChannelStreamer(AsyncTextStreamer):
+    """
+    Streamer que publica el texto en el canal del chat en lugar de en una cola local.
+
+    Misma agrupación por tiempo/tokens que el SSE: cada grupo sale como evento
+    `ai_stream_delta` (con número de secuencia) para que el WebSocket lo reenvíe
+    a los clientes del chat. `finish()` publica `ai_stream_end` con el texto final.
+    """
+
+    def __init__(
+        self,
+        tokenizer,
+        publisher: ChatEventPublisher,
+        chat_uuid: str,
+        stream_id: str,
+        loop: Optional[asyncio.AbstractEventLoop] = None,
+        **kwargs
+    ):
+        super().__init__(tokenizer, loop=loop, **kwargs)
+        self.publisher = publisher
+        self.chat_uuid = chat_uuid
+        self.stream_id = stream_id
+        self.sequence = 0
+
+    def _publish(self, item: Optional[str]):
+        if item is None:
+            return  # El final lo publica finish() con el contenido completo
+        self.sequence += 1
+        self.publisher.publish({
+            "type": "ai_stream_delta",
+            "chat_uuid": self.chat_uuid,
+            "stream_id": self.stream_id,
+            "seq": self.sequence,
+            "delta": item,
+            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S")
+        })
+
+    def finish(
+        self,
+        content: Optional[str] = None,
+        finish_reason: Optional[str] = None,
+        usage: Optional[Dict[str, Any]] = None,
+        error: Optional[str] = None
+    ):
+        """Mensaje final del stream: el texto limpio completo o el error"""
+        self.publisher.publish({
+            "type": "ai_stream_end",
+            "chat_uuid": self.chat_uuid,
+            "stream_id": self.stream_id,
+            "seq": self.sequence,
+            "content": content,
+            "finish_reason": finish_reason,
+            "usage": usage,
+            "error": error,
+            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S")
+        })
+
+chat_event_publisher: Optional[ChatEventPublisher] = None
+
+def build_chat_event_publisher():
+    """Publicador de tokens en el canal del chat (Redis o memory:// en pruebas)"""
+    global chat_event_publisher
+    location = CHAT_STREAM_REDIS
+    if not location and WORKER_QUEUE.startswith(("redis://", "rediss://", "unix://")):
+        location = WORKER_QUEUE
+    if not location:
+        return
     try:
-        # Formatear prompt
-        formatted_prompt = generation_engine.format_messages(request.messages)
-
-        # Preparar inputs
-        inputs = tokenizer(
-            formatted_prompt,
-            return_tensors="pt",
-            truncation=True,
-            max_length=4096
-        ).to(model.device)
-
-        # Configuración de generación
-        generation_config = {
-            "max_new_tokens": request.max_tokens,
-            "temperature": request.temperature,
-            "top_p": request.top_p,
-            "repetition_penalty": request.repetition_penalty,
-            "do_sample": True,
-            "pad_token_id": tokenizer.eos_token_id,
-            "eos_token_id": tokenizer.eos_token_id,
+        if location.startswith("memory://"):
+            client = MemoryPubSub()
+        else:
+            import redis
+            client = redis.Redis.from_url(location, health_check_interval=30)
+        chat_event_publisher = ChatEventPublisher(client, CHAT_STREAM_CHANNEL)
+        logger.info(f"📡 Tokens publicados en el canal '{CHAT_STREAM_CHANNEL}'")
+    except Exception as e:
+        logger.error(f"❌ Publicación de tokens en el chat desactivada: {e}")
+
+def open_chat_stream(request: "ChatCompletionRequest", runtime: "ModelRuntime", stream_id: str) -> Optional[ChatChannelStreamer]:
+    """
+    Streamer hacia el canal del chat si la solicitud trae chat_uuid y hay publicador.
+    Se crea dentro de la solicitud: su temporizador de agrupación corre en ese loop.
+    """
+    if not request.chat_uuid or chat_event_publisher is None:
+        return None
+    return ChatChannelStreamer(
+        runtime.tokenizer,
+        chat_event_publisher,
+        request.chat_uuid,
+        stream_id,
+        loop=asyncio.get_running_loop(),
+        coalesce_ms=CHAT_STREAM_COALESCE_MS,
+        coalesce_tokens=CHAT_STREAM_COALESCE_TOKENS,
+        skip_special_tokens=True
+    )
+
+class SchedulerQueueFull(Exception):
+    """La cola de admisión del planificador está llena"""
+
+    def __init__(self, message: str, retry_after: int = 1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class ClientLimitExceeded(SchedulerQueueFull):
+    """El chat/usuario ya tiene el máximo de solicitudes en curso"""
+
+class CancellationToken:
+    """
+    Token de cancelación cooperativa de una solicitud.
+
+    El planificador lo consulta antes de cada paso de decodificación y libera el
+    hueco del batch en cuanto se activa: por desconexión del cliente, por el plazo
+    máximo de la solicitud o por DELETE /v1/requests/{id}.
+    """
+
+    def __init__(self, timeout_s: Optional[float] = None):
+        self.deadline = time.monotonic() + timeout_s if timeout_s else None
+        self.reason: Optional[str] = None
+
+    def cancel(self, reason: str = "cancelled"):
+        if self.reason is None:
+            self.reason = reason
+
+    def is_cancelled(self) -> bool:
+        if self.reason is None and self.deadline is not None and time.monotonic() >= self.deadline:
+            self.reason = "timeout"
+        return self.reason is not None
+
+class GenerationRequest:
+    """Solicitud de generación gestionada por el planificador"""
+
+    def __init__(
+        self,
+        input_ids: List[int],
+        max_new_tokens: int,
+        temperature: float,
+        top_p: float,
+        repetition_penalty: float,
+        streamer=None,
+        request_id: Optional[str] = None,
+        timeout_s: Optional[float] = None,
+        seed: Optional[int] = None,
+        metric_labels: Optional[Tuple[str, str]] = None,
+        priority: str = "interactive",
+        user: Optional[str] = None,
+        reasoning_budget: int = 0,
+        hide_reasoning: bool = False
+    ):
+        self.request_id = request_id or f"chatcmpl-{uuid.uuid4()}"
+        self.input_ids = list(input_ids)
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.repetition_penalty = repetition_penalty
+        self.seed = seed
+        self.streamer = streamer
+        self.cancel_token = CancellationToken(timeout_s)
+        self.metric_labels = metric_labels
+        self.priority = priority
+        self.user = user
+        self.reasoning_budget = effective_reasoning_budget(reasoning_budget, max_new_tokens)
+        self.hide_reasoning = hide_reasoning
+
+        # Resultado
+        self.output_ids: List[int] = []
+        self.reasoning_tokens = 0
+        self.reasoning_truncated = False  # El presupuesto forzó el cierre del razonamiento
+        self.cached_tokens = 0
+        self.draft_proposed = 0
+        self.draft_accepted = 0
+        self.target_steps = 0
+        self.finish_reason: Optional[str] = None
+        self.error: Optional[Exception] = None
+        self.enqueued_at = time.time()
+        self.started_at: Optional[float] = None
+        self.prefilled_at: Optional[float] = None
+        self.first_token_at: Optional[float] = None
+        self.last_token_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.done = threading.Event()
+
+        # Estado interno del planificador
+        self._next_token: Optional[int] = None
+        self._position = 0
+        self._seen_ids = set(self.input_ids)
+        self._seen_tensor = None
+        self._generator = None
+        self._draft_past = None
+        self._draft_len = 0
+        self._loop = None
+        self._future = None
+        self._virtual_start = 0.0
+        self._virtual_finish = 0.0
+        self._counts_for_user = True  # En un grupo (n>1, lote) solo cuenta el primero
+        self._in_reasoning = False
+        self._forced_tokens = collections.deque()  # Tokens impuestos al muestreo (cierre del <think>)
+
+    @property
+    def token_budget(self) -> int:
+        """Tokens de caché KV que la solicitud puede llegar a ocupar"""
+        return len(self.input_ids) + self.max_new_tokens
+
+    @property
+    def flow_key(self) -> Tuple[str, str]:
+        """Flujo del reparto justo: clase de prioridad + chat/usuario (o la propia solicitud)"""
+        return self.priority, self.user or self.request_id
+
+    def speculative_stats(self) -> Optional[Dict[str, Any]]:
+        """Aceptación y tokens por pasada del modelo principal, si hubo especulación"""
+        if not self.draft_proposed:
+            return None
+        return {
+            "draft_tokens": self.draft_proposed,
+            "accepted_tokens": self.draft_accepted,
+            "acceptance_rate": round(self.draft_accepted / self.draft_proposed, 4),
+            "tokens_per_target_step": round(len(self.output_ids) / max(1, self.target_steps), 3)
         }
 
-        # Generar respuesta
-        with torch.no_grad():
-            outputs = model.generate(
-                **inputs,
-                **generation_config
+    async def wait(self) -> "GenerationRequest":
+        """Espera sin bloquear el event loop a que el planificador termine la solicitud"""
+        if self._future is not None:
+            await self._future
+        else:
+            await asyncio.get_running_loop().run_in_executor(None, self.done.wait)
+
+        if self.error is not None:
+            raise self.error
+        return self
+
+def effective_reasoning_budget(budget: int, max_new_tokens: int) -> int:
+    """
+    Presupuesto de <think> que deja sitio a la respuesta: como mucho max_new_tokens
+    menos la reserva (`reasoning_answer_reserve`, a lo sumo la mitad de max_new_tokens).
+    0 sigue significando sin límite.
+    """
+    budget = max(0, budget or 0)
+    if not budget or not max_new_tokens:
+        return budget
+    reserve = min(max(0, REASONING_ANSWER_RESERVE), max_new_tokens // 2)
+    return max(1, min(budget, max_new_tokens - reserve))
+
+def reasoning_token_ids(tokenizer) -> Tuple[Optional[int], Optional[int]]:
+    """Ids de <think> y </think> si el tokenizer los tiene como un solo token cada uno"""
+    ids = []
+    for marker in ("<think>", "</think>"):
+        encoded = tokenizer.encode(marker, add_special_tokens=False)
+        ids.append(encoded[0] if len(encoded) == 1 else None)
+    return (None, None) if None in ids else (ids[0], ids[1])
+
+class GenerationScheduler:
+    """
+    Planificador central de generación con continuous batching.
+
+    Las solicitudes de todos los endpoints se encolan aquí y un único hilo las
+    decodifica juntas, un token por paso, en un batch dinámico: cada secuencia
+    entra al batch tras su prefill y sale en cuanto termina, sin esperar al resto.
+    La caché KV del batch se mantiene alineada a la derecha con relleno a la izquierda.
+    """
+
+    def __init__(
+        self,
+        model,
+        tokenizer,
+        max_batch_size: int,
+        max_batch_tokens: int,
+        max_queue_size: int,
+        prefix_cache: Optional[PrefixKVCache] = None,
+        draft_model=None,
+        speculative_tokens: int = 4,
+        priority_weights: Optional[Dict[str, float]] = None,
+        ttft_targets: Optional[Dict[str, float]] = None,
+        max_inflight_per_user: int = 0
+    ):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.prefix_cache = prefix_cache
+        self.draft_model = draft_model
+        self.speculative_tokens = max(1, speculative_tokens)
+        if draft_model is not None:
+            # Vocabulario común (las matrices de salida pueden venir rellenadas a tamaños distintos)
+            self._spec_vocab = min(model.config.vocab_size, draft_model.config.vocab_size)
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_batch_tokens = max(1, max_batch_tokens)
+        self.max_queue_size = max(1, max_queue_size)
+        self.eos_token_id = tokenizer.eos_token_id
+
+        # Delimitadores <think>...</think> (modelos R1) y tokens con los que se fuerza
+        # el cierre del razonamiento al agotar el presupuesto
+        self.think_start_id, self.think_end_id = reasoning_token_ids(tokenizer)
+        self.reasoning_close_ids: List[int] = []
+        if self.think_end_id is not None:
+            self.reasoning_close_ids = tokenizer.encode(REASONING_CLOSE_TEXT, add_special_tokens=False)
+            if self.think_end_id not in self.reasoning_close_ids:
+                self.reasoning_close_ids = [self.think_end_id]
+
+        self.waiting = collections.deque()
+        self.active: List[GenerationRequest] = []
+        self.requests: Dict[str, GenerationRequest] = {}  # En cola o en el batch, por id
+
+        # Reparto justo ponderado (WFQ): cada flujo (clase, chat) avanza su tiempo virtual
+        # en token_budget / peso; se admite siempre la solicitud con menor tiempo de fin
+        self.priority_weights = priority_weights or {"interactive": 1}
+        self.ttft_targets = ttft_targets or {}
+        self.max_inflight_per_user = max(0, max_inflight_per_user)
+        self._virtual_time = 0.0
+        self._flow_finish: Dict[Tuple[str, str], float] = {}
+        self._flow_inflight: Dict[Tuple[str, str], int] = {}
+        self._user_inflight: Dict[str, int] = {}
+        self._class_ttft = {name: collections.deque(maxlen=512) for name in self.priority_weights}
+
+        # Estado del batch: caché KV en tuplas por capa y máscara de atención [batch, tiempo]
+        self._past = None
+        self._attention_mask = None
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[Thread] = None
+
+        self._throughput = collections.deque(maxlen=2048)  # (timestamp, tokens)
+        self.stats = {
+            "requests_completed": 0,
+            "requests_failed": 0,
+            "requests_cancelled": 0,
+            "prefill_tokens": 0,
+            "prefill_tokens_saved": 0,
+            "tokens_generated": 0,
+            "decode_steps": 0,
+            "speculative_steps": 0,
+            "draft_tokens_proposed": 0,
+            "draft_tokens_accepted": 0,
+            "reasoning_tokens": 0,
+            "reasoning_budget_forced": 0,
+        }
+        # Tiempos para estimar la aceleración especulativa frente a la decodificación normal
+        self._spec_timing = {"spec_s": 0.0, "spec_tokens": 0, "verify_s": 0.0, "single_s": 0.0, "single_tokens": 0}
+        # Media móvil del tiempo de servicio de una solicitud, para estimar Retry-After
+        self._service_time_ewma: Optional[float] = None
+
+    # --- Ciclo de vida -------------------------------------------------------
+
+    def start(self):
+        """Arranca el hilo de decodificación"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = Thread(target=self._run, name="foxia-scheduler", daemon=True)
+        self._thread.start()
+        logger.info(f"✅ Planificador de generación activo (batch máx. {self.max_batch_size})")
+
+    def stop(self):
+        """Detiene el hilo de decodificación"""
+        self._stop.set()
+        self._wakeup.set()
+
+    def shutdown(self, timeout_s: float = 10.0):
+        """Detiene el hilo y falla lo que quede pendiente (al descargar el modelo)"""
+        self.stop()
+        if self._thread is not None:
+            self._thread.join(timeout=timeout_s)
+
+        error = RuntimeError("El modelo fue descargado")
+        with self._lock:
+            leftovers = list(self.waiting) + list(self.active)
+            self.waiting.clear()
+        for request in leftovers:
+            self.stats["requests_failed"] += 1
+            self._finish(request, "error", error)
+        self._past, self._attention_mask, self.active = None, None, []
+        if self.prefix_cache is not None:
+            self.prefix_cache.clear()
+
+    def submit(self, request: GenerationRequest) -> GenerationRequest:
+        """Encola una solicitud; lanza SchedulerQueueFull si la cola está llena"""
+        with self._lock:
+            if len(self.waiting) >= self.max_queue_size:
+                raise SchedulerQueueFull(
+                    f"Cola de generación llena ({self.max_queue_size} solicitudes en espera)",
+                    retry_after=self.retry_after_s()
+                )
+            self._validate(request)
+            self._check_user_limit(request)
+            self._enqueue(request)
+
+        self._wakeup.set()
+        return request
+
+    def submit_many(self, group: List[GenerationRequest]) -> List[GenerationRequest]:
+        """
+        Encola un grupo (n>1 o lote) de forma atómica: o entran todas o ninguna.
+        El grupo cuenta como una sola solicitud para el límite por usuario.
+        """
+        with self._lock:
+            if len(self.waiting) + len(group) > self.max_queue_size:
+                raise SchedulerQueueFull(
+                    f"Cola de generación sin hueco para {len(group)} solicitudes "
+                    f"({len(self.waiting)}/{self.max_queue_size} en espera)",
+                    retry_after=self.retry_after_s()
+                )
+            if len({request.request_id for request in group}) != len(group):
+                raise ValueError("Ids de solicitud repetidos en el grupo")
+            for request in group:
+                self._validate(request)
+            self._check_user_limit(group[0])
+
+            for index, request in enumerate(group):
+                request._counts_for_user = index == 0
+                self._enqueue(request)
+
+        self._wakeup.set()
+        return group
+
+    def _validate(self, request: GenerationRequest):
+        if self._stop.is_set():
+            raise SchedulerQueueFull("El modelo se está descargando", retry_after=1)
+        if request.request_id in self.requests:
+            raise ValueError(f"Ya existe una solicitud activa con id {request.request_id}")
+        if request.priority not in self.priority_weights:
+            raise ValueError(f"Clase de prioridad desconocida: {request.priority}")
+
+    def _check_user_limit(self, request: GenerationRequest):
+        if (
+            self.max_inflight_per_user
+            and request.user
+            and self._user_inflight.get(request.user, 0) >= self.max_inflight_per_user
+        ):
+            raise ClientLimitExceeded(
+                f"'{request.user}' ya tiene {self.max_inflight_per_user} solicitudes en curso",
+                retry_after=self.retry_after_s()
+            )
+
+    def _enqueue(self, request: GenerationRequest):
+        """Añade la solicitud a la cola (llamar con el lock tomado)"""
+        try:
+            request._loop = asyncio.get_running_loop()
+            request._future = request._loop.create_future()
+        except RuntimeError:
+            pass  # Llamada fuera de un event loop: usar request.done
+
+        # Tiempo virtual WFQ: empieza donde acabó el flujo (o en el tiempo actual si estaba ocioso)
+        flow = request.flow_key
+        request._virtual_start = max(self._virtual_time, self._flow_finish.get(flow, 0.0))
+        request._virtual_finish = request._virtual_start + request.token_budget / self.priority_weights[request.priority]
+        self._flow_finish[flow] = request._virtual_finish
+        self._flow_inflight[flow] = self._flow_inflight.get(flow, 0) + 1
+        if request.user and request._counts_for_user:
+            self._user_inflight[request.user] = self._user_inflight.get(request.user, 0) + 1
+
+        self.waiting.append(request)
+        self.requests[request.request_id] = request
+
+    def check_admission(self):
+        """Rechaza de inmediato (antes de tokenizar) si la cola ya está llena"""
+        if len(self.waiting) >= self.max_queue_size:
+            raise SchedulerQueueFull(
+                f"Cola de generación llena ({self.max_queue_size} solicitudes en espera)",
+                retry_after=self.retry_after_s()
             )
 
-        # Decodificar respuesta
-        generated_tokens = outputs[0, inputs.input_ids.shape[1]:]
-        response_message = tokenizer.decode(generated_tokens, skip_special_tokens=True)
-        response_message = generation_engine.clean_content(response_message)
+    def retry_after_s(self) -> int:
+        """Segundos estimados hasta que se libere un hueco en la cola"""
+        # Con el batch lleno, termina una solicitud cada service_time / max_batch_size segundos
+        service_time = self._service_time_ewma or 10.0
+        excess = max(1, len(self.waiting) - self.max_queue_size + 1)
+        return int(min(60, max(1, math.ceil(excess * service_time / max(1, self.max_batch_size)))))
+
+    def cancel(self, request_id: str, reason: str = "cancelled") -> bool:
+        """Cancela una solicitud en cola o en curso; devuelve False si no existe"""
+        request = self.requests.get(request_id)
+        if request is None:
+            return False
 
-        # Calcular tokens
-        prompt_tokens = inputs.input_ids.shape[1]
-        completion_tokens = outputs.shape[1] - prompt_tokens
+        request.cancel_token.cancel(reason)
+        self._wakeup.set()
+        return True
 
-        response_data = {
-            "id": f"chatcmpl-{uuid.uuid4()}",
-            "object": "chat.completion",
-            "created": int(time.time()),
-            "model": MODEL_ID,
-            "choices": [{
-                "index": 0,
-                "message": {
-                    "role": "assistant",
-                    "content": response_message
-                },
-                "finish_reason": "stop"
-            }],
-            "usage": {
-                "prompt_tokens": prompt_tokens,
-                "completion_tokens": completion_tokens,
-                "total_tokens": prompt_tokens + completion_tokens
+    @torch.no_grad()
+    def precompute_prefix(self, input_ids: List[int]) -> int:
+        """
+        Calcula una vez el estado KV de un prefijo compartido y lo fija en la caché.
+        Usa el modelo fuera del hilo del planificador: llamar solo antes de recibir tráfico.
+        """
+        if self.prefix_cache is None or not input_ids:
+            return 0
+
+        outputs = self.model(input_ids=torch.tensor([input_ids], device=self.model.device), use_cache=True)
+        self.prefix_cache.store(input_ids, _cache_to_legacy(outputs.past_key_values), pinned=True)
+        return len(input_ids)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Estado actual del planificador para /health"""
+        now = time.time()
+        recent = sum(tokens for ts, tokens in list(self._throughput) if now - ts <= 10.0)
+        return {
+            "active_sequences": len(self.active),
+            "waiting_requests": len(self.waiting),
+            "max_batch_size": self.max_batch_size,
+            "max_batch_tokens": self.max_batch_tokens,
+            "tokens_per_second_10s": round(recent / 10.0, 2),
+            "prefix_cache": self.prefix_cache.snapshot() if self.prefix_cache is not None else None,
+            "speculative": self._speculative_snapshot(),
+            "priority_classes": self._priority_snapshot(),
+            **self.stats
+        }
+
+    def load(self) -> Dict[str, Any]:
+        """Carga instantánea para el latido: cola, secuencias en curso y tokens KV libres"""
+        now = time.time()
+        with self._lock:
+            reserved = sum(r.token_budget for r in self.active)
+            return {
+                "queue_depth": len(self.waiting),
+                "in_flight": len(self.active),
+                "max_batch_size": self.max_batch_size,
+                "kv_free_tokens": max(0, self.max_batch_tokens - reserved),
+                "tokens_per_second": round(sum(t for ts, t in list(self._throughput) if now - ts <= 10.0) / 10.0, 2)
             }
+
+    def _priority_snapshot(self) -> Dict[str, Any]:
+        """Time-to-first-token por clase frente a su objetivo"""
+        classes = {}
+        for name, weight in self.priority_weights.items():
+            samples = sorted(self._class_ttft.get(name, ()))
+            target = self.ttft_targets.get(name)
+            entry = {
+                "weight": weight,
+                "waiting": sum(1 for r in list(self.waiting) if r.priority == name),
+                "ttft_target_s": target,
+                "ttft_samples": len(samples)
+            }
+            if samples:
+                entry["ttft_avg_s"] = round(sum(samples) / len(samples), 3)
+                entry["ttft_p95_s"] = round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 3)
+                if target is not None:
+                    entry["within_target_rate"] = round(sum(1 for v in samples if v <= target) / len(samples), 4)
+            classes[name] = entry
+        return classes
+
+    def _speculative_snapshot(self) -> Dict[str, Any]:
+        if self.draft_model is None:
+            return {"enabled": False}
+
+        timing = self._spec_timing
+        proposed = self.stats["draft_tokens_proposed"]
+        snapshot = {
+            "enabled": True,
+            "speculative_tokens": self.speculative_tokens,
+            "acceptance_rate": round(self.stats["draft_tokens_accepted"] / proposed, 4) if proposed else None,
+            "speedup_estimate": None
         }
+        if timing["spec_tokens"]:
+            spec_latency = timing["spec_s"] / timing["spec_tokens"]
+            if timing["single_tokens"]:
+                single_latency = timing["single_s"] / timing["single_tokens"]
+            else:
+                # Sin decodificación normal medida: una pasada de verificación cuesta casi lo mismo
+                single_latency = timing["verify_s"] / max(1, self.stats["speculative_steps"])
+            snapshot["speedup_estimate"] = round(single_latency / spec_latency, 3)
+        return snapshot
 
-        return JSONResponse(content=response_data)
+    # --- Bucle principal -----------------------------------------------------
 
-    except Exception as e:
+    def _run(self):
+        while not self._stop.is_set():
+            self._wakeup.clear()
+            self._drop_cancelled()
+            self._admit_waiting()
+
+            if not self.active:
+                self._wakeup.wait(timeout=0.5)
+                continue
+
+            try:
+                # Con una sola secuencia activa la latencia manda: especular si hay borrador.
+                # Con varias, el batch ya aprovecha la GPU y se decodifica normalmente.
+                if self.draft_model is not None and len(self.active) == 1 and bool(self._attention_mask.all()):
+                    self._speculative_step()
+                else:
+                    self._decode_step()
+            except Exception as e:
+                logger.error(f"❌ Error en paso de decodificación: {e}")
+                self._fail_batch(e)
+
+    def _drop_cancelled(self):
+        """Saca de la cola y del batch las solicitudes canceladas o fuera de plazo"""
+        with self._lock:
+            dropped = [r for r in self.waiting if r.cancel_token.is_cancelled()]
+            for request in dropped:
+                self.waiting.remove(request)
+
+        rows = [i for i, r in enumerate(self.active) if r.cancel_token.is_cancelled()]
+        dropped.extend(self.active[i] for i in rows)
+        if rows:
+            self._remove_rows(rows)
+
+        for request in dropped:
+            self.stats["requests_cancelled"] += 1
+            logger.info(f"🛑 Generación {request.request_id} cancelada ({request.cancel_token.reason})")
+            self._finish(request, request.cancel_token.reason)
+
+    def _admit_waiting(self):
+        """Hace prefill de las solicitudes en espera mientras haya hueco en el batch"""
+        while True:
+            with self._lock:
+                if not self.waiting or len(self.active) >= self.max_batch_size:
+                    return
+
+                candidate = min(self.waiting, key=lambda r: r._virtual_finish)
+                in_flight = sum(r.token_budget for r in self.active)
+                if self.active and in_flight + candidate.token_budget > self.max_batch_tokens:
+                    return
+
+                self.waiting.remove(candidate)
+                self._virtual_time = max(self._virtual_time, candidate._virtual_start)
+
+            try:
+                self._prefill(candidate)
+            except Exception as e:
+                logger.error(f"❌ Error en prefill de {candidate.request_id}: {e}")
+                self.stats["requests_failed"] += 1
+                self._finish(candidate, "error", e)
+
+    @torch.no_grad()
+    def _prefill(self, request: GenerationRequest):
+        """Procesa el prompt de una solicitud y la incorpora al batch"""
+        request.started_at = time.time()
+
+        if request.streamer is not None:
+            request.streamer.put(torch.tensor([request.input_ids]))
+
+        # Reutilizar la caché KV del prefijo ya procesado en un turno anterior
+        reused, prefix_past = 0, None
+        if self.prefix_cache is not None:
+            reused, prefix_past = self.prefix_cache.lookup(request.input_ids)
+
+        input_ids = torch.tensor([request.input_ids[reused:]], device=self.model.device)
+        outputs = self.model(
+            input_ids=input_ids,
+            past_key_values=_cache_from_legacy(prefix_past),
+            use_cache=True
+        )
+        past = _cache_to_legacy(outputs.past_key_values)
+        request.prefilled_at = time.time()
+        request._position = len(request.input_ids)
+        # La plantilla de chat de R1 abre el <think> al final del prompt
+        request._in_reasoning = self.think_start_id is not None and self.think_start_id in request.input_ids[-3:]
+        request.cached_tokens = reused
+        self.stats["prefill_tokens"] += len(request.input_ids) - reused
+        self.stats["prefill_tokens_saved"] += reused
+
+        if self.prefix_cache is not None:
+            self.prefix_cache.store(request.input_ids, past)
+
+        token = self._sample(outputs.logits[0, -1, :], request)
+        self._throughput.append((time.time(), 1))
+        if self._append_token(request, token):
+            return
+
+        self._join_batch(request, past)
+
+    def _join_batch(self, request: GenerationRequest, past):
+        """Alinea la caché KV de una secuencia nueva con la del batch y la concatena"""
+        length = past[0][0].shape[2]
+        mask = torch.ones((1, length), dtype=torch.long, device=past[0][0].device)
+
+        if self._past is None:
+            self._past, self._attention_mask = past, mask
+        else:
+            current = self._attention_mask.shape[1]
+            if length < current:
+                past = _pad_past_left(past, current - length)
+                mask = torch.nn.functional.pad(mask, (current - length, 0), value=0)
+            elif length > current:
+                self._past = _pad_past_left(self._past, length - current)
+                self._attention_mask = torch.nn.functional.pad(self._attention_mask, (length - current, 0), value=0)
+
+            self._past = _concat_past(self._past, past)
+            self._attention_mask = torch.cat([self._attention_mask, mask], dim=0)
+
+        self.active.append(request)
+
+    @torch.no_grad()
+    def _decode_step(self):
+        """Decodifica un token para todas las secuencias activas en una sola pasada"""
+        started = time.perf_counter()
+        batch = list(self.active)
+        device = self._attention_mask.device
+
+        input_ids = torch.tensor([[r._next_token] for r in batch], device=device)
+        position_ids = torch.tensor([[r._position] for r in batch], device=device)
+        attention_mask = torch.cat(
+            [self._attention_mask, self._attention_mask.new_ones((len(batch), 1))], dim=1
+        )
+
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=_cache_from_legacy(self._past),
+            use_cache=True
+        )
+        self._past = _cache_to_legacy(outputs.past_key_values)
+        self._attention_mask = attention_mask
+        self.stats["decode_steps"] += 1
+
+        logits = outputs.logits[:, -1, :]
+        finished = []
+        for row, request in enumerate(batch):
+            request._position += 1
+            request.target_steps += 1
+            token = self._sample(logits[row], request)
+            if self._append_token(request, token):
+                finished.append(row)
+
+        self._throughput.append((time.time(), len(batch)))
+        if finished:
+            self._remove_rows(finished)
+
+        if len(batch) == 1:
+            self._spec_timing["single_s"] += time.perf_counter() - started
+            self._spec_timing["single_tokens"] += 1
+
+    @torch.no_grad()
+    def _speculative_step(self):
+        """
+        Paso de decodificación especulativa para la única secuencia activa.
+
+        El modelo borrador propone `speculative_tokens` tokens y el modelo principal los
+        verifica en una sola pasada. Con greedy se aceptan mientras coincidan con el
+        argmax; con muestreo se usa el criterio de aceptación/rechazo estándar, que
+        conserva exactamente la distribución del modelo principal.
+        """
+        started = time.perf_counter()
+        request = self.active[0]
+        k = min(self.speculative_tokens, request.max_new_tokens - len(request.output_ids))
+        if k < 1 or request._forced_tokens:
+            self._decode_step()
+            return
+
+        device = self._attention_mask.device
+        vocab = self._spec_vocab
+        greedy = not request.temperature or request.temperature <= 0
+
+        # 1. Propuesta: poner al día la caché del borrador y muestrear k tokens
+        full = request.input_ids + request.output_ids
+        feed = full[request._draft_len:]
+        draft_past = request._draft_past
+        drafts: List[int] = []
+        draft_probs = []
+        for _ in range(k):
+            outputs = self.draft_model(
+                input_ids=torch.tensor([feed], device=self.draft_model.device),
+                past_key_values=_cache_from_legacy(draft_past),
+                use_cache=True
+            )
+            draft_past = _cache_to_legacy(outputs.past_key_values)
+            warped = self._warp(outputs.logits[0, -1, :vocab].to(device), request, drafts)
+
+            if greedy:
+                token, probs = int(torch.argmax(warped)), None
+            else:
+                probs = torch.softmax(warped, dim=-1)
+                token = int(torch.multinomial(probs, num_samples=1, generator=self._generator_for(request, probs.device)))
+            drafts.append(token)
+            draft_probs.append(probs)
+            feed = [token]
+
+        # 2. Verificación: el modelo principal procesa el último token y los k borradores
+        verify_started = time.perf_counter()
+        outputs = self.model(
+            input_ids=torch.tensor([[request._next_token] + drafts], device=device),
+            past_key_values=_cache_from_legacy(self._past),
+            use_cache=True
+        )
+        past = _cache_to_legacy(outputs.past_key_values)
+        target_logits = outputs.logits[0, :, :vocab]
+        request.target_steps += 1
+        self._spec_timing["verify_s"] += time.perf_counter() - verify_started
+
+        # 3. Aceptación
+        accepted, final_token = 0, None
+        for j, token in enumerate(drafts):
+            warped = self._warp(target_logits[j], request, drafts[:j])
+            if greedy:
+                target_token = int(torch.argmax(warped))
+                if target_token == token:
+                    accepted += 1
+                    continue
+                final_token = target_token
+                break
+
+            p = torch.softmax(warped, dim=-1)
+            q = draft_probs[j]
+            generator = self._generator_for(request, p.device)
+            if float(torch.rand(1, generator=generator, device=p.device)) < min(1.0, float(p[token] / q[token])):
+                accepted += 1
+                continue
+
+            residual = torch.clamp(p - q, min=0.0)
+            residual = residual / residual.sum() if residual.sum() > 0 else p
+            final_token = int(torch.multinomial(residual, num_samples=1, generator=generator))
+            break
+
+        if final_token is None:
+            final_token = self._sample(target_logits[k], request, drafts)
+
+        self.stats["speculative_steps"] += 1
+        self.stats["draft_tokens_proposed"] += k
+        self.stats["draft_tokens_accepted"] += accepted
+        request.draft_proposed += k
+        request.draft_accepted += accepted
+
+        # 4. Emitir tokens aceptados + corrección/bonus. Se para en el primer token que
+        # termina la secuencia o agota el presupuesto de razonamiento: desde ahí mandan
+        # el final o el cierre forzado del <think>, no los borradores
+        emitted, finished = 0, False
+        for token in drafts[:accepted] + [final_token]:
+            emitted += 1
+            if self._append_token(request, token):
+                finished = True
+                break
+            if request._forced_tokens:
+                break
+
+        self._throughput.append((time.time(), emitted))
+        self._spec_timing["spec_s"] += time.perf_counter() - started
+        self._spec_timing["spec_tokens"] += emitted
+
+        if finished:
+            self._remove_rows([0])
+            return
+
+        # 5. Recortar cachés a lo emitido: el principal guarda el token anterior y los
+        # emitidos salvo el último, que queda pendiente para el siguiente paso
+        new_length = request._position + emitted
+        self._past = tuple((key[:, :, :new_length], value[:, :, :new_length]) for key, value in past)
+        self._attention_mask = self._attention_mask.new_ones((1, new_length))
+        request._position = new_length
+
+        draft_length = min(len(full) + emitted - 1, len(full) + k - 1)
+        request._draft_past = tuple((key[:, :, :draft_length], value[:, :, :draft_length]) for key, value in draft_past)
+        request._draft_len = draft_length
+
+    def _remove_rows(self, rows: List[int]):
+        """Saca del batch las secuencias terminadas y recorta el relleno sobrante"""
+        keep = [i for i in range(len(self.active)) if i not in set(rows)]
+        if not keep:
+            self._past, self._attention_mask, self.active = None, None, []
+            return
+
+        index = torch.tensor(keep, device=self._attention_mask.device)
+        mask = self._attention_mask[index]
+
+        # El relleno está a la izquierda: recortar columnas vacías en todas las filas
+        used_columns = mask.sum(dim=0).nonzero()
+        start = int(used_columns[0]) if len(used_columns) else 0
+
+        self._past = _select_past(self._past, index, start)
+        self._attention_mask = mask[:, start:]
+        self.active = [self.active[i] for i in keep]
+
+    # --- Muestreo y finalización ---------------------------------------------
+
+    def _warp(self, logits, request: GenerationRequest, extra_ids: List[int] = ()):
+        """
+        Aplica penalización de repetición, temperatura y top-p a unos logits.
+        `extra_ids` son tokens aún no confirmados (borradores) que cuentan como vistos.
+        """
+        logits = logits.float()
+
+        if request.repetition_penalty and request.repetition_penalty != 1.0:
+            if extra_ids:
+                seen = torch.tensor(sorted(request._seen_ids.union(extra_ids)), device=logits.device)
+            else:
+                if request._seen_tensor is None or request._seen_tensor.device != logits.device:
+                    request._seen_tensor = torch.tensor(sorted(request._seen_ids), device=logits.device)
+                seen = request._seen_tensor
+            scores = logits[seen]
+            logits[seen] = torch.where(
+                scores < 0, scores * request.repetition_penalty, scores / request.repetition_penalty
+            )
+
+        if not request.temperature or request.temperature <= 0:
+            return logits
+
+        logits = logits / request.temperature
+
+        if request.top_p is not None and request.top_p < 1.0:
+            sorted_logits, sorted_indices = torch.sort(logits, descending=True)
+            cumulative = torch.softmax(sorted_logits, dim=-1).cumsum(dim=-1)
+            remove = cumulative > request.top_p
+            remove[1:] = remove[:-1].clone()
+            remove[0] = False
+            logits[sorted_indices[remove]] = float("-inf")
+
+        return logits
+
+    @staticmethod
+    def _generator_for(request: GenerationRequest, device):
+        """Generador aleatorio propio de la solicitud si fijó una seed"""
+        if request.seed is not None and request._generator is None:
+            request._generator = torch.Generator(device=device).manual_seed(request.seed)
+        return request._generator
+
+    def _sample(self, logits, request: GenerationRequest, extra_ids: List[int] = ()) -> int:
+        """Elige el siguiente token (greedy con temperature 0, muestreo en otro caso)"""
+        if request._forced_tokens:
+            return request._forced_tokens.popleft()
+        logits = self._warp(logits, request, extra_ids)
+        if not request.temperature or request.temperature <= 0:
+            return int(torch.argmax(logits))
+
+        probs = torch.softmax(logits, dim=-1)
+        return int(torch.multinomial(probs, num_samples=1, generator=self._generator_for(request, probs.device)))
+
+    def _append_token(self, request: GenerationRequest, token: int) -> bool:
+        """Registra un token generado; devuelve True si la secuencia terminó"""
+        request.output_ids.append(token)
+        self.stats["tokens_generated"] += 1
+
+        now = time.time()
+        if request.first_token_at is None:
+            request.first_token_at = now
+            self._class_ttft[request.priority].append(now - request.enqueued_at)
+        elif request.metric_labels is not None:
+            metrics.inter_token.observe(now - request.last_token_at, *request.metric_labels)
+        request.last_token_at = now
+
+        if token not in request._seen_ids:
+            request._seen_ids.add(token)
+            request._seen_tensor = None
+
+        if token == self.eos_token_id:
+            self._finish(request, "stop")
+            return True
+
+        reasoning = self._track_reasoning(request, token)
+        if request.streamer is not None and not (reasoning and request.hide_reasoning):
+            request.streamer.put(torch.tensor([token]))
+
+        if len(request.output_ids) >= request.max_new_tokens:
+            self._finish(request, "length")
+            return True
+
+        request._next_token = token
+        return False
+
+    def _track_reasoning(self, request: GenerationRequest, token: int) -> bool:
+        """
+        Cuenta los tokens del bloque <think> y, al agotar el presupuesto de la
+        solicitud, programa el cierre (`reasoning_close_text`) para que los
+        siguientes tokens ya sean la respuesta. Devuelve True si el token es
+        parte del razonamiento (delimitadores incluidos).
+        """
+        if self.think_end_id is None:
+            return False
+        if token == self.think_start_id and not request._in_reasoning and request.reasoning_tokens == 0:
+            request._in_reasoning = True
+        elif not request._in_reasoning:
+            return False
+
+        request.reasoning_tokens += 1
+        self.stats["reasoning_tokens"] += 1
+
+        if token == self.think_end_id:
+            request._in_reasoning = False
+            # Cierre natural antes de que empezara el forzado: ya no hace falta
+            if len(request._forced_tokens) == len(self.reasoning_close_ids):
+                request._forced_tokens.clear()
+        elif (
+            request.reasoning_budget
+            and request.reasoning_tokens >= request.reasoning_budget
+            and not request.reasoning_truncated
+        ):
+            request.reasoning_truncated = True
+            request._forced_tokens.extend(self.reasoning_close_ids)
+            self.stats["reasoning_budget_forced"] += 1
+        return True
+
+    def _finish(self, request: GenerationRequest, reason: str, error: Optional[Exception] = None):
+        """Marca la solicitud como terminada y despierta a quien la espera"""
+        request.finish_reason = reason
+        request.error = error
+        request.finished_at = time.time()
+        request._draft_past = None
+        with self._lock:
+            if self.requests.pop(request.request_id, None) is not None:
+                self._release_flow(request)
+        if error is None and request.started_at is not None:
+            service_time = request.finished_at - request.started_at
+            if self._service_time_ewma is None:
+                self._service_time_ewma = service_time
+            else:
+                self._service_time_ewma = 0.8 * self._service_time_ewma + 0.2 * service_time
+        if error is None and not request.cancel_token.is_cancelled():
+            self.stats["requests_completed"] += 1
+
+        if request.streamer is not None:
+            try:
+                request.streamer.end()
+            except Exception as e:
+                logger.warning(f"⚠️  Error cerrando streamer de {request.request_id}: {e}")
+
+        request.done.set()
+        if request._future is not None:
+            try:
+                request._loop.call_soon_threadsafe(self._resolve_future, request)
+            except RuntimeError:
+                pass  # El event loop ya se cerró
+
+    def _release_flow(self, request: GenerationRequest):
+        """Descuenta la solicitud de su flujo y de su usuario (llamar con el lock tomado)"""
+        flow = request.flow_key
+        remaining = self._flow_inflight.get(flow, 1) - 1
+        if remaining <= 0:
+            # Flujo ocioso: su próxima solicitud parte del tiempo virtual actual
+            self._flow_inflight.pop(flow, None)
+            self._flow_finish.pop(flow, None)
+        else:
+            self._flow_inflight[flow] = remaining
+
+        if request.user and request._counts_for_user:
+            remaining = self._user_inflight.get(request.user, 1) - 1
+            if remaining <= 0:
+                self._user_inflight.pop(request.user, None)
+            else:
+                self._user_inflight[request.user] = remaining
+
+    @staticmethod
+    def _resolve_future(request: GenerationRequest):
+        if not request._future.done():
+            request._future.set_result(request)
+
+    def _fail_batch(self, error: Exception):
+        """Aborta todas las secuencias activas tras un error irrecuperable del batch"""
+        for request in self.active:
+            self.stats["requests_failed"] += 1
+            self._finish(request, "error", error)
+
+        self._past, self._attention_mask, self.active = None, None, []
+        clean_gpu_cache()
+
+# ==============================================================================
+# === REGISTRO DE MODELOS (CAMBIO EN CALIENTE) ================================
+# ==============================================================================
+
+class ModelRuntime:
+    """Un modelo servible: pesos, tokenizer, motor de prompts y planificador propios"""
+
+    def __init__(self, model_id: str, model_instance, tokenizer_instance, engine=None, draft=None):
+        self.model_id = model_id
+        self.model = model_instance
+        self.tokenizer = tokenizer_instance
+        self.engine = engine or FoxiaGenerationEngine(model_instance, tokenizer_instance)
+        self.scheduler = GenerationScheduler(
+            model_instance,
+            tokenizer_instance,
+            max_batch_size=MAX_BATCH_SIZE,
+            max_batch_tokens=MAX_BATCH_TOKENS,
+            max_queue_size=MAX_QUEUE_SIZE,
+            prefix_cache=PrefixKVCache(
+                max_bytes=PREFIX_CACHE_MAX_MB * 1024**2,
+                max_entries=PREFIX_CACHE_MAX_ENTRIES
+            ),
+            draft_model=draft,
+            speculative_tokens=SPECULATIVE_TOKENS,
+            priority_weights=PRIORITY_WEIGHTS,
+            ttft_targets=PRIORITY_TTFT_TARGETS_S,
+            max_inflight_per_user=MAX_INFLIGHT_PER_USER
+        )
+        self.footprint_bytes = model_footprint_bytes(model_instance)
+        self.loaded_at = time.time()
+        self.last_used = self.loaded_at
+        self.warm = False
+        # Solicitudes que ya eligieron este modelo y aún no entraron al planificador
+        # (cachés, prompt): el drenado al retirarlo también las espera
+        self._reserved = 0
+        self._reserved_lock = threading.Lock()
+
+    def start(self):
+        self.scheduler.start()
+
+    def reserve(self):
+        with self._reserved_lock:
+            self._reserved += 1
+
+    def unreserve(self):
+        """Suelta la reserva de resolve(); llamar cuando la solicitud ya está encolada o se abandona"""
+        with self._reserved_lock:
+            self._reserved -= 1
+
+    def warmup(self):
+        """Calienta el modelo y precalcula la caché KV de los prompts de sistema"""
+        logger.info(f"--> Realizando calentamiento GPU para {self.model_id}...")
+        try:
+            warmup_inputs = self.tokenizer("Calentamiento modelo 4-bit", return_tensors="pt").to(self.model.device)
+            _ = self.model.generate(**warmup_inputs, max_new_tokens=10)
+            logger.info("✅ GPU calentada y lista para 4-bit")
+        except Exception as e:
+            logger.warning(f"⚠️  Calentamiento falló: {e}")
+
+        logger.info("--> Precalculando caché KV de los prompts de sistema...")
+        for role_name in ROLE_PROMPTS:
+            try:
+                prefix_tokens = self.scheduler.precompute_prefix(self.engine.role_prefix_ids(role_name))
+                logger.info(f"✅ Prefijo de '{role_name}' en caché ({prefix_tokens} tokens)")
+            except Exception as e:
+                logger.warning(f"⚠️  No se pudo precalcular el prefijo de '{role_name}': {e}")
+        self.warm = True
+
+    def in_flight(self) -> int:
+        return len(self.scheduler.requests) + self._reserved
+
+    def release(self):
+        """Detiene el planificador y suelta las referencias a los pesos"""
+        self.scheduler.shutdown()
+        self.scheduler.model = self.scheduler.draft_model = None
+        self.engine.model = None
+        self.model = None
+        clean_gpu_cache()
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "model_id": self.model_id,
+            "memory_gb": round(self.footprint_bytes / (1024**3), 2),
+            "loaded_at": self.loaded_at,
+            "last_used": self.last_used,
+            "warm": self.warm,
+            "in_flight": self.in_flight()
+        }
+
+class ModelNotAvailable(Exception):
+    """El modelo pedido no está cargado (o todavía se está cargando)"""
+
+    def __init__(self, message: str, loading: bool = False):
+        super().__init__(message)
+        self.loading = loading
+
+class ModelRegistry:
+    """
+    Modelos residentes por id.
+
+    Un modelo nuevo se carga y calienta en un hilo de fondo y solo entonces se
+    publica; el cambio de modelo por defecto es atómico. Cada solicitud resuelve su
+    modelo al llegar, así que las que están en curso terminan en el anterior, que se
+    libera cuando se queda sin solicitudes. Con presupuesto de memoria, los modelos
+    que no son el por defecto se descargan por LRU.
+    """
+
+    def __init__(self, default_runtime: ModelRuntime, memory_budget_bytes: int = 0):
+        self.runtimes: "collections.OrderedDict[str, ModelRuntime]" = collections.OrderedDict()
+        self.runtimes[default_runtime.model_id] = default_runtime
+        self.default_id = default_runtime.model_id
+        self.memory_budget_bytes = memory_budget_bytes
+        self.loading: Dict[str, Dict[str, Any]] = {}
+        self.retiring: List[ModelRuntime] = []
+        self._lock = threading.Lock()
+
+    def default(self) -> ModelRuntime:
+        return self.runtimes[self.default_id]
+
+    def resolve(self, model_id: Optional[str] = None, reserve: bool = False) -> ModelRuntime:
+        """
+        Modelo que atenderá una solicitud; lanza ModelNotAvailable si no está residente.
+        Con `reserve`, la reserva se toma con el lock: un cambio de modelo no puede
+        retirarlo y drenarlo entre la resolución y el submit.
+        """
+        with self._lock:
+            runtime = self.runtimes.get(model_id or self.default_id)
+            if runtime is None:
+                loading = self.loading.get(model_id, {}).get("status") == "loading"
+                raise ModelNotAvailable(
+                    f"Modelo '{model_id}' {'cargándose' if loading else 'no cargado'}. "
+                    f"Disponibles: {', '.join(self.runtimes)}",
+                    loading=loading
+                )
+            self.runtimes.move_to_end(runtime.model_id)
+            runtime.last_used = time.time()
+            if reserve:
+                runtime.reserve()
+            return runtime
+
+    def all_runtimes(self) -> List[ModelRuntime]:
+        with self._lock:
+            return list(self.runtimes.values()) + list(self.retiring)
+
+    def footprint_bytes(self) -> int:
+        return sum(runtime.footprint_bytes for runtime in self.all_runtimes())
+
+    def load(self, model_id: str, make_default: bool = False, replace: bool = False) -> str:
+        """Lanza la carga en segundo plano; devuelve el estado resultante"""
+        with self._lock:
+            if model_id in self.runtimes:
+                if make_default or replace:
+                    self._switch_default(model_id, replace)
+                    return "switched"
+                return "resident"
+            if self.loading.get(model_id, {}).get("status") == "loading":
+                return "loading"
+            self.loading[model_id] = {"status": "loading", "started_at": time.time()}
+
+        Thread(target=self._load, args=(model_id, make_default, replace), name=f"foxia-load-{model_id}", daemon=True).start()
+        return "loading"
+
+    def _load(self, model_id: str, make_default: bool, replace: bool):
+        started = time.time()
+        try:
+            logger.info(f"--> Cargando modelo {model_id} en segundo plano...")
+            loader = ModelLoader4Bit(model_id)
+            loader.load_model_4bit()
+            runtime = ModelRuntime(model_id, loader.model, loader.tokenizer)
+            runtime.start()
+            runtime.warmup()
+
+            with self._lock:
+                self.runtimes[model_id] = runtime
+                if make_default or replace:
+                    self._switch_default(model_id, replace)
+                self._evict_over_budget(keep=model_id)
+                self.loading[model_id] = {"status": "ready", "load_s": round(time.time() - started, 1)}
+            logger.info(f"✅ Modelo {model_id} listo en {time.time() - started:.1f}s")
+        except Exception as e:
+            logger.error(f"❌ No se pudo cargar {model_id}: {e}")
+            with self._lock:
+                self.loading[model_id] = {"status": "error", "error": str(e)}
+            clean_gpu_cache()
+
+    def _switch_default(self, model_id: str, replace: bool):
+        """Cambia el modelo por defecto (llamar con el lock tomado)"""
+        previous = self.default_id
+        self.default_id = model_id
+        logger.info(f"🔀 Modelo por defecto: {previous} → {model_id}")
+        if replace and previous != model_id:
+            self._retire(self.runtimes.pop(previous))
+
+    def _evict_over_budget(self, keep: Optional[str] = None):
+        """
+        Descarga por LRU los modelos que no son el por defecto (llamar con el lock tomado).
+        `keep` es el modelo recién cargado: nunca es candidato, aunque sea el único que
+        sobre, para no tirar la carga que se acaba de pagar.
+        """
+        if not self.memory_budget_bytes:
+            return
+        while sum(r.footprint_bytes for r in self.runtimes.values()) > self.memory_budget_bytes:
+            candidates = [model_id for model_id in self.runtimes if model_id not in (self.default_id, keep)]
+            if not candidates:
+                logger.warning("⚠️ Presupuesto de memoria superado sin modelos descargables")
+                break
+            logger.info(f"📦 Presupuesto de memoria superado: descargando {candidates[0]}")
+            self._retire(self.runtimes.pop(candidates[0]))
+
+    def unload(self, model_id: str):
+        with self._lock:
+            if model_id == self.default_id:
+                raise ValueError("No se puede descargar el modelo por defecto")
+            runtime = self.runtimes.pop(model_id, None)
+            if runtime is None:
+                raise ModelNotAvailable(f"Modelo '{model_id}' no cargado")
+            self._retire(runtime)
+
+    def _retire(self, runtime: ModelRuntime):
+        """Deja terminar las solicitudes en curso del modelo y después lo libera"""
+        self.retiring.append(runtime)
+
+        def drain():
+            deadline = time.time() + REQUEST_TIMEOUT_S
+            while runtime.in_flight() and time.time() < deadline:
+                time.sleep(0.5)
+            runtime.release()
+            with self._lock:
+                self.retiring.remove(runtime)
+            logger.info(f"🧹 Modelo {runtime.model_id} descargado")
+
+        Thread(target=drain, name=f"foxia-unload-{runtime.model_id}", daemon=True).start()
+
+    def cancel(self, request_id: str, reason: str = "cancelled") -> bool:
+        return any(runtime.scheduler.cancel(request_id, reason) for runtime in self.all_runtimes())
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "default": self.default_id,
+                "resident": [runtime.snapshot() for runtime in self.runtimes.values()],
+                "retiring": [runtime.model_id for runtime in self.retiring],
+                "loading": dict(self.loading),
+                "memory_budget_gb": round(self.memory_budget_bytes / (1024**3), 2) if self.memory_budget_bytes else None
+            }
+
+# Se publica en bootstrap() cuando el modelo por defecto está cargado y caliente;
+# los pesos solo se referencian desde el registro, para poder liberarlos
+model_registry: Optional[ModelRegistry] = None
+
+def require_registry() -> ModelRegistry:
+    """Registro de modelos, o 503 mientras el servidor sigue arrancando"""
+    if model_registry is None:
+        raise HTTPException(
+            status_code=503,
+            detail=f"Servidor arrancando (etapa: {server_readiness.stage})",
+            headers={"Retry-After": "30"}
+        )
+    return model_registry
+
+# ==============================================================================
+# === CACHÉ SEMÁNTICA DE RESPUESTAS ===========================================
+# ==============================================================================
+
+class SemanticResponseCache:
+    """
+    Caché de respuestas para preguntas casi idénticas (saludos, preguntas frecuentes).
+
+    Indexa el embedding del último mensaje del usuario (normalizado) junto con el rol
+    en un índice FAISS de producto interno; con embeddings normalizados equivale a la
+    similitud coseno. Un acierto por encima del umbral devuelve la respuesta guardada
+    sin pasar por el modelo. Las entradas caducan por TTL y se expulsan por LRU.
+    """
+
+    def __init__(self, embedder, threshold: float, ttl_s: float, max_entries: int, max_user_turns: int):
+        self.embedder = embedder
+        self.threshold = threshold
+        self.ttl_s = ttl_s
+        self.max_entries = max(1, max_entries)
+        self.max_user_turns = max(1, max_user_turns)
+
+        import faiss
+
+        self.dimension = embedder.get_sentence_embedding_dimension()
+        self.index = faiss.IndexIDMap2(faiss.IndexFlatIP(self.dimension))
+        self.entries: "collections.OrderedDict[int, Dict[str, Any]]" = collections.OrderedDict()
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "bypassed": 0, "stores": 0, "evictions": 0, "expired": 0}
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        """Normaliza el texto para que variaciones triviales compartan entrada"""
+        text = re.sub(r"\s+", " ", text.lower()).strip()
+        return text.strip(" ¿?¡!.,;:")
+
+    def query_text(self, messages: List[Message]) -> Optional[str]:
+        """Último mensaje del usuario normalizado, o None si la conversación no es cacheable"""
+        user_messages = [m.content for m in messages if m.role == "user"]
+        if not user_messages or len(user_messages) > self.max_user_turns:
+            return None
+        text = self.normalize(user_messages[-1])
+        return text or None
+
+    def _embed(self, role: str, text: str) -> np.ndarray:
+        embedding = self.embedder.encode(
+            [f"{role}: {text}"],
+            normalize_embeddings=True,
+            convert_to_numpy=True,
+            show_progress_bar=False
+        )
+        return np.asarray(embedding, dtype="float32")
+
+    def lookup(self, messages: List[Message], role: str) -> Optional[Dict[str, Any]]:
+        """Devuelve la entrada cacheada más similar por encima del umbral, o None"""
+        text = self.query_text(messages)
+        if text is None:
+            return None
+
+        embedding = self._embed(role, text)
+        now = time.time()
+
+        with self._lock:
+            if self.index.ntotal > 0:
+                scores, ids = self.index.search(embedding, min(4, self.index.ntotal))
+                for score, entry_id in zip(scores[0], ids[0]):
+                    entry = self.entries.get(int(entry_id))
+                    if entry is None or score < self.threshold:
+                        continue
+                    if now - entry["created_at"] > self.ttl_s:
+                        self._remove(int(entry_id))
+                        self.stats["expired"] += 1
+                        continue
+                    if entry["role"] != role:
+                        continue
+
+                    self.entries.move_to_end(int(entry_id))
+                    self.stats["hits"] += 1
+                    return {**entry, "similarity": float(score)}
+
+            self.stats["misses"] += 1
+            return None
+
+    def store(self, messages: List[Message], role: str, content: str, usage: Dict[str, int]):
+        """Guarda una respuesta generada para la pregunta del usuario"""
+        text = self.query_text(messages)
+        if text is None or not content:
+            return
+
+        embedding = self._embed(role, text)
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self.index.add_with_ids(embedding, np.array([entry_id], dtype="int64"))
+            self.entries[entry_id] = {
+                "role": role,
+                "query": text,
+                "content": content,
+                "usage": usage,
+                "created_at": time.time()
+            }
+            self.stats["stores"] += 1
+
+            while len(self.entries) > self.max_entries:
+                self._remove(next(iter(self.entries)))
+                self.stats["evictions"] += 1
+
+    def _remove(self, entry_id: int):
+        self.entries.pop(entry_id, None)
+        self.index.remove_ids(np.array([entry_id], dtype="int64"))
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Estado de la caché para /health"""
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            "enabled": True,
+            "entries": len(self.entries),
+            "hit_rate": round(self.stats["hits"] / lookups, 4) if lookups else 0.0,
+            **self.stats
+        }
+
+# Se construye en el arranque de fondo, cuando el modelo ya está listo
+semantic_cache: Optional[SemanticResponseCache] = None
+
+_embedders: Dict[str, Any] = {}
+_embedders_lock = threading.Lock()
+
+def load_embedder(model_name: str):
+    """Modelo de embeddings en CPU, compartido entre la caché semántica y el RAG"""
+    with _embedders_lock:
+        if model_name not in _embedders:
+            from sentence_transformers import SentenceTransformer
+            _embedders[model_name] = SentenceTransformer(model_name, device="cpu")
+        return _embedders[model_name]
+
+def build_semantic_cache():
+    """Carga el modelo de embeddings (y FAISS) y activa la caché semántica"""
+    global semantic_cache
+    try:
+        logger.info(f"--> Cargando embeddings para la caché semántica: {SEMANTIC_CACHE_MODEL}")
+        semantic_cache = SemanticResponseCache(
+            load_embedder(SEMANTIC_CACHE_MODEL),
+            threshold=SEMANTIC_CACHE_THRESHOLD,
+            ttl_s=SEMANTIC_CACHE_TTL_S,
+            max_entries=SEMANTIC_CACHE_MAX_ENTRIES,
+            max_user_turns=SEMANTIC_CACHE_MAX_USER_TURNS
+        )
+        logger.info(f"✅ Caché semántica activa (umbral {SEMANTIC_CACHE_THRESHOLD})")
+    except Exception as e:
+        logger.warning(f"⚠️  Caché semántica desactivada: {e}")
+
+# ==============================================================================
+# === CONOCIMIENTO: RAG SOBRE TRIPLETAS =======================================
+# ==============================================================================
+
+# Ventana de las tripletas de contexto, igual que SearchKnowledge en la BD
+CONTEXT_TRIPLET_MAX_AGE_S = 7 * 24 * 3600
+
+def _parse_timestamp(value: Any) -> Optional[float]:
+    """Fecha de MariaDB/SQLite ('YYYY-MM-DD HH:MM:SS'), ISO o epoch a epoch; None si vacía"""
+    if value in (None, "", 0):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    text = str(value).strip().replace("T", " ").rstrip("Z").split(".")[0]
+    if text.isdigit():
+        return float(text)
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d"):
+        try:
+            return time.mktime(time.strptime(text, fmt))
+        except ValueError:
+            continue
+    return None
+
+def format_knowledge(triplets: List[Dict[str, Any]]) -> str:
+    """Bloque de conocimiento que precede al último turno del usuario"""
+    lines = []
+    for triplet in triplets:
+        line = f"- {triplet['subject']} {triplet['predicate']} {triplet['object']}"
+        if triplet.get("description"):
+            line += f" ({triplet['description']})"
+        lines.append(line)
+    return "**Conocimiento relevante:**\n" + "\n".join(lines)
+
+class KnowledgeIndex:
+    """
+    Tripletas de conocimiento indexadas por embedding para inyectarlas en el prompt.
+
+    Las globales van a un índice FAISS de producto interno (embeddings normalizados
+    = coseno): plano mientras es pequeño y IVF a partir de `ivf_threshold`, que se
+    reentrena desde los vectores guardados cuando el índice se cuadruplica. IVF y no
+    HNSW porque las tripletas se editan y borran, y HNSW no admite borrados.
+    Las de contexto son pocas por chat (max_chat_context_triplets) y se comparan
+    por fuerza bruta dentro del chat de la solicitud.
+
+    Las actualizaciones son incrementales: solo se recalcula el embedding de las
+    tripletas nuevas o cuyo texto cambió; cada cambio sube `version`. La búsqueda
+    tiene un presupuesto de latencia; si se agota, o si ya hay tantas búsquedas en
+    cola como hilos, la solicitud sigue sin conocimiento.
+    """
+
+    def __init__(self, embedder, top_k: int, min_score: float, timeout_s: float, ivf_threshold: int):
+        import faiss
+
+        self.faiss = faiss
+        self.embedder = embedder
+        self.top_k = max(1, top_k)
+        self.min_score = min_score
+        self.timeout_s = timeout_s
+        self.ivf_threshold = max(1024, ivf_threshold)
+        self.dimension = embedder.get_sentence_embedding_dimension()
+
+        self.global_triplets: Dict[int, Dict[str, Any]] = {}
+        self.global_vectors: Dict[int, np.ndarray] = {}
+        self.context_triplets: Dict[int, Dict[str, Any]] = {}
+        self.context_vectors: Dict[str, Dict[int, np.ndarray]] = {}
+        self._hashes: Dict[Tuple[str, int], str] = {}
+
+        self.index = self._flat_index()
+        self.index_kind = "flat"
+        self._trained_size = 0
+        self._lock = threading.RLock()
+        self._query_cache: "collections.OrderedDict[str, np.ndarray]" = collections.OrderedDict()
+        # Hilos propios: una búsqueda lenta no ocupa el pool de CPU de los prompts
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="foxia-rag")
+        self._max_pending = 4  # Búsquedas en curso + en espera
+        self._pending = 0
+        self.version = 0
+        self.cursor: Any = None
+        self.refreshed_at: Optional[float] = None
+        self.stats = {"queries": 0, "hits": 0, "empty": 0, "timeouts": 0, "errors": 0, "busy": 0,
+                      "upserts": 0, "deletes": 0, "embedded": 0, "rebuilds": 0}
+
+    # --- Índice -------------------------------------------------------------
+
+    def _flat_index(self):
+        return self.faiss.IndexIDMap2(self.faiss.IndexFlatIP(self.dimension))
+
+    def _ivf_index(self, ids: np.ndarray, vectors: np.ndarray):
+        """IVF entrenado con los vectores actuales (~4·sqrt(n) listas, >= 39 puntos por lista)"""
+        nlist = max(16, min(int(4 * math.sqrt(len(ids))), len(ids) // 39))
+        quantizer = self.faiss.IndexFlatIP(self.dimension)
+        index = self.faiss.IndexIVFFlat(quantizer, self.dimension, nlist, self.faiss.METRIC_INNER_PRODUCT)
+        index.train(vectors)
+        index.nprobe = max(1, nlist // 8)
+        return index
+
+    def _maybe_rebuild(self):
+        """Pasa a IVF (o vuelve a plano) según el tamaño; reentrena si creció mucho"""
+        count = len(self.global_vectors)
+        if self.index_kind == "flat" and count < self.ivf_threshold:
+            return
+        if self.index_kind == "ivf" and count >= self.ivf_threshold // 2 and count < 4 * self._trained_size:
+            return
+
+        ids = np.fromiter(self.global_vectors.keys(), dtype="int64", count=count)
+        vectors = np.stack(list(self.global_vectors.values())) if count else np.zeros((0, self.dimension), dtype="float32")
+        if count >= self.ivf_threshold:
+            index, kind = self._ivf_index(ids, vectors), "ivf"
+            self._trained_size = count
+        else:
+            index, kind = self._flat_index(), "flat"
+            self._trained_size = 0
+        if count:
+            index.add_with_ids(vectors, ids)
+        self.index, self.index_kind = index, kind
+        self.stats["rebuilds"] += 1
+        logger.info(f"📚 Índice de conocimiento reconstruido: {kind} con {count} tripletas")
+
+    # --- Actualización ------------------------------------------------------
+
+    @staticmethod
+    def triplet_text(triplet: Dict[str, Any]) -> str:
+        """Texto que se embebe: la tripleta como frase, más su descripción"""
+        text = f"{triplet['subject']} {triplet['predicate']} {triplet['object']}"
+        if triplet.get("description"):
+            text += f". {triplet['description']}"
+        return text
+
+    def _embed(self, texts: List[str]) -> np.ndarray:
+        embeddings = self.embedder.encode(
+            texts,
+            batch_size=64,
+            normalize_embeddings=True,
+            convert_to_numpy=True,
+            show_progress_bar=False
+        )
+        return np.asarray(embeddings, dtype="float32").reshape(len(texts), self.dimension)
+
+    def _normalize(self, row: Dict[str, Any], source: str) -> Optional[Dict[str, Any]]:
+        """Fila del feed (columnas de la BD) a tripleta interna; None si está inactiva"""
+        if source == "global" and str(row.get("is_active", 1)).lower() in ("0", "false"):
+            return None
+        triplet = {
+            "source": source,
+            "id": int(row["id"]),
+            "subject": str(row["subject"]),
+            "predicate": str(row["predicate"]),
+            "object": str(row["object"]),
+            "description": row.get("description") if source == "global" else None,
+            "category": row.get("category") if source == "global" else None,
+        }
+        if source == "context":
+            triplet["chat_id"] = str(row["chat_id"])
+            triplet["confidence"] = float(row.get("confidence_score") or 1.0)
+            triplet["created_at"] = _parse_timestamp(row.get("created_at")) or time.time()
+            triplet["expires_at"] = _parse_timestamp(row.get("expires_at"))
+        return triplet
+
+    def _remove(self, source: str, triplet_id: int):
+        self._hashes.pop((source, triplet_id), None)
+        if source == "global":
+            if self.global_triplets.pop(triplet_id, None) is not None:
+                self.global_vectors.pop(triplet_id, None)
+                self.index.remove_ids(np.array([triplet_id], dtype="int64"))
+                self.stats["deletes"] += 1
+        else:
+            triplet = self.context_triplets.pop(triplet_id, None)
+            if triplet is not None:
+                chat = self.context_vectors.get(triplet["chat_id"], {})
+                chat.pop(triplet_id, None)
+                if not chat:
+                    self.context_vectors.pop(triplet["chat_id"], None)
+                self.stats["deletes"] += 1
+
+    def apply(self, batch: Dict[str, Any]) -> Dict[str, int]:
+        """
+        Aplica un lote del feed:
+        {"global": [...], "context": [...], "deleted": {"global": [ids], "context": [ids]},
+         "full": bool, "cursor": ...}
+        Con "full" el lote es una instantánea completa: lo que no venga se borra.
+        """
+        pending: List[Tuple[str, Dict[str, Any], str]] = []
+        inactive: List[Tuple[str, int]] = []
+        seen = {"global": set(), "context": set()}
+
+        for source in ("global", "context"):
+            for row in batch.get(source) or []:
+                triplet = self._normalize(row, source)
+                if triplet is None:
+                    inactive.append((source, int(row["id"])))
+                    continue
+                seen[source].add(triplet["id"])
+                text = self.triplet_text(triplet)
+                digest = hashlib.sha1(text.encode("utf-8")).hexdigest()
+                if self._hashes.get((source, triplet["id"])) == digest:
+                    # Mismo texto: se actualizan los metadatos sin recalcular el embedding
+                    with self._lock:
+                        if source == "global":
+                            self.global_triplets[triplet["id"]] = triplet
+                        else:
+                            self.context_triplets[triplet["id"]] = triplet
+                    continue
+                pending.append((source, triplet, digest))
+
+        # El embedding (lo caro) fuera del lock: las búsquedas siguen atendiéndose
+        vectors = self._embed([self.triplet_text(t) for _, t, _ in pending]) if pending else None
+
+        deleted = batch.get("deleted") or {}
+        with self._lock:
+            for source, triplet_id in inactive:
+                self._remove(source, triplet_id)
+            for source in ("global", "context"):
+                for triplet_id in deleted.get(source) or []:
+                    self._remove(source, int(triplet_id))
+
+            if batch.get("full"):
+                for triplet_id in [i for i in self.global_triplets if i not in seen["global"]]:
+                    self._remove("global", triplet_id)
+                for triplet_id in [i for i in self.context_triplets if i not in seen["context"]]:
+                    self._remove("context", triplet_id)
+
+            for (source, triplet, digest), vector in zip(pending, vectors if vectors is not None else []):
+                triplet_id = triplet["id"]
+                self._remove(source, triplet_id)
+                if source == "global":
+                    self.global_triplets[triplet_id] = triplet
+                    self.global_vectors[triplet_id] = vector
+                    self.index.add_with_ids(vector[None, :], np.array([triplet_id], dtype="int64"))
+                else:
+                    self.context_triplets[triplet_id] = triplet
+                    self.context_vectors.setdefault(triplet["chat_id"], {})[triplet_id] = vector
+                self._hashes[(source, triplet_id)] = digest
+                self.stats["upserts"] += 1
+            self.stats["embedded"] += len(pending)
+
+            self._maybe_rebuild()
+            if pending or inactive or any(deleted.values()) or batch.get("full"):
+                self.version += 1
+            if "cursor" in batch:
+                self.cursor = batch["cursor"]
+            self.refreshed_at = time.time()
+
+        return {"embedded": len(pending), "global": len(self.global_triplets), "context": len(self.context_triplets)}
+
+    # --- Búsqueda -----------------------------------------------------------
+
+    def _query_vector(self, query: str) -> np.ndarray:
+        key = re.sub(r"\s+", " ", query.lower()).strip()
+        with self._lock:
+            cached = self._query_cache.get(key)
+            if cached is not None:
+                self._query_cache.move_to_end(key)
+                return cached
+        vector = self._embed([key])[0]
+        with self._lock:
+            self._query_cache[key] = vector
+            while len(self._query_cache) > 1024:
+                self._query_cache.popitem(last=False)
+        return vector
+
+    def search(self, query: str, chat_id: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Top-k tripletas (globales + de contexto del chat) por encima del umbral"""
+        vector = self._query_vector(query)
+        results: List[Tuple[float, Dict[str, Any]]] = []
+
+        with self._lock:
+            if self.index.ntotal > 0:
+                scores, ids = self.index.search(vector[None, :], min(self.top_k, self.index.ntotal))
+                for score, triplet_id in zip(scores[0], ids[0]):
+                    triplet = self.global_triplets.get(int(triplet_id))
+                    if triplet is not None and score >= self.min_score:
+                        results.append((float(score), triplet))
+
+            chat = self.context_vectors.get(str(chat_id)) if chat_id is not None else None
+            if chat:
+                now = time.time()
+                ids = list(chat.keys())
+                scores = np.stack([chat[i] for i in ids]) @ vector
+                for triplet_id, score in zip(ids, scores):
+                    triplet = self.context_triplets[triplet_id]
+                    if score < self.min_score or now - triplet["created_at"] > CONTEXT_TRIPLET_MAX_AGE_S:
+                        continue
+                    if triplet["expires_at"] is not None and triplet["expires_at"] <= now:
+                        continue
+                    # La confianza de la extracción pondera el parecido
+                    results.append((float(score) * triplet["confidence"], triplet))
+
+        results.sort(key=lambda item: item[0], reverse=True)
+        return [triplet for _, triplet in results[:self.top_k]]
+
+    def _search_done(self, future):
+        with self._lock:
+            self._pending -= 1
+
+    def retrieve(self, query: str, chat_id: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Búsqueda con presupuesto de latencia; ante timeout, saturación o error devuelve []"""
+        start = time.perf_counter()
+        outcome, triplets = "hit", []
+        with self._lock:
+            busy = self._pending >= self._max_pending
+            if not busy:
+                self._pending += 1
+        if busy:
+            # Encolar más solo haría que todas las búsquedas agotaran su presupuesto
+            outcome = "busy"
+        else:
+            future = self._executor.submit(self.search, query, chat_id)
+            future.add_done_callback(self._search_done)
+            try:
+                triplets = future.result(timeout=self.timeout_s)
+                if not triplets:
+                    outcome = "empty"
+            except FutureTimeout:
+                # Si aún no empezó se descarta; si ya corre, termina y calienta la caché de la consulta
+                future.cancel()
+                outcome = "timeout"
+            except Exception as e:
+                outcome = "error"
+                logger.warning(f"⚠️  Error recuperando conocimiento: {e}")
+
+        self.stats["queries"] += 1
+        self.stats[{"hit": "hits", "empty": "empty", "timeout": "timeouts", "error": "errors", "busy": "busy"}[outcome]] += 1
+        metrics.rag_retrieval.observe(time.perf_counter() - start)
+        metrics.rag_queries.inc(outcome)
+        return triplets
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Estado del índice para /health"""
+        return {
+            "enabled": True,
+            "index": self.index_kind,
+            "version": self.version,
+            "global_triplets": len(self.global_triplets),
+            "context_triplets": len(self.context_triplets),
+            "chats": len(self.context_vectors),
+            "cursor": self.cursor,
+            "refreshed_at": self.refreshed_at,
+            **self.stats
+        }
+
+class JsonTripletSource:
+    """
+    Instantánea en un fichero JSON con las tablas exportadas:
+    {"global_knowledge_triplets": [...], "chat_context_triplets": [...]}.
+    Se relee solo cuando cambia su fecha de modificación.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._mtime: Optional[float] = None
+
+    def fetch(self, cursor: Any) -> Optional[Dict[str, Any]]:
+        mtime = os.path.getmtime(self.path)
+        if mtime == self._mtime:
+            return None
+        with open(self.path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        self._mtime = mtime
+        return {
+            "global": data.get("global_knowledge_triplets", data.get("global", [])),
+            "context": data.get("chat_context_triplets", data.get("context", [])),
+            "full": True,
+            "cursor": mtime
+        }
+
+class SqliteTripletSource:
+    """
+    Base SQLite con las mismas tablas que MariaDB (para pruebas y nodos sin BD).
+    Incremental: globales por updated_at y de contexto por id (solo se insertan);
+    los borrados se detectan comparando ids.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def fetch(self, cursor: Any) -> Optional[Dict[str, Any]]:
+        cursor = dict(cursor or {})
+        since_updated = cursor.get("global_updated_at") or ""
+        since_context = int(cursor.get("context_id") or 0)
+
+        connection = sqlite3.connect(self.path)
+        connection.row_factory = sqlite3.Row
+        try:
+            global_rows = [dict(row) for row in connection.execute(
+                "SELECT id, subject, predicate, object, category, description, is_active, updated_at "
+                "FROM global_knowledge_triplets WHERE COALESCE(updated_at, '') > ? ORDER BY updated_at",
+                (since_updated,)
+            )]
+            context_rows = [dict(row) for row in connection.execute(
+                "SELECT id, chat_id, subject, predicate, object, confidence_score, created_at, expires_at "
+                "FROM chat_context_triplets WHERE id > ? ORDER BY id",
+                (since_context,)
+            )]
+            global_ids = {row[0] for row in connection.execute("SELECT id FROM global_knowledge_triplets")}
+            context_ids = {row[0] for row in connection.execute("SELECT id FROM chat_context_triplets")}
+        finally:
+            connection.close()
+
+        if global_rows:
+            cursor["global_updated_at"] = max(str(row["updated_at"] or "") for row in global_rows)
+        if context_rows:
+            cursor["context_id"] = max(row["id"] for row in context_rows)
+        return {
+            "global": global_rows,
+            "context": context_rows,
+            "present": {"global": global_ids, "context": context_ids},
+            "cursor": cursor
+        }
+
+class FeedTripletSource:
+    """
+    Endpoint de exportación del servidor central: GET <url>?since=<cursor> devuelve
+    {"global": [...], "context": [...], "deleted": {...}, "cursor": ..., "full": bool}.
+    """
+
+    def __init__(self, url: str):
+        self.url = url
+
+    def fetch(self, cursor: Any) -> Optional[Dict[str, Any]]:
+        params = {"since": json.dumps(cursor)} if cursor is not None else {}
+        response = requests.get(self.url, params=params, headers={"x-api-key": API_KEY}, timeout=30, verify=False)
+        response.raise_for_status()
+        return response.json()
+
+def triplet_source(location: str):
+    """Elige el origen según la configuración: URL, .json o base SQLite"""
+    if location.startswith(("http://", "https://")):
+        return FeedTripletSource(location)
+    if location.endswith(".json"):
+        return JsonTripletSource(location)
+    return SqliteTripletSource(location)
+
+# Se construye en el arranque de fondo, cuando el modelo ya está listo
+knowledge_base: Optional[KnowledgeIndex] = None
+
+def refresh_knowledge(index: KnowledgeIndex, source) -> bool:
+    """Trae los cambios del origen y los aplica; True si había algo nuevo"""
+    batch = source.fetch(index.cursor)
+    if not batch:
+        return False
+    present = batch.pop("present", None)
+    if present is not None:
+        # Borrados de un origen incremental: lo indexado que ya no existe
+        with index._lock:
+            batch["deleted"] = {
+                "global": [i for i in index.global_triplets if i not in present["global"]],
+                "context": [i for i in index.context_triplets if i not in present["context"]]
+            }
+    if not (batch.get("global") or batch.get("context") or batch.get("full")
+            or any((batch.get("deleted") or {}).values())):
+        index.cursor = batch.get("cursor", index.cursor)
+        return False
+    result = index.apply(batch)
+    logger.info(f"📚 Conocimiento actualizado: {result['embedded']} embeddings nuevos, "
+                f"{result['global']} globales, {result['context']} de contexto")
+    return True
+
+def knowledge_refresh_loop(index: KnowledgeIndex, source):
+    """Hilo de refresco periódico del índice de conocimiento"""
+    while True:
+        time.sleep(RAG_REFRESH_S)
+        try:
+            refresh_knowledge(index, source)
+        except Exception as e:
+            logger.warning(f"⚠️  Refresco de conocimiento fallido: {e}")
+
+def build_knowledge_base():
+    """Carga los embeddings, indexa el origen configurado y lanza el refresco"""
+    global knowledge_base
+    try:
+        logger.info(f"--> Cargando embeddings para el conocimiento: {RAG_EMBEDDING_MODEL}")
+        index = KnowledgeIndex(
+            load_embedder(RAG_EMBEDDING_MODEL),
+            top_k=RAG_TOP_K,
+            min_score=RAG_MIN_SCORE,
+            timeout_s=RAG_TIMEOUT_MS / 1000,
+            ivf_threshold=RAG_IVF_THRESHOLD
+        )
+        if RAG_SOURCE:
+            source = triplet_source(RAG_SOURCE)
+            refresh_knowledge(index, source)
+            Thread(target=knowledge_refresh_loop, args=(index, source), daemon=True, name="foxia-rag-refresh").start()
+        knowledge_base = index
+        logger.info(f"✅ RAG activo: {len(index.global_triplets)} tripletas globales "
+                    f"({RAG_SOURCE or 'solo push en /v1/knowledge'})")
+    except Exception as e:
+        logger.warning(f"⚠️  RAG desactivado: {e}")
+
+# ==============================================================================
+# === CACHÉ EXACTA DE RESPUESTAS DETERMINISTAS ================================
+# ==============================================================================
+
+class ExactResponseCache:
+    """
+    Caché direccionada por contenido para solicitudes deterministas.
+
+    Con temperature 0 (greedy) o con seed fija, la respuesta depende solo del prompt
+    tokenizado y de los parámetros de generación, así que se indexa por el hash de
+    ambos. La memoria está acotada en bytes (LRU) y, opcionalmente, se persiste en un
+    SQLite local para sobrevivir a reinicios de Colab.
+    """
+
+    def __init__(self, max_bytes: int, path: Optional[str] = None, disk_max_bytes: int = 0):
+        self.max_bytes = max(0, max_bytes)
+        self.disk_max_bytes = max(0, disk_max_bytes)
+        self.entries: "collections.OrderedDict[str, Tuple[Dict[str, Any], int]]" = collections.OrderedDict()
+        self.total_bytes = 0
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self.stats = {"hits": 0, "disk_hits": 0, "misses": 0, "bypassed": 0, "stores": 0, "evictions": 0}
+
+        if path:
+            try:
+                self._db = sqlite3.connect(path, check_same_thread=False)
+                self._db.execute("PRAGMA journal_mode=WAL")
+                self._db.execute("PRAGMA synchronous=NORMAL")
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS responses ("
+                    "key TEXT PRIMARY KEY, payload TEXT NOT NULL, "
+                    "nbytes INTEGER NOT NULL, last_used REAL NOT NULL)"
+                )
+                self._db.commit()
+                logger.info(f"✅ Caché exacta persistente en {path}")
+            except sqlite3.Error as e:
+                logger.warning(f"⚠️  No se pudo abrir la caché exacta en disco ({path}): {e}")
+                self._db = None
+
+    @property
+    def persistent(self) -> bool:
+        return self._db is not None
+
+    @staticmethod
+    def is_deterministic(request: ChatCompletionRequest) -> bool:
+        return request.temperature == 0 or request.seed is not None
+
+    @staticmethod
+    def make_key(input_ids: List[int], request: ChatCompletionRequest, model_id: str = MODEL_ID) -> str:
+        """Hash del prompt tokenizado y de la configuración de generación"""
+        digest = hashlib.sha256(np.asarray(input_ids, dtype=np.int64).tobytes())
+        digest.update(json.dumps({
+            "model": model_id,
+            "max_tokens": request.max_tokens,
+            "temperature": request.temperature,
+            "top_p": request.top_p,
+            "repetition_penalty": request.repetition_penalty,
+            "seed": request.seed,
+            "reasoning_budget": request_reasoning_budget(request)
+        }, sort_keys=True).encode())
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Busca en memoria y, si no está, en disco"""
+        with self._lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return self.entries[key][0]
+
+            if self._db is not None:
+                row = self._db.execute("SELECT payload FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    self._db.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+                    self._db.commit()
+                    payload = json.loads(row[0])
+                    self._put_memory(key, payload, len(row[0]))
+                    self.stats["hits"] += 1
+                    self.stats["disk_hits"] += 1
+                    return payload
+
+            self.stats["misses"] += 1
+            return None
+
+    def put(self, key: str, payload: Dict[str, Any]):
+        """Guarda una respuesta en memoria y, si hay persistencia, en disco"""
+        serialized = json.dumps(payload)
+        with self._lock:
+            self._put_memory(key, payload, len(serialized))
+            self.stats["stores"] += 1
+
+            if self._db is not None:
+                try:
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO responses (key, payload, nbytes, last_used) VALUES (?, ?, ?, ?)",
+                        (key, serialized, len(serialized), time.time())
+                    )
+                    # Recortar el almacén en disco por antigüedad de uso
+                    disk_bytes = self._db.execute("SELECT COALESCE(SUM(nbytes), 0) FROM responses").fetchone()[0]
+                    while disk_bytes > self.disk_max_bytes:
+                        oldest = self._db.execute(
+                            "SELECT key, nbytes FROM responses ORDER BY last_used ASC LIMIT 1"
+                        ).fetchone()
+                        if oldest is None:
+                            break
+                        self._db.execute("DELETE FROM responses WHERE key = ?", (oldest[0],))
+                        disk_bytes -= oldest[1]
+                    self._db.commit()
+                except sqlite3.Error as e:
+                    logger.warning(f"⚠️  Error escribiendo la caché exacta en disco: {e}")
+
+    def _put_memory(self, key: str, payload: Dict[str, Any], nbytes: int):
+        if nbytes > self.max_bytes:
+            return
+        if key in self.entries:
+            self.total_bytes -= self.entries.pop(key)[1]
+
+        self.entries[key] = (payload, nbytes)
+        self.total_bytes += nbytes
+        while self.total_bytes > self.max_bytes:
+            _, (_, evicted_bytes) = self.entries.popitem(last=False)
+            self.total_bytes -= evicted_bytes
+            self.stats["evictions"] += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Estado de la caché para /health"""
+        return {
+            "entries": len(self.entries),
+            "memory_mb": round(self.total_bytes / (1024**2), 3),
+            "max_memory_mb": round(self.max_bytes / (1024**2), 2),
+            "persistent": self.persistent,
+            **self.stats
+        }
+
+exact_cache = ExactResponseCache(
+    max_bytes=int(EXACT_CACHE_MAX_MB * 1024**2),
+    path=EXACT_CACHE_PATH or None,
+    disk_max_bytes=int(EXACT_CACHE_DISK_MAX_MB * 1024**2)
+)
+
+# ==============================================================================
+# === ENDPOINTS PRINCIPALES ===================================================
+# ==============================================================================
+
+@app.get("/", response_model=StatusResponse)
+async def read_root():
+    """Endpoint de estado principal"""
+    return {
+        "status": "ok",
+        "message": "Fox-IA Server con 4-bit quantization está funcionando correctamente",
+        "version": "4.1-4bit"
+    }
+
+@app.get("/health")
+async def health_check():
+    """Health check completo del sistema (lee el muestreo de fondo, no bloquea)"""
+    system_summary = system_sampler.summary()
+    sample = system_summary.get("latest", {})
+
+    gpu_metrics = {"status": "GPU no detectada"}
+    if sample.get("vram_total_gb") is not None:
+        gpu_metrics = {
+            "status": "OK",
+            "vram_total_gb": sample["vram_total_gb"],
+            "vram_used_gb": sample["vram_used_gb"],
+            "vram_percent_used": sample["vram_percent"]
+        }
+    elif sample.get("gpu_error"):
+        gpu_metrics["error"] = sample["gpu_error"]
+
+    # Memoria del modelo (muestreada en segundo plano)
+    model_memory = "No disponible"
+    if sample.get("model_memory_gb") is not None:
+        model_memory = f"{sample['model_memory_gb']:.2f} GB"
+
+    system_metrics = {
+        "cpu_used": sample.get("cpu_percent"),
+        "ram_used": sample.get("ram_percent"),
+        "gpu": gpu_metrics,
+        "model_memory": model_memory,
+        "sampled_at": sample.get("timestamp"),
+        "windows": system_summary.get("windows", {})
+    }
+
+    # Todavía arrancando: el puerto ya responde, pero no hay modelo que servir
+    if model_registry is None:
+        return {
+            "status": "error" if server_readiness.error else "loading",
+            "readiness": server_readiness.snapshot(),
+            "system_metrics": system_metrics,
+            "model_loaded": False,
+            "startup": startup_profile.snapshot(),
+            "timestamp": time.time()
+        }
+
+    # Verificar quantization
+    quantization_status = "4-bit activado"
+    try:
+        default_model = model_registry.default().model
+        if hasattr(default_model, 'quantization_method'):
+            quantization_status = f"{default_model.quantization_method}"
+        else:
+            quantization_status = "No quantization"
+    except:
+        quantization_status = "Desconocido"
+
+    return {
+        "status": "healthy",
+        "readiness": server_readiness.snapshot(),
+        "system_metrics": system_metrics,
+        "model_loaded": model_registry.default().model is not None,
+        "quantization": quantization_status,
+        "scheduler": model_registry.default().scheduler.snapshot(),
+        "models": model_registry.snapshot(),
+        "startup": startup_profile.snapshot(),
+        "semantic_cache": semantic_cache.snapshot() if semantic_cache is not None else {"enabled": False},
+        "knowledge": knowledge_base.snapshot() if knowledge_base is not None else {"enabled": False},
+        "heartbeat": node_heartbeat.snapshot() if node_heartbeat is not None else {"enabled": False},
+        "worker": job_worker.snapshot() if job_worker is not None else {"enabled": False},
+        "chat_stream": chat_event_publisher.snapshot() if chat_event_publisher is not None else {"enabled": False},
+        "exact_cache": exact_cache.snapshot(),
+        "timestamp": time.time()
+    }
+
+@app.get("/ready")
+async def readiness_check():
+    """200 cuando el modelo por defecto está cargado y caliente; 503 mientras arranca"""
+    return JSONResponse(status_code=200 if server_readiness.ready else 503, content=server_readiness.snapshot())
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Métricas en formato de exposición de Prometheus"""
+    lines = metrics.render()
+
+    # Sumar el estado de los planificadores de todos los modelos residentes
+    runtimes = model_registry.all_runtimes() if model_registry is not None else []
+    scheduler_states = [runtime.scheduler.snapshot() for runtime in runtimes]
+    scheduler_state = {
+        key: sum(state[key] for state in scheduler_states)
+        for key in (
+            "active_sequences", "waiting_requests", "tokens_per_second_10s", "requests_completed",
+            "requests_failed", "requests_cancelled", "prefill_tokens", "prefill_tokens_saved", "tokens_generated"
+        )
+    }
+    gauges = {
+        "foxia_active_sequences": ("Secuencias en el batch de decodificación", scheduler_state["active_sequences"]),
+        "foxia_waiting_requests": ("Solicitudes en cola de admisión", scheduler_state["waiting_requests"]),
+        "foxia_tokens_per_second_10s": ("Tokens generados por segundo (ventana de 10s)", scheduler_state["tokens_per_second_10s"]),
+        "foxia_resident_models": ("Modelos cargados en memoria", len(scheduler_states)),
+        "foxia_ready": ("1 si el nodo terminó de arrancar", int(server_readiness.ready)),
+    }
+    sample = system_sampler.latest()
+    for key, help_text in (
+        ("cpu_percent", "Uso de CPU"),
+        ("ram_percent", "Uso de RAM"),
+        ("vram_used_gb", "VRAM usada (GB)"),
+        ("vram_percent", "Uso de VRAM")
+    ):
+        if sample.get(key) is not None:
+            gauges[f"foxia_system_{key}"] = (help_text, sample[key])
+
+    for name, (help_text, value) in gauges.items():
+        lines.extend([f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {value}"])
+
+    for key in ("requests_completed", "requests_failed", "requests_cancelled", "prefill_tokens", "prefill_tokens_saved", "tokens_generated"):
+        name = f"foxia_scheduler_{key}_total"
+        lines.extend([f"# TYPE {name} counter", f"{name} {scheduler_state[key]}"])
+
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
+@app.post("/v1/chat/completions")
+async def create_chat_completion(
+    request: ChatCompletionRequest,
+    http_request: Request,
+    api_key: str = Depends(verify_api_key),
+    request_id: Optional[str] = Header(None, alias="x-request-id")
+):
+    """Endpoint profesional de chat completions con streaming"""
+
+    if request.stream and request.n and request.n > 1:
+        raise HTTPException(status_code=400, detail="n>1 solo está disponible sin streaming")
+
+    if request.stream:
+        return await handle_streaming_request(request, http_request, request_id)
+    else:
+        return await handle_standard_request(request, http_request, request_id)
+
+# Pool acotado para el trabajo de CPU de las solicitudes (tokenización, embeddings, SQLite):
+# la generación ya corre en el hilo del planificador, esto mantiene libre el event loop
+cpu_executor = ThreadPoolExecutor(max_workers=max(1, CPU_WORKERS), thread_name_prefix="foxia-cpu")
+
+async def run_cpu(func, *args, **kwargs):
+    """Ejecuta una función bloqueante en el pool de CPU sin bloquear el event loop"""
+    return await asyncio.get_running_loop().run_in_executor(cpu_executor, functools.partial(func, *args, **kwargs))
+
+def overloaded_error(error: SchedulerQueueFull) -> HTTPException:
+    """503 (nodo saturado) o 429 (límite del chat) con Retry-After para reintentar"""
+    return HTTPException(
+        status_code=429 if isinstance(error, ClientLimitExceeded) else 503,
+        detail=str(error),
+        headers={"Retry-After": str(error.retry_after)}
+    )
+
+def request_reasoning_budget(request: ChatCompletionRequest) -> int:
+    """Presupuesto de tokens de razonamiento: el de la solicitud o el del nodo, recortado a max_tokens (0 = sin límite)"""
+    budget = REASONING_BUDGET if request.reasoning_budget is None else request.reasoning_budget
+    return effective_reasoning_budget(budget, request.max_tokens or MAX_NEW_TOKENS)
+
+def request_priority(request: ChatCompletionRequest) -> str:
+    """Clase de prioridad: la indicada o, por defecto, interactiva"""
+    return request.priority or "interactive"
+
+def resolve_runtime(model_id: Optional[str]) -> ModelRuntime:
+    """
+    Modelo que atiende la solicitud: 404 si no existe, 503 si se está cargando.
+    Vuelve reservado: el llamador hace runtime.unreserve() cuando ha encolado la
+    generación (o ha terminado sin ella, p. ej. por un acierto de caché).
+    """
+    try:
+        return require_registry().resolve(model_id, reserve=True)
+    except ModelNotAvailable as e:
+        if e.loading:
+            raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "30"})
+        raise HTTPException(status_code=404, detail=str(e))
+
+async def prepare_input_ids(request: ChatCompletionRequest, runtime: ModelRuntime) -> List[int]:
+    """Admisión rápida y construcción del prompt en el pool de CPU"""
+    try:
+        runtime.scheduler.check_admission()
+        input_ids, _ = await run_cpu(runtime.engine.build_prompt, request.messages, request.max_tokens, chat_id=request.chat_id)
+    except SchedulerQueueFull as e:
+        raise overloaded_error(e)
+    except PromptTooLong as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return input_ids
+
+def new_generation_request(
+    request: ChatCompletionRequest,
+    input_ids: List[int],
+    labels: Tuple[str, str],
+    request_id: Optional[str] = None,
+    streamer=None,
+    seed: Optional[int] = None,
+    priority: Optional[str] = None,
+    user: Optional[str] = None
+) -> GenerationRequest:
+    """GenerationRequest con los parámetros de muestreo de la solicitud HTTP"""
+    return GenerationRequest(
+        input_ids,
+        max_new_tokens=request.max_tokens,
+        temperature=request.temperature,
+        top_p=request.top_p,
+        repetition_penalty=request.repetition_penalty,
+        streamer=streamer,
+        request_id=request_id,
+        timeout_s=REQUEST_TIMEOUT_S,
+        seed=request.seed if seed is None else seed,
+        metric_labels=labels,
+        priority=priority or request_priority(request),
+        user=user if user is not None else request.user,
+        reasoning_budget=request_reasoning_budget(request),
+        hide_reasoning=not (STREAM_REASONING if request.include_reasoning is None else request.include_reasoning)
+    )
+
+def completion_tokens_details(generation_requests: List[GenerationRequest]) -> Dict[str, Any]:
+    """Tokens de razonamiento (<think>) frente a tokens de respuesta"""
+    reasoning = sum(r.reasoning_tokens for r in generation_requests)
+    details = {
+        "reasoning_tokens": reasoning,
+        "answer_tokens": sum(len(r.output_ids) for r in generation_requests) - reasoning
+    }
+    if any(r.reasoning_truncated for r in generation_requests):
+        details["reasoning_truncated"] = True
+    return details
+
+def completion_usage(input_ids: List[int], generation_request: GenerationRequest) -> Dict[str, Any]:
+    """Uso de tokens de una generación terminada"""
+    prompt_tokens = len(input_ids)
+    completion_tokens = len(generation_request.output_ids)
+    usage = {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+        "prompt_tokens_details": {"cached_tokens": generation_request.cached_tokens},
+        "completion_tokens_details": completion_tokens_details([generation_request])
+    }
+    speculative = generation_request.speculative_stats()
+    if speculative is not None:
+        usage["speculative"] = speculative
+    return usage
+
+def decode_completion(generation_request: GenerationRequest, runtime: ModelRuntime) -> str:
+    response_message = runtime.tokenizer.decode(generation_request.output_ids, skip_special_tokens=True)
+    return runtime.engine.clean_content(response_message)
+
+async def cancel_on_disconnect(http_request: Optional[Request], *generation_requests: GenerationRequest):
+    """Cancela las generaciones pendientes si el cliente HTTP cierra la conexión"""
+    if http_request is None:
+        return
+    while not all(request.done.is_set() for request in generation_requests):
+        if await http_request.is_disconnected():
+            for request in generation_requests:
+                if not request.done.is_set():
+                    model_registry.cancel(request.request_id, "client_disconnected")
+            return
+        await asyncio.sleep(1.0)
+
+async def wait_group(http_request: Optional[Request], group: List[GenerationRequest], labels: Tuple[str, str], received_at: float):
+    """Espera a todas las generaciones de un grupo; los errores quedan en cada solicitud"""
+    disconnect_watcher = asyncio.create_task(cancel_on_disconnect(http_request, *group))
+    try:
+        await asyncio.gather(*(request.wait() for request in group), return_exceptions=True)
+    finally:
+        disconnect_watcher.cancel()
+        for request in group:
+            metrics.observe_generation(labels, request, received_at)
+
+def completion_choice(index: int, content: str, finish_reason: Optional[str]) -> Dict[str, Any]:
+    return {
+        "index": index,
+        "message": {
+            "role": "assistant",
+            "content": content
+        },
+        "finish_reason": finish_reason
+    }
+
+def build_completion_response(
+    request_id: str,
+    content: str,
+    finish_reason: Optional[str],
+    usage: Dict[str, Any],
+    cache: Optional[str] = None,
+    choices: Optional[List[Dict[str, Any]]] = None,
+    model_id: str = MODEL_ID
+) -> JSONResponse:
+    """Construye la respuesta chat.completion (no streaming)"""
+    response_data = {
+        "id": request_id,
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model_id,
+        "choices": choices or [completion_choice(0, content, finish_reason)],
+        "usage": usage
+    }
+    if cache:
+        response_data["cache"] = cache
+
+    return JSONResponse(content=response_data, headers={"X-Request-Id": request_id})
+
+def cached_event_stream(request_id: str, content: str, cache: str, model_id: str = MODEL_ID) -> EventSourceResponse:
+    """Devuelve por SSE una respuesta cacheada en un solo chunk"""
+    created = int(time.time())
+
+    async def event_generator():
+        for delta, finish_reason in (({"content": content}, None), ({}, "stop")):
+            event_data = {
+                "id": request_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model_id,
+                "cache": cache,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+            }
+            yield {"event": "message", "data": json.dumps(event_data)}
+        yield {"event": "complete", "data": "[DONE]"}
+
+    return EventSourceResponse(event_generator(), headers={"X-Request-Id": request_id})
+
+def semantic_cache_role(model_id: str) -> str:
+    """
+    Las entradas de la caché semántica se separan por rol, por modelo y por versión
+    del conocimiento: al cambiar las tripletas, las respuestas que se apoyaban en las
+    anteriores dejan de servirse.
+    """
+    role = DEFAULT_ROLE if model_id == MODEL_ID else f"{DEFAULT_ROLE} @ {model_id}"
+    if knowledge_base is not None:
+        role += f" #kb{knowledge_base.version}"
+    return role
+
+def semantic_cache_applies(request: ChatCompletionRequest) -> bool:
+    """
+    La caché semántica devuelve respuestas aproximadas: no sirve si el cliente pidió
+    una salida reproducible (seed o temperature 0), que ya cubre la caché exacta, ni
+    en chats con contexto propio (chat_id), cuyas tripletas cambian la respuesta.
+    """
+    return (
+        bool(request.cache)
+        and request.chat_id is None
+        and not ExactResponseCache.is_deterministic(request)
+    )
+
+async def lookup_semantic_cache(request: ChatCompletionRequest, model_id: str = MODEL_ID) -> Optional[Dict[str, Any]]:
+    """Consulta la caché semántica fuera del event loop (el embedding es CPU)"""
+    if semantic_cache is None:
+        return None
+    if not semantic_cache_applies(request):
+        semantic_cache.stats["bypassed"] += 1
+        return None
+    return await run_cpu(semantic_cache.lookup, request.messages, semantic_cache_role(model_id))
+
+def store_semantic_cache(request: ChatCompletionRequest, content: str, usage: Dict[str, Any], model_id: str = MODEL_ID):
+    """Guarda en segundo plano una respuesta completa en la caché semántica (devuelve el futuro)"""
+    if semantic_cache is None or not semantic_cache_applies(request):
+        return None
+    return asyncio.get_running_loop().run_in_executor(
+        cpu_executor, semantic_cache.store, request.messages, semantic_cache_role(model_id), content, usage
+    )
+
+async def lookup_exact_cache(
+    request: ChatCompletionRequest,
+    input_ids: List[int],
+    model_id: str = MODEL_ID
+) -> Tuple[Optional[str], Optional[Dict[str, Any]]]:
+    """Devuelve (clave, respuesta cacheada) para solicitudes deterministas; (None, None) si no aplica"""
+    if not exact_cache.is_deterministic(request):
+        return None, None
+    if not request.cache:
+        exact_cache.stats["bypassed"] += 1
+        return None, None
+
+    key = exact_cache.make_key(input_ids, request, model_id)
+    if exact_cache.persistent:
+        return key, await run_cpu(exact_cache.get, key)
+    return key, exact_cache.get(key)
+
+def store_exact_cache(key: Optional[str], generation_request: GenerationRequest, content: str, usage: Dict[str, Any]):
+    """Guarda una respuesta determinista terminada (stop o length) en la caché exacta"""
+    if key is None or generation_request.finish_reason not in ("stop", "length"):
+        return
+    payload = {"content": content, "finish_reason": generation_request.finish_reason, "usage": usage}
+    if exact_cache.persistent:
+        asyncio.get_running_loop().run_in_executor(cpu_executor, exact_cache.put, key, payload)
+    else:
+        exact_cache.put(key, payload)
+
+async def handle_streaming_request(
+    request: ChatCompletionRequest,
+    http_request: Optional[Request] = None,
+    request_id: Optional[str] = None
+):
+    """Maneja requests con streaming"""
+    received_at = time.time()
+    labels = metric_labels(http_request, stream=True)
+    runtime = resolve_runtime(request.model)
+    model_id = runtime.model_id
+
+    try:
+        # Caché semántica antes de construir el prompt: un acierto no paga RAG ni tokenización.
+        # No se solapa con la exacta (solo aplica a solicitudes no reproducibles)
+        cached = await lookup_semantic_cache(request, model_id)
+        if cached is not None:
+            metrics.cache_hits.inc(*labels, "semantic")
+            return cached_event_stream(request_id or f"chatcmpl-{uuid.uuid4()}", cached["content"], "semantic", model_id)
+
+        # Preparar inputs: system prompt + turnos recientes dentro del presupuesto de contexto
+        input_ids = await prepare_input_ids(request, runtime)
+        metrics.tokenization.observe(time.time() - received_at, *labels)
+
+        # Caché exacta: necesita el prompt tokenizado
+        exact_key, exact_hit = await lookup_exact_cache(request, input_ids, model_id)
+        if exact_hit is not None:
+            metrics.cache_hits.inc(*labels, "exact")
+            return cached_event_stream(request_id or f"chatcmpl-{uuid.uuid4()}", exact_hit["content"], "exact", model_id)
+
+        # Configurar streamer
+        streamer = AsyncTextStreamer(
+            runtime.tokenizer,
+            asyncio.get_running_loop(),
+            coalesce_ms=STREAM_COALESCE_MS,
+            coalesce_tokens=STREAM_COALESCE_TOKENS,
+            skip_special_tokens=True
+        )
+
+        # Encolar en el planificador: la generación se hace en el batch compartido
+        generation_request = new_generation_request(
+            request, input_ids, labels, request_id=request_id, streamer=streamer
+        )
+        try:
+            runtime.scheduler.submit(generation_request)
+        except SchedulerQueueFull as e:
+            raise overloaded_error(e)
+        except ValueError as e:
+            raise HTTPException(status_code=409, detail=str(e))
+    finally:
+        runtime.unreserve()
+
+    # El id y la cabecera del chunk son fijos durante todo el stream:
+    # por cada chunk solo se serializa el contenido
+    created = int(time.time())
+    chunk_prefix = (
+        f'{{"id": {json.dumps(generation_request.request_id)}, "object": "chat.completion.chunk", '
+        f'"created": {created}, "model": {json.dumps(model_id)}, '
+        f'"choices": [{{"index": 0, "delta": {{"content": '
+    )
+    chunk_suffix = '}, "finish_reason": null}]}'
+
+    # Generador de eventos SSE
+    async def event_generator():
+        try:
+            while True:
+                text = await streamer.queue.get()
+                if text is None:
+                    break
+                if not text.strip():
+                    continue
+
+                clean_text = runtime.engine.clean_content(text)
+                if clean_text:
+                    yield {"event": "message", "data": f"{chunk_prefix}{json.dumps(clean_text)}{chunk_suffix}"}
+        finally:
+            # Cliente desconectado: sse_starlette cancela este generador
+            if not generation_request.done.is_set():
+                runtime.scheduler.cancel(generation_request.request_id, "client_disconnected")
+            else:
+                metrics.observe_generation(labels, generation_request, received_at)
+
+        usage = None
+        if generation_request.finish_reason in ("stop", "length"):
+            full_response = decode_completion(generation_request, runtime)
+            usage = completion_usage(input_ids, generation_request)
+            store_exact_cache(exact_key, generation_request, full_response, usage)
+            if generation_request.finish_reason == "stop":
+                store_semantic_cache(request, full_response, usage, model_id)
+
+        # Evento de finalización
+        event_data = {
+            "id": generation_request.request_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model_id,
+            "choices": [{
+                "index": 0,
+                "delta": {},
+                "finish_reason": generation_request.finish_reason or "stop"
+            }]
+        }
+        if usage is not None:
+            event_data["usage"] = usage
+        yield {"event": "message", "data": json.dumps(event_data)}
+        yield {"event": "complete", "data": "[DONE]"}
+
+    return EventSourceResponse(
+        event_generator(),
+        headers={"X-Request-Id": generation_request.request_id}
+    )
+
+async def handle_standard_request(
+    request: ChatCompletionRequest,
+    http_request: Optional[Request] = None,
+    request_id: Optional[str] = None
+):
+    """Maneja requests estándar (sin streaming)"""
+    if request.n and request.n > 1:
+        return await handle_multi_choice_request(request, http_request, request_id)
+
+    received_at = time.time()
+    labels = metric_labels(http_request, stream=False)
+    runtime = resolve_runtime(request.model)
+    model_id = runtime.model_id
+    request_id = request_id or f"chatcmpl-{uuid.uuid4()}"
+    chat_stream = open_chat_stream(request, runtime, request_id)
+
+    try:
+        # Caché semántica: preguntas casi idénticas ya respondidas. Va antes de construir
+        # el prompt (un acierto no paga RAG ni tokenización) y no se solapa con la exacta
+        cached = await lookup_semantic_cache(request, model_id)
+        if cached is not None:
+            metrics.cache_hits.inc(*labels, "semantic")
+            if chat_stream is not None:
+                chat_stream.finish(cached["content"], "stop", cached["usage"])
+            return build_completion_response(
+                request_id, cached["content"], "stop", cached["usage"],
+                cache="semantic", model_id=model_id
+            )
+
+        # Preparar inputs: system prompt + turnos recientes dentro del presupuesto de contexto
+        input_ids = await prepare_input_ids(request, runtime)
+        metrics.tokenization.observe(time.time() - received_at, *labels)
+
+        # Caché exacta: mismo prompt y parámetros deterministas
+        exact_key, exact_hit = await lookup_exact_cache(request, input_ids, model_id)
+        if exact_hit is not None:
+            metrics.cache_hits.inc(*labels, "exact")
+            if chat_stream is not None:
+                chat_stream.finish(exact_hit["content"], exact_hit["finish_reason"], exact_hit["usage"])
+            return build_completion_response(
+                request_id,
+                exact_hit["content"],
+                exact_hit["finish_reason"],
+                exact_hit["usage"],
+                cache="exact",
+                model_id=model_id
+            )
+
+        # Encolar en el planificador y esperar sin bloquear el event loop
+        # (con chat_uuid, los tokens salen al canal del chat mientras se generan)
+        generation_request = new_generation_request(
+            request, input_ids, labels, request_id=request_id, streamer=chat_stream
+        )
+        try:
+            runtime.scheduler.submit(generation_request)
+        except SchedulerQueueFull as e:
+            raise overloaded_error(e)
+        except ValueError as e:
+            raise HTTPException(status_code=409, detail=str(e))
+
+        disconnect_watcher = asyncio.create_task(cancel_on_disconnect(http_request, generation_request))
+        try:
+            await generation_request.wait()
+        finally:
+            disconnect_watcher.cancel()
+            metrics.observe_generation(labels, generation_request, received_at)
+
+        # Decodificar respuesta y calcular tokens
+        response_message = decode_completion(generation_request, runtime)
+        usage = completion_usage(input_ids, generation_request)
+
+        store_exact_cache(exact_key, generation_request, response_message, usage)
+        if generation_request.finish_reason == "stop":
+            store_semantic_cache(request, response_message, usage, model_id)
+        if chat_stream is not None:
+            chat_stream.finish(response_message, generation_request.finish_reason, usage)
+
+        return build_completion_response(
+            generation_request.request_id, response_message, generation_request.finish_reason, usage,
+            model_id=model_id
+        )
+
+    except HTTPException as e:
+        if chat_stream is not None:
+            chat_stream.finish(finish_reason="error", error=str(e.detail))
+        raise
+    except Exception as e:
         logger.error(f"Error en generación: {e}")
+        if chat_stream is not None:
+            chat_stream.finish(finish_reason="error", error=str(e))
         raise HTTPException(status_code=500, detail=f"Error interno del servidor: {str(e)}")
+    finally:
+        runtime.unreserve()
+
+async def handle_multi_choice_request(
+    request: ChatCompletionRequest,
+    http_request: Optional[Request] = None,
+    request_id: Optional[str] = None
+):
+    """
+    n respuestas alternativas para el mismo prompt. Entran juntas al batch: la primera
+    hace el prefill y las demás reutilizan su caché KV (solo procesan el último token).
+    Las cachés de respuestas no se usan porque guardan una sola respuesta.
+    """
+    received_at = time.time()
+    labels = metric_labels(http_request, stream=False)
+    request_id = request_id or f"chatcmpl-{uuid.uuid4()}"
+    runtime = resolve_runtime(request.model)
+
+    try:
+        input_ids = await prepare_input_ids(request, runtime)
+        metrics.tokenization.observe(time.time() - received_at, *labels)
+
+        # Con seed, cada alternativa usa seed + índice para que no salgan idénticas
+        group = [
+            new_generation_request(
+                request,
+                input_ids,
+                labels,
+                request_id=request_id if index == 0 else f"{request_id}-{index}",
+                seed=request.seed + index if request.seed is not None else None
+            )
+            for index in range(request.n)
+        ]
+        try:
+            runtime.scheduler.submit_many(group)
+        except SchedulerQueueFull as e:
+            raise overloaded_error(e)
+        except ValueError as e:
+            raise HTTPException(status_code=409, detail=str(e))
+    finally:
+        runtime.unreserve()
+
+    await wait_group(http_request, group, labels, received_at)
+
+    failed = [r for r in group if r.error is not None]
+    if failed:
+        logger.error(f"Error en generación: {failed[0].error}")
+        raise HTTPException(status_code=500, detail=f"Error interno del servidor: {str(failed[0].error)}")
+
+    completion_tokens = sum(len(r.output_ids) for r in group)
+    usage = {
+        "prompt_tokens": len(input_ids),
+        "completion_tokens": completion_tokens,
+        "total_tokens": len(input_ids) + completion_tokens,
+        "prompt_tokens_details": {"cached_tokens": group[0].cached_tokens},
+        "completion_tokens_details": completion_tokens_details(group)
+    }
+    choices = [completion_choice(index, decode_completion(r, runtime), r.finish_reason) for index, r in enumerate(group)]
+    return build_completion_response(
+        request_id, choices[0]["message"]["content"], None, usage, choices=choices, model_id=runtime.model_id
+    )
+
+@app.post("/v1/batch/completions")
+async def create_batch_completion(
+    batch: BatchCompletionRequest,
+    http_request: Request,
+    api_key: str = Depends(verify_api_key)
+):
+    """
+    Varias completions independientes en una sola llamada. Los prompts entran juntos
+    en el batch del planificador (caché KV con padding a la izquierda) y se devuelve
+    el uso de tokens de cada uno. Pensado para trabajos offline (extracción de
+    tripletas, resúmenes) que antes hacían una llamada HTTP por prompt.
+    """
+    received_at = time.time()
+    labels = metric_labels(http_request, stream=False)
+    batch_id = f"batch-{uuid.uuid4()}"
+    runtime = resolve_runtime(batch.model)
+
+    try:
+        if not batch.requests or len(batch.requests) > BATCH_MAX_ITEMS:
+            raise HTTPException(status_code=400, detail=f"El lote debe tener entre 1 y {BATCH_MAX_ITEMS} solicitudes")
+        if any(item.stream or (item.n and item.n > 1) for item in batch.requests):
+            raise HTTPException(status_code=400, detail="Las solicitudes de un lote no admiten stream ni n>1")
+
+        try:
+            runtime.scheduler.check_admission()
+        except SchedulerQueueFull as e:
+            raise overloaded_error(e)
+
+        # Tokenizar todos los prompts en el pool de CPU
+        prompts = await asyncio.gather(
+            *(run_cpu(runtime.engine.build_prompt, item.messages, item.max_tokens, chat_id=item.chat_id) for item in batch.requests),
+            return_exceptions=True
+        )
+        metrics.tokenization.observe(time.time() - received_at, *labels)
+
+        results: List[Optional[Dict[str, Any]]] = [None] * len(batch.requests)
+        pending = []  # (índice, input_ids, clave de caché exacta, GenerationRequest)
+        for index, (item, prompt) in enumerate(zip(batch.requests, prompts)):
+            if isinstance(prompt, Exception):
+                results[index] = {"index": index, "error": str(prompt)}
+                continue
+
+            input_ids, _ = prompt
+            exact_key, exact_hit = await lookup_exact_cache(item, input_ids, runtime.model_id)
+            if exact_hit is not None:
+                metrics.cache_hits.inc(*labels, "exact")
+                results[index] = {
+                    "index": index,
+                    "choices": [completion_choice(0, exact_hit["content"], exact_hit["finish_reason"])],
+                    "usage": exact_hit["usage"],
+                    "cache": "exact"
+                }
+                continue
+
+            # Todo el lote es un único flujo del reparto justo
+            generation_request = new_generation_request(
+                item,
+                input_ids,
+                labels,
+                request_id=f"{batch_id}-{index}",
+                priority=item.priority or batch.priority,
+                user=batch.user or batch_id
+            )
+            pending.append((index, input_ids, exact_key, generation_request))
+
+        group = [entry[3] for entry in pending]
+        if group:
+            try:
+                runtime.scheduler.submit_many(group)
+            except SchedulerQueueFull as e:
+                raise overloaded_error(e)
+            except ValueError as e:
+                raise HTTPException(status_code=409, detail=str(e))
+    finally:
+        runtime.unreserve()
+
+    if group:
+        await wait_group(http_request, group, labels, received_at)
+
+    for index, input_ids, exact_key, generation_request in pending:
+        if generation_request.error is not None:
+            results[index] = {"index": index, "id": generation_request.request_id, "error": str(generation_request.error)}
+            continue
+
+        content = decode_completion(generation_request, runtime)
+        usage = completion_usage(input_ids, generation_request)
+        store_exact_cache(exact_key, generation_request, content, usage)
+        results[index] = {
+            "index": index,
+            "id": generation_request.request_id,
+            "choices": [completion_choice(0, content, generation_request.finish_reason)],
+            "usage": usage
+        }
+
+    totals = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+    for result in results:
+        for key in totals:
+            totals[key] += result.get("usage", {}).get(key, 0)
+
+    return JSONResponse(content={
+        "id": batch_id,
+        "object": "batch.completion",
+        "created": int(time.time()),
+        "model": runtime.model_id,
+        "results": results,
+        "usage": totals
+    })
 
 @app.post("/generar")
 async def generar_respuesta(
     request: UserRequest,
-    api_key: str = Depends(verify_api_key)
+    http_request: Request,
+    api_key: str = Depends(verify_api_key),
+    request_id: Optional[str] = Header(None, alias="x-request-id")
 ):
     """Endpoint simplificado para generación rápida"""
 
@@ -1010,13 +4985,17 @@ async def generar_respuesta(
         mensajes=messages,
         stream=request.stream,
         max_tokens=512,
-        temperature=0.7
+        temperature=request.temperature,
+        seed=request.seed,
+        cache=request.cache,
+        priority=request.priority,
+        user=request.user
     )
 
     if request.stream:
-        return await handle_streaming_request(chat_request)
+        return await handle_streaming_request(chat_request, http_request, request_id)
     else:
-        response = await handle_standard_request(chat_request)
+        response = await handle_standard_request(chat_request, http_request, request_id)
         # Extraer solo el contenido de la respuesta para formato simple
         response_data = response.body.decode() if hasattr(response, 'body') else "{}"
         response_json = json.loads(response_data)
@@ -1026,21 +5005,101 @@ async def generar_respuesta(
         else:
             return {"reply": "No se pudo generar una respuesta"}
 
+@app.delete("/v1/requests/{request_id}")
+async def cancel_generation(
+    request_id: str,
+    api_key: str = Depends(verify_api_key)
+):
+    """Cancela una generación en cola o en curso y libera su hueco en el batch"""
+    if not require_registry().cancel(request_id):
+        raise HTTPException(status_code=404, detail="Solicitud no encontrada o ya finalizada")
+    return {"status": "success", "message": "Generación cancelada", "request_id": request_id}
+
 @app.post("/configurar")
 async def configure_server(
     config: ClientConfig,
     api_key: str = Depends(verify_api_key)
 ):
-    """Endpoint para configuración del servidor"""
+    """
+    Endpoint para configuración del servidor.
+
+    Gestión de modelos (sin reiniciar el proceso):
+      {"load_model": id, "make_default": bool, "replace": bool}  carga en segundo plano
+      {"unload_model": id}                                      descarga tras drenar
+    """
     logger.info(f"Configuración recibida: {config.settings}")
-    return {"status": "success", "message": "Configuración aplicada"}
+    settings = config.settings
+    result = {"status": "success", "message": "Configuración aplicada"}
+    registry = require_registry()
+
+    if settings.get("load_model"):
+        result["load"] = registry.load(
+            str(settings["load_model"]),
+            make_default=bool(settings.get("make_default", False)),
+            replace=bool(settings.get("replace", False))
+        )
+    if settings.get("unload_model"):
+        try:
+            registry.unload(str(settings["unload_model"]))
+            result["unload"] = "retiring"
+        except (ValueError, ModelNotAvailable) as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+    result["models"] = registry.snapshot()
+    return result
+
+@app.get("/v1/models")
+async def list_models(api_key: str = Depends(verify_api_key)):
+    """Modelos residentes (formato OpenAI) y cargas en curso"""
+    snapshot = require_registry().snapshot()
+    return {
+        "object": "list",
+        "data": [
+            {
+                "id": entry["model_id"],
+                "object": "model",
+                "created": int(entry["loaded_at"]),
+                "owned_by": "foxia",
+                "default": entry["model_id"] == snapshot["default"]
+            }
+            for entry in snapshot["resident"]
+        ],
+        "loading": snapshot["loading"]
+    }
+
+def require_knowledge_base() -> KnowledgeIndex:
+    """Índice de conocimiento activo, o 409 si el RAG está desactivado o cargando"""
+    if knowledge_base is None:
+        raise HTTPException(status_code=409, detail="RAG desactivado o todavía cargando (rag_enabled)")
+    return knowledge_base
+
+@app.get("/v1/knowledge")
+async def knowledge_status(api_key: str = Depends(verify_api_key)):
+    """Estado del índice de tripletas"""
+    return require_knowledge_base().snapshot()
+
+@app.post("/v1/knowledge")
+async def push_knowledge(batch: Dict[str, Any], api_key: str = Depends(verify_api_key)):
+    """
+    Empuja cambios de tripletas sin esperar al refresco (mismo formato que el feed):
+    {"global": [...], "context": [...], "deleted": {"global": [ids], "context": [ids]}, "full": false}
+    """
+    index = require_knowledge_base()
+    try:
+        return await run_cpu(index.apply, batch)
+    except (KeyError, TypeError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"Lote de tripletas inválido: {e}")
 
 # ==============================================================================
 # === SISTEMA DE REGISTRO EN SERVIDOR CENTRAL =================================
 # ==============================================================================
 
 def register_with_central_server(public_url):
-    """Registra el nodo en el servidor central de Fox-IA"""
+    """Registra el nodo en el servidor central de Fox-IA (solo cuando está listo para recibir tráfico)"""
+    if not server_readiness.wait():
+        logger.warning("⚠️  El arranque falló: el nodo no se registra en el servidor central")
+        return
+
     try:
         logger.info(f"--> Intentando registrar nodo en: {REGISTER_ENDPOINT}")
         registration_data = {"node_url": public_url}
@@ -1064,6 +5123,538 @@ def register_with_central_server(public_url):
         logger.warning(f"⚠️  Error inesperado al registrar el nodo: {e}")
         logger.warning("⚠️  El servidor continuará funcionando sin registro central")
 
+def node_load_report(node_url: str) -> Dict[str, Any]:
+    """Carga actual del nodo para que el servidor central elija el menos cargado"""
+    report = {
+        "node_url": node_url,
+        "ready": server_readiness.ready,
+        "stage": server_readiness.stage,
+        "model_id": None,
+        "models": [],
+        "queue_depth": 0,
+        "in_flight": 0,
+        "max_batch_size": 0,
+        "kv_free_tokens": 0,
+        "tokens_per_second": 0.0
+    }
+    registry = model_registry
+    if registry is not None:
+        report["model_id"] = registry.default_id
+        report["models"] = list(registry.runtimes)
+        # Los modelos retirándose también ocupan el batch hasta que terminan
+        for runtime in registry.all_runtimes():
+            load = runtime.scheduler.load()
+            for key in ("queue_depth", "in_flight", "max_batch_size", "kv_free_tokens", "tokens_per_second"):
+                report[key] += load[key]
+
+    sample = system_sampler.latest()
+    if sample.get("vram_total_gb") is not None and sample.get("vram_used_gb") is not None:
+        report["vram_free_gb"] = round(sample["vram_total_gb"] - sample["vram_used_gb"], 2)
+
+    # 0 = ocioso, 1 = batch lleno, >1 = hay cola. Sin modelo listo no hay capacidad.
+    if report["ready"] and report["max_batch_size"]:
+        report["load_score"] = round((report["queue_depth"] + report["in_flight"]) / report["max_batch_size"], 3)
+    else:
+        report["load_score"] = None
+    return report
+
+class NodeHeartbeat:
+    """
+    Latido periódico al servidor central con la carga del nodo.
+
+    Usa una sesión HTTP persistente (keep-alive) para no repetir el handshake TLS
+    en cada latido, autenticada con la clave API del nodo (x-api-key). Si el
+    servidor central no responde, el intervalo crece exponencialmente hasta
+    `max_backoff_s`, con jitter para que varios nodos no reintenten a la vez, y
+    vuelve al normal con el primer latido aceptado.
+    """
+
+    def __init__(self, endpoint: str, node_url: str, interval_s: float, max_backoff_s: float, api_key: str = API_KEY):
+        self.endpoint = endpoint
+        self.node_url = node_url
+        self.interval_s = max(1.0, interval_s)
+        self.max_backoff_s = max(self.interval_s, max_backoff_s)
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=1)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.verify = False
+        self.session.headers["x-api-key"] = api_key
+
+        self.failures = 0
+        self.last_ok_at: Optional[float] = None
+        self.last_error: Optional[str] = None
+        self.stats = {"sent": 0, "failed": 0}
+        self._stop = threading.Event()
+        self._thread: Optional[Thread] = None
+
+    def next_delay(self) -> float:
+        """Intervalo normal, o backoff exponencial con jitter tras fallos"""
+        if not self.failures:
+            return self.interval_s
+        delay = min(self.max_backoff_s, self.interval_s * 2 ** self.failures)
+        return delay * random.uniform(0.8, 1.2)
+
+    def beat(self, report: Optional[Dict[str, Any]] = None) -> bool:
+        """Envía un latido; True si el servidor central lo aceptó"""
+        try:
+            response = self.session.post(self.endpoint, json=report or node_load_report(self.node_url), timeout=5)
+            response.raise_for_status()
+        except Exception as e:
+            self.failures += 1
+            self.stats["failed"] += 1
+            self.last_error = str(e)
+            if self.failures == 1:
+                logger.warning(f"⚠️  Latido al servidor central fallido, reintentando con backoff: {e}")
+            return False
+
+        if self.failures:
+            logger.info(f"💓 Latido restablecido tras {self.failures} fallos")
+        self.failures = 0
+        self.last_ok_at = time.time()
+        self.stats["sent"] += 1
+        return True
+
+    def _run(self):
+        while True:
+            self.beat()
+            if self._stop.wait(self.next_delay()):
+                return
+
+    def start(self):
+        self._thread = Thread(target=self._run, daemon=True, name="foxia-heartbeat")
+        self._thread.start()
+        logger.info(f"💓 Latido al servidor central cada {self.interval_s:.0f}s")
+
+    def stop(self):
+        """Detiene el latido y avisa al servidor central de que el nodo se retira"""
+        self._stop.set()
+        self.beat({**node_load_report(self.node_url), "ready": False, "load_score": None})
+        self.session.close()
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "enabled": True,
+            "endpoint": self.endpoint,
+            "interval_s": self.interval_s,
+            "consecutive_failures": self.failures,
+            "next_delay_s": round(self.next_delay(), 1),
+            "last_ok_at": self.last_ok_at,
+            "last_error": self.last_error,
+            **self.stats
+        }
+
+node_heartbeat: Optional[NodeHeartbeat] = None
+
+def start_heartbeat(public_url: str):
+    """Arranca el latido si está configurado (heartbeat_endpoint y heartbeat_interval_s > 0)"""
+    global node_heartbeat
+    if HEARTBEAT_INTERVAL_S <= 0 or not HEARTBEAT_ENDPOINT:
+        return
+    node_heartbeat = NodeHeartbeat(HEARTBEAT_ENDPOINT, public_url, HEARTBEAT_INTERVAL_S, HEARTBEAT_MAX_BACKOFF_S)
+    node_heartbeat.start()
+
+# ==============================================================================
+# === MODO WORKER: COLA DE TRABAJOS DE CHAT ===================================
+# ==============================================================================
+
+class RedisJobQueue:
+    """
+    Cola de trabajos en una lista de Redis (LPUSH del servidor central, consumo FIFO).
+
+    Patrón fiable: cada trabajo se mueve de forma atómica a una lista de proceso
+    propia del worker (BRPOPLPUSH) y solo se borra de ella al publicar su resultado.
+    Cada worker renueva una concesión en `{jobs_key}:leases` (ZSET worker → caducidad,
+    con la hora del propio Redis); cualquier worker devuelve a la cola las listas de
+    proceso cuya concesión caducó, así que los trabajos de un nodo caído se recuperan
+    aunque no vuelva a arrancar con el mismo id.
+    """
+
+    # Publicar/devolver solo si el trabajo sigue en la lista de proceso: si otro worker
+    # lo reclamó por concesión caducada, ya está otra vez en la cola y se descarta
+    COMPLETE_SCRIPT = """
+if redis.call('LREM', KEYS[1], 1, ARGV[1]) == 1 then
+    redis.call('LPUSH', KEYS[2], ARGV[2])
+    return 1
+end
+return 0
+"""
+    RELEASE_SCRIPT = """
+if redis.call('LREM', KEYS[1], 1, ARGV[1]) == 1 then
+    redis.call('RPUSH', KEYS[2], ARGV[1])
+    return 1
+end
+return 0
+"""
+
+    def __init__(self, url: str, jobs_key: str, results_key: str, worker_id: str, visibility_timeout_s: float = 120.0):
+        import redis
+
+        self.client = redis.Redis.from_url(url, decode_responses=True, health_check_interval=30)
+        self.jobs_key = jobs_key
+        self.results_key = results_key
+        self.worker_id = worker_id
+        self.processing_prefix = f"{jobs_key}:processing:"
+        self.processing_key = self.processing_prefix + worker_id
+        self.leases_key = f"{jobs_key}:leases"
+        self.visibility_timeout_s = visibility_timeout_s
+        self._complete = self.client.register_script(self.COMPLETE_SCRIPT)
+        self._release = self.client.register_script(self.RELEASE_SCRIPT)
+
+    def _now(self) -> float:
+        seconds, micros = self.client.time()
+        return seconds + micros / 1e6
+
+    def heartbeat(self):
+        """Renueva la concesión del worker sobre sus trabajos en proceso"""
+        self.client.zadd(self.leases_key, {self.worker_id: self._now() + self.visibility_timeout_s})
+
+    def reap(self) -> int:
+        """Devuelve a la cola los trabajos de los workers con la concesión caducada"""
+        now, reaped = self._now(), 0
+        for key in self.client.scan_iter(match=self.processing_prefix + "*", count=100):
+            worker = key[len(self.processing_prefix):]
+            if worker == self.worker_id:
+                continue
+            expires_at = self.client.zscore(self.leases_key, worker)
+            if expires_at is not None and expires_at > now:
+                continue
+            while self.client.lmove(key, self.jobs_key, "LEFT", "RIGHT") is not None:
+                reaped += 1
+            self.client.zrem(self.leases_key, worker)
+        return reaped
+
+    def recover(self) -> int:
+        """Devuelve a la cabeza de la cola los trabajos que quedaron a medias"""
+        recovered = 0
+        # La cola se consume por la derecha: del más reciente al más antiguo, cada uno al frente
+        while self.client.lmove(self.processing_key, self.jobs_key, "LEFT", "RIGHT") is not None:
+            recovered += 1
+        return recovered
+
+    def claim(self, max_jobs: int, timeout_s: float) -> List[Tuple[Any, str]]:
+        """Hasta max_jobs trabajos: espera por el primero y recoge los que ya estén en cola"""
+        raw = self.client.brpoplpush(self.jobs_key, self.processing_key, timeout=max(1, int(timeout_s)))
+        if raw is None:
+            return []
+        claimed = [(raw, raw)]
+        while len(claimed) < max_jobs:
+            raw = self.client.rpoplpush(self.jobs_key, self.processing_key)
+            if raw is None:
+                break
+            claimed.append((raw, raw))
+        return claimed
+
+    def complete(self, handle: Any, result: Dict[str, Any]) -> bool:
+        """Publica el resultado; False si el trabajo ya no era de este worker"""
+        args = [handle, json.dumps(result, ensure_ascii=False)]
+        return self._complete(keys=[self.processing_key, self.results_key], args=args) == 1
+
+    def release(self, handle: Any) -> bool:
+        """Devuelve el trabajo al frente de la cola (nodo saturado)"""
+        return self._release(keys=[self.processing_key, self.jobs_key], args=[handle]) == 1
+
+    def close(self):
+        self.client.close()
+
+class SqliteJobQueue:
+    """
+    La misma cola sobre SQLite, para pruebas y nodos sin Redis. Los productores
+    insertan en ai_jobs (ver `enqueue`) y leen los resultados de ai_results.
+    La concesión es `claimed_at`, que el worker renueva en sus trabajos en proceso.
+    """
+
+    def __init__(self, path: str, worker_id: str, visibility_timeout_s: float = 120.0):
+        self.worker_id = worker_id
+        self.visibility_timeout_s = visibility_timeout_s
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS ai_jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, payload TEXT NOT NULL, "
+            "status TEXT NOT NULL DEFAULT 'pending', worker TEXT, claimed_at REAL)"
+        )
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS ai_results (id INTEGER PRIMARY KEY AUTOINCREMENT, payload TEXT NOT NULL, "
+            "created_at REAL NOT NULL)"
+        )
+        self._lock = threading.Lock()
+
+    def enqueue(self, job: Dict[str, Any]) -> int:
+        with self._lock:
+            cursor = self._connection.execute("INSERT INTO ai_jobs (payload) VALUES (?)", (json.dumps(job, ensure_ascii=False),))
+            return cursor.lastrowid
+
+    def recover(self) -> int:
+        with self._lock:
+            cursor = self._connection.execute(
+                "UPDATE ai_jobs SET status = 'pending', worker = NULL WHERE status = 'processing' AND worker = ?",
+                (self.worker_id,)
+            )
+            return cursor.rowcount
+
+    def heartbeat(self):
+        with self._lock:
+            self._connection.execute(
+                "UPDATE ai_jobs SET claimed_at = ? WHERE status = 'processing' AND worker = ?",
+                (time.time(), self.worker_id)
+            )
+
+    def reap(self) -> int:
+        """Devuelve a la cola los trabajos cuya concesión caducó (worker caído)"""
+        with self._lock:
+            cursor = self._connection.execute(
+                "UPDATE ai_jobs SET status = 'pending', worker = NULL "
+                "WHERE status = 'processing' AND claimed_at < ? AND worker != ?",
+                (time.time() - self.visibility_timeout_s, self.worker_id)
+            )
+            return cursor.rowcount
+
+    def _claim_now(self, max_jobs: int) -> List[Tuple[Any, str]]:
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._connection.execute(
+                    "SELECT id, payload FROM ai_jobs WHERE status = 'pending' ORDER BY id LIMIT ?", (max_jobs,)
+                ).fetchall()
+                self._connection.executemany(
+                    "UPDATE ai_jobs SET status = 'processing', worker = ?, claimed_at = ? WHERE id = ?",
+                    [(self.worker_id, time.time(), row[0]) for row in rows]
+                )
+                self._connection.execute("COMMIT")
+            except Exception:
+                self._connection.execute("ROLLBACK")
+                raise
+        return [(row[0], row[1]) for row in rows]
+
+    def claim(self, max_jobs: int, timeout_s: float) -> List[Tuple[Any, str]]:
+        deadline = time.time() + timeout_s
+        while True:
+            claimed = self._claim_now(max_jobs)
+            if claimed or time.time() >= deadline:
+                return claimed
+            time.sleep(0.05)
+
+    def complete(self, handle: Any, result: Dict[str, Any]) -> bool:
+        """Publica el resultado; False si el trabajo ya no era de este worker (reclamado por caducar)"""
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                cursor = self._connection.execute(
+                    "UPDATE ai_jobs SET status = 'done' WHERE id = ? AND status = 'processing' AND worker = ?",
+                    (handle, self.worker_id)
+                )
+                if cursor.rowcount == 1:
+                    self._connection.execute(
+                        "INSERT INTO ai_results (payload, created_at) VALUES (?, ?)",
+                        (json.dumps(result, ensure_ascii=False), time.time())
+                    )
+                self._connection.execute("COMMIT")
+                return cursor.rowcount == 1
+            except Exception:
+                # Sin ROLLBACK la conexión quedaría con la transacción abierta y bloquearía la base
+                self._connection.execute("ROLLBACK")
+                raise
+
+    def release(self, handle: Any) -> bool:
+        with self._lock:
+            cursor = self._connection.execute(
+                "UPDATE ai_jobs SET status = 'pending', worker = NULL WHERE id = ? AND status = 'processing' AND worker = ?",
+                (handle, self.worker_id)
+            )
+            return cursor.rowcount == 1
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+def open_job_queue(location: str):
+    """Cola según la configuración: redis://... o sqlite:///ruta"""
+    if location.startswith(("redis://", "rediss://", "unix://")):
+        return RedisJobQueue(location, WORKER_JOBS_KEY, WORKER_RESULTS_KEY, WORKER_ID, WORKER_VISIBILITY_TIMEOUT_S)
+    if location.startswith("sqlite://"):
+        return SqliteJobQueue(location[len("sqlite://"):], WORKER_ID, WORKER_VISIBILITY_TIMEOUT_S)
+    raise ValueError(f"Cola de trabajos no soportada: {location}")
+
+class RequeueJob(Exception):
+    """El nodo no puede aceptar el trabajo ahora: vuelve a la cola tras `retry_after` segundos"""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class JobWorker:
+    """
+    Modo worker: en lugar de esperar una llamada HTTP por mensaje, el nodo toma
+    trabajos de la cola y los pasa al planificador.
+
+    Mantiene hasta `concurrency` trabajos en curso (por defecto el tamaño máximo del
+    batch), que el continuous batching decodifica juntos; al terminar uno se recoge
+    el siguiente. Cada trabajo sigue el mismo camino que /v1/chat/completions sin
+    streaming (cachés, RAG, métricas) y su resultado se publica en la cola de
+    resultados con los campos del trabajo para que el servidor central lo guarde.
+    Mientras corre renueva su concesión y recoge los trabajos de workers caídos.
+    """
+
+    def __init__(self, queue, concurrency: int, lease_interval_s: float = 30.0):
+        self.queue = queue
+        self.concurrency = max(1, concurrency)
+        self.lease_interval_s = max(1.0, lease_interval_s)
+        self.in_flight = 0
+        self.stats = {"claimed": 0, "completed": 0, "failed": 0, "requeued": 0, "recovered": 0, "reaped": 0}
+        self._running = False
+        self._slot_freed: Optional[asyncio.Event] = None
+
+    @staticmethod
+    def build_request(job: Dict[str, Any]) -> ChatCompletionRequest:
+        """Solicitud de chat a partir del trabajo (mismos campos que la API HTTP)"""
+        return ChatCompletionRequest(
+            mensajes=job.get("mensajes") or job.get("messages"),
+            max_tokens=job.get("max_tokens", MAX_NEW_TOKENS),
+            temperature=job.get("temperature", DEFAULT_CONFIG["temperature"]),
+            top_p=job.get("top_p", DEFAULT_CONFIG["top_p"]),
+            seed=job.get("seed"),
+            cache=job.get("cache", True),
+            priority=job.get("priority"),
+            user=str(job["chat_id"]) if job.get("chat_id") is not None else job.get("user"),
+            chat_id=job.get("chat_id"),
+            chat_uuid=job.get("chat_uuid"),
+            reasoning_budget=job.get("reasoning_budget"),
+            include_reasoning=job.get("include_reasoning"),
+            model=job.get("model")
+        )
+
+    async def execute(self, job: Dict[str, Any]) -> Dict[str, Any]:
+        """Genera la respuesta del trabajo; RequeueJob si el nodo está saturado o cargando"""
+        started = time.time()
+        request = self.build_request(job)
+        try:
+            response = await handle_standard_request(request)
+        except HTTPException as e:
+            if e.status_code in (429, 503):
+                raise RequeueJob(str(e.detail), float((e.headers or {}).get("Retry-After", 5)))
+            raise
+
+        data = json.loads(response.body)
+        choice = data["choices"][0]
+        return {
+            "status": "ok",
+            "request_id": data["id"],
+            "model": data["model"],
+            "content": choice["message"]["content"],
+            "finish_reason": choice["finish_reason"],
+            "usage": data["usage"],
+            "cache": data.get("cache"),
+            "latency_s": round(time.time() - started, 3)
+        }
+
+    async def _process(self, handle: Any, raw: str):
+        try:
+            try:
+                job = json.loads(raw)
+                if not isinstance(job, dict):
+                    raise ValueError("el trabajo no es un objeto JSON")
+            except ValueError as e:
+                # Trabajo ilegible: se publica como error para que no quede atascado en la cola
+                logger.error(f"❌ Trabajo ilegible en la cola: {e}")
+                self.stats["failed"] += 1
+                await asyncio.to_thread(self.queue.complete, handle, {"status": "error", "error": str(e), "payload": str(raw)[:500]})
+                return
+            # El resultado repite los campos del trabajo (chat_id, message_id, uuid...) sin el historial
+            echo = {key: value for key, value in job.items() if key not in ("mensajes", "messages")}
+            try:
+                result = {**echo, **await self.execute(job)}
+                self.stats["completed"] += 1
+            except RequeueJob as e:
+                logger.info(f"⏳ Trabajo devuelto a la cola ({e}); reintento en {e.retry_after:.0f}s")
+                self.stats["requeued"] += 1
+                await asyncio.sleep(e.retry_after)
+                await asyncio.to_thread(self.queue.release, handle)
+                return
+            except Exception as e:
+                logger.error(f"❌ Trabajo fallido (chat {job.get('chat_id')}): {e}")
+                result = {**echo, "status": "error", "error": str(e)}
+                self.stats["failed"] += 1
+            if job.get("enqueued_at"):
+                result["queue_s"] = round(time.time() - float(job["enqueued_at"]), 3)
+            if not await asyncio.to_thread(self.queue.complete, handle, result):
+                # La concesión caducó y otro worker lo reclamó: su resultado es el que vale
+                logger.warning(f"⚠️  Resultado descartado (chat {job.get('chat_id')}): el trabajo ya no era de este nodo")
+        except Exception as e:
+            # Cola caída: el trabajo queda en la lista de proceso y se recupera al reiniciar
+            logger.error(f"❌ Error procesando trabajo de la cola: {e}")
+        finally:
+            self.in_flight -= 1
+            self._slot_freed.set()
+
+    async def maintain_lease(self):
+        """Renueva la concesión y devuelve a la cola los trabajos de workers caídos"""
+        while self._running:
+            try:
+                await asyncio.to_thread(self.queue.heartbeat)
+                reaped = await asyncio.to_thread(self.queue.reap)
+                if reaped:
+                    self.stats["reaped"] += reaped
+                    logger.info(f"♻️  {reaped} trabajos de workers caídos devueltos a la cola")
+            except Exception as e:
+                logger.warning(f"⚠️  No se pudo renovar la concesión de la cola: {e}")
+            await asyncio.sleep(self.lease_interval_s)
+
+    async def run(self):
+        self._running = True
+        self._slot_freed = asyncio.Event()
+        self.stats["recovered"] = await asyncio.to_thread(self.queue.recover)
+        if self.stats["recovered"]:
+            logger.info(f"♻️  {self.stats['recovered']} trabajos a medias devueltos a la cola")
+        lease_task = asyncio.create_task(self.maintain_lease())
+        logger.info(f"📥 Worker de cola activo ({self.concurrency} trabajos en paralelo)")
+
+        while self._running:
+            free = self.concurrency - self.in_flight
+            if free <= 0:
+                self._slot_freed.clear()
+                await self._slot_freed.wait()
+                continue
+            try:
+                claimed = await asyncio.to_thread(self.queue.claim, free, 1.0)
+            except Exception as e:
+                logger.warning(f"⚠️  Cola de trabajos no disponible: {e}")
+                await asyncio.sleep(5)
+                continue
+            for handle, raw in claimed:
+                self.in_flight += 1
+                self.stats["claimed"] += 1
+                asyncio.create_task(self._process(handle, raw))
+        lease_task.cancel()
+
+    def stop(self):
+        self._running = False
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "enabled": True,
+            "queue": WORKER_QUEUE.split("@")[-1],  # sin credenciales
+            "concurrency": self.concurrency,
+            "in_flight": self.in_flight,
+            **self.stats
+        }
+
+job_worker: Optional[JobWorker] = None
+
+def start_job_worker():
+    """Arranca el worker de cola en su propio event loop (hilo de fondo)"""
+    global job_worker
+    try:
+        job_worker = JobWorker(
+            open_job_queue(WORKER_QUEUE),
+            WORKER_CONCURRENCY or MAX_BATCH_SIZE,
+            lease_interval_s=WORKER_VISIBILITY_TIMEOUT_S / 4
+        )
+    except Exception as e:
+        logger.error(f"❌ Modo worker desactivado: {e}")
+        return
+    Thread(target=lambda: asyncio.run(job_worker.run()), daemon=True, name="foxia-job-worker").start()
+
 # ==============================================================================
 # === INICIALIZACIÓN Y EJECUCIÓN DEL SERVIDOR =================================
 # ==============================================================================
@@ -1077,6 +5668,8 @@ def clean_gpu_cache():
 
 def initialize_ngrok():
     """Inicializa el túnel Ngrok"""
+    from pyngrok import ngrok
+
     try:
         ngrok.kill()
     except:
@@ -1102,30 +5695,70 @@ def run_server():
         timeout_keep_alive=300
     )
 
-# LLAMADA DE CALENTAMIENTO PARA 4-BIT
-logger.info("--> Realizando calentamiento GPU para 4-bit...")
-try:
-    warmup_inputs = tokenizer("Calentamiento modelo 4-bit", return_tensors="pt").to(model.device)
-    _ = model.generate(**warmup_inputs, max_new_tokens=10)
-    logger.info("✅ GPU calentada y lista para 4-bit")
-except Exception as e:
-    logger.warning(f"⚠️  Calentamiento falló: {e}")
+def bootstrap():
+    """
+    Arranque pesado, con el puerto ya abierto: carga del modelo, calentamiento y
+    precálculo de los prefijos de sistema. El registro de modelos se publica (y
+    /ready pasa a 200) solo con el modelo caliente; la caché semántica y el
+    índice de conocimiento se construyen después porque son opcionales.
+    """
+    global model_registry, draft_model
+    try:
+        server_readiness.advance("carga_modelo")
+        model_instance, tokenizer_instance = load_initial_model()
+        startup_profile.mark("carga_modelo")
+        draft_model = load_draft_model(tokenizer_instance)
+
+        server_readiness.advance("calentamiento")
+        registry = ModelRegistry(
+            ModelRuntime(MODEL_ID, model_instance, tokenizer_instance, draft=draft_model),
+            memory_budget_bytes=int(MODEL_MEMORY_BUDGET_GB * 1024**3)
+        )
+        del model_instance, tokenizer_instance
+        registry.default().start()
+        registry.default().warmup()
+        startup_profile.mark("calentamiento")
+
+        model_registry = registry
+        server_readiness.set_ready()
+        logger.info(f"🚀 Arranque hasta el primer token: {startup_profile.snapshot()['total_s']:.1f}s "
+                    f"(estrategia de carga: {startup_profile.details.get('load_strategy')})")
+    except Exception as e:
+        logger.error(f"❌ Arranque fallido: {e}")
+        server_readiness.fail(e)
+        return
+
+    if SEMANTIC_CACHE_ENABLED:
+        build_semantic_cache()
+    if RAG_ENABLED:
+        build_knowledge_base()
+    build_chat_event_publisher()
+    if WORKER_QUEUE:
+        start_job_worker()
 
 # INICIALIZACIÓN PRINCIPAL
 if __name__ == "__main__":
     try:
-        public_url = initialize_ngrok()
+        # Iniciar servidor en hilo separado: escucha desde ya y /health informa del arranque
+        server_thread = Thread(target=run_server, daemon=True)
+        server_thread.start()
+
+        # URL del nodo: la configurada o, si no hay, la del túnel ngrok
+        public_url = NODE_URL or initialize_ngrok()
+
+        # Carga y calentamiento del modelo
+        bootstrap()
 
         if public_url:
-            # Registrar el nodo en el servidor central
+            # Registrar el nodo en el servidor central (espera a que esté listo)
             register_with_central_server(public_url)
+            if server_readiness.ready:
+                start_heartbeat(public_url)
         else:
-            logger.warning("⚠️  Usando servidor local sin Ngrok")
+            logger.warning("⚠️  Usando servidor local sin URL pública (ni node_url ni Ngrok)")
 
-        # Iniciar servidor en hilo separado
-        server_thread = Thread(target=run_server, daemon=True)
-        server_thread.start()
-        time.sleep(3)
+        if not server_readiness.ready:
+            raise RuntimeError(f"el modelo no se pudo cargar ({server_readiness.error})")
 
         print("\n" + "="*70)
         print("🚀 FOX-IA SERVER 4.1-4bit - ACTIVO Y OPERATIVO")
@@ -1134,26 +5767,39 @@ if __name__ == "__main__":
             print(f"🌐 URL Pública: {public_url}")
             print(f"📚 Documentación: {public_url}/docs")
         print(f"🔑 API Key: {API_KEY}")
-        print(f"🤖 Modelo: {MODEL_ID}")
-        print(f"⚡ Dispositivo: {model.device}")
-        print(f"💾 Quantization: 4-bit activada")
-        print(f"🎯 Estrategia: NF4 + Double Quantization")
-        print(f"📊 Memoria modelo: ~4-6GB (optimizado con 4-bit)")
+        print(f"🤖 Modelo: {model_registry.default().model_id}")
+        print(f"⚡ Dispositivo: {model_registry.default().model.device}")
+        print("💾 Quantization: 4-bit activada")
+        print("🎯 Estrategia: NF4 + Double Quantization")
+        print("📊 Memoria modelo: ~4-6GB (optimizado con 4-bit)")
         print(f"🏠 Registro central: {'✅ Conectado' if public_url else '❌ Local'}")
         print("\n🔧 Endpoints Disponibles:")
-        print(f"   • GET  /              - Estado del servidor")
-        print(f"   • GET  /health        - Health check completo")
-        print(f"   • POST /v1/chat/completions - Chat completions (estándar)")
-        print(f"   • POST /generar       - Generación simplificada")
-        print(f"   • POST /configurar    - Configuración del servidor")
+        print("   • GET  /              - Estado del servidor")
+        print("   • GET  /health        - Health check completo")
+        print("   • GET  /ready         - Disponibilidad (200 con el modelo caliente)")
+        print("   • GET  /metrics       - Métricas Prometheus (latencias por etapa)")
+        print("   • POST /v1/chat/completions - Chat completions (estándar)")
+        print("   • POST /generar       - Generación simplificada")
+        print("   • POST /v1/batch/completions - Lote de prompts en un solo batch")
+        print("   • DELETE /v1/requests/{id} - Cancelar una generación")
+        print("   • GET  /v1/models     - Modelos residentes")
+        print("   • GET/POST /v1/knowledge - Índice de tripletas (RAG)")
+        print("   • POST /configurar    - Configuración del servidor (carga/cambio de modelos)")
         print("\n🎯 Características:")
-        print(f"   • 4-bit quantization activa")
-        print(f"   • NF4 con double quantization")
-        print(f"   • Optimizado para Google Colab")
-        print(f"   • Streaming en tiempo real")
-        print(f"   • Autenticación por API Key")
-        print(f"   • Métricas del sistema en tiempo real")
-        print(f"   • Registro automático en servidor central")
+        print("   • 4-bit quantization activa")
+        print("   • NF4 con double quantization")
+        print("   • Optimizado para Google Colab")
+        print("   • Streaming en tiempo real")
+        print(f"   • Continuous batching (hasta {MAX_BATCH_SIZE} secuencias por paso)")
+        if draft_model is not None:
+            print(f"   • Decodificación especulativa con {DRAFT_MODEL_ID} ({SPECULATIVE_TOKENS} tokens)")
+        print("   • Autenticación por API Key")
+        print("   • Métricas del sistema en tiempo real")
+        print("   • Registro automático en servidor central")
+        if job_worker is not None:
+            print(f"   • Modo worker: trabajos de {WORKER_QUEUE.split('@')[-1]} ({job_worker.concurrency} en paralelo)")
+        if node_heartbeat is not None:
+            print(f"   • Latido con la carga del nodo cada {HEARTBEAT_INTERVAL_S:.0f}s")
         print("="*70)
         print("Presiona Ctrl+C para detener el servidor")
 
@@ -1163,7 +5809,10 @@ if __name__ == "__main__":
 
     except KeyboardInterrupt:
         print("\n🛑 Deteniendo servidor...")
+        if node_heartbeat is not None:
+            node_heartbeat.stop()
         try:
+            from pyngrok import ngrok
             ngrok.kill()
         except:
             pass
@@ -22,6 +22,15 @@ class AIController
                 "temperature" => (float)ConfigService::get('ai_temperature', 0.2),
                 "top_p" => (float)ConfigService::get('ai_top_p', 0.9),
                 "max_new_tokens" => (int)ConfigService::get('ai_max_new_tokens', 1024),
+                // Tokens máximos del bloque <think> antes de forzar la respuesta (0 = sin límite)
+                "reasoning_budget" => (int)ConfigService::get('ai_reasoning_budget', 512),
+                // Modo cola: Redis del que los nodos toman los trabajos de chat
+                "worker_queue" => ConfigService::get('ai_dispatch_mode', 'spawn') === 'queue'
+                    ? ConfigService::get('ai_worker_queue', '')
+                    : '',
+                // Tokens en vivo al canal del chat: en modo spawn y en modo cola
+                "chat_stream_redis" => ConfigService::get('ai_chat_stream_redis', '')
+                    ?: ConfigService::get('ai_worker_queue', ''),
                 // La clave API que el nodo Python debe usar para autenticarse
                 "api_key" => ConfigService::get('ai_service_api_key', 'foxia-default-key')
             ];
@@ -61,4 +70,34 @@ class AIController
              echo json_encode(['error' => 'Error del servidor: ' . $e->getMessage()]);
          }
      }
+
+    /**
+     * Recibe el latido periódico de un nodo de IA con su carga actual.
+     */
+    public function nodeHeartbeat()
+    {
+        header('Content-Type: application/json');
+        $input = json_decode(file_get_contents('php://input'), true);
+        $nodeUrl = $input['node_url'] ?? null;
+
+        if (empty($nodeUrl) || !filter_var($nodeUrl, FILTER_VALIDATE_URL)) {
+            http_response_code(400);
+            echo json_encode(['error' => 'URL de nodo no proporcionada o no válida']);
+            return;
+        }
+
+        try {
+            $aiService = new AIService();
+            if ($aiService->recordHeartbeat($nodeUrl, $input)) {
+                http_response_code(200);
+                echo json_encode(['message' => 'Latido registrado']);
+            } else {
+                http_response_code(500);
+                echo json_encode(['error' => 'Error al registrar el latido']);
+            }
+        } catch (Exception $e) {
+            http_response_code(500);
+            echo json_encode(['error' => 'Error del servidor: ' . $e->getMessage()]);
+        }
+    }
 }
@@ -799,17 +799,22 @@ class ChatController
             // =====================================================
             // 🤖 INTEGRACIÓN ASÍNCRONA CON IA
             // =====================================================
-            if ($chatType === 'ai') {
-                $launcherScriptPath = __DIR__ . '/../../bin/launch-ai-job.sh';
-                $debugLog = '/tmp/ai_launcher.log';
-                $args = "--chat_id=$chatId --message_id=$messageId";
-                $command = "bash $launcherScriptPath $args";
-                shell_exec("$command >> $debugLog 2>&1 &");
-                error_log("✅ AI-DEBUG: Comando SH disparado: " . $command);
+            // Modo 'queue': el trabajo se encola tras el commit (el historial ya incluye
+            // este mensaje) y lo toma el primer nodo libre
+            $queueAIJob = $chatType === 'ai' && $this->redis
+                && ConfigService::get('ai_dispatch_mode', 'spawn') === 'queue';
+
+            if ($chatType === 'ai' && !$queueAIJob) {
+                $this->launchAIJob($chatId, $messageId);
             }
 
             $this->db->commit();
 
+            if ($queueAIJob && !(new AIService())->enqueueJob($this->redis, $chatId, $messageId)) {
+                // Sin cola disponible: se procesa como siempre
+                $this->launchAIJob($chatId, $messageId);
+            }
+
             http_response_code(201);
             echo json_encode([
                 'message' => 'Mensaje enviado exitosamente',
@@ -1331,6 +1336,14 @@ class ChatController
         $stmt->execute();
     }
 
+    /**
+     * Lanza el procesador de IA en segundo plano para un mensaje (un proceso por trabajo)
+     */
+    private function launchAIJob(int $chatId, int $messageId): void
+    {
+        AIService::spawnJob($chatId, $messageId);
+    }
+
     private function createEnhancedNotifications(int $chatId, int $senderId, string $messageContent, string $chatTitle, bool $isReply = false, $replyingToMessage = null)
     {
         $queryRecipients = "SELECT user_id FROM chat_participants WHERE chat_id = :chat_id AND user_id != :sender_id";
@@ -0,0 +1,27 @@
+<?php
+// src/Middleware/NodeApiKeyMiddleware.php
+
+namespace Foxia\Middleware;
+
+use Foxia\Services\ConfigService;
+
+/**
+ * Autentica a los nodos de IA: deben enviar en `x-api-key` la misma clave que
+ * reciben en /api/ai/config (ai_service_api_key).
+ */
+class NodeApiKeyMiddleware
+{
+    public static function handle(): bool
+    {
+        $expected = (string)ConfigService::get('ai_service_api_key', '');
+        $provided = (string)($_SERVER['HTTP_X_API_KEY'] ?? '');
+
+        if ($expected === '' || $provided === '' || !hash_equals($expected, $provided)) {
+            error_log("❌ NodeApiKeyMiddleware: clave de nodo ausente o inválida desde " . ($_SERVER['REMOTE_ADDR'] ?? '?'));
+            http_response_code(401);
+            echo json_encode(['error' => 'Clave API de nodo inválida']);
+            return false;
+        }
+        return true;
+    }
+}
@@ -9,6 +9,16 @@ use Foxia\Config\Database;
 
 class AIService
 {
+    // Un nodo sin latido en este tiempo deja de contar como "con carga conocida"
+    private const HEARTBEAT_STALE_SECONDS = 60;
+
+    // Listas de Redis del modo cola: trabajos para los nodos y resultados de vuelta
+    public const JOBS_QUEUE_KEY = 'foxia:ai-jobs';
+    public const RESULTS_QUEUE_KEY = 'foxia:ai-results';
+    // Marca por mensaje del usuario ya respondido: descarta resultados duplicados
+    private const REPLIED_KEY_PREFIX = 'foxia:ai-replied:';
+    private const REPLIED_TTL_SECONDS = 86400;
+
     private $db;
 
     public function __construct()
@@ -36,6 +46,34 @@ class AIService
         }
     }
 
+    /**
+     * Guarda el latido de un nodo con su carga actual.
+     * No sondea al resto de nodos: llega cada pocos segundos desde cada nodo.
+     */
+    public function recordHeartbeat(string $url, array $report): bool
+    {
+        try {
+            $loadScore = isset($report['load_score']) && is_numeric($report['load_score'])
+                ? (string)(float)$report['load_score']
+                : null;
+            $sql = "INSERT INTO ai_nodes (node_url, is_active, last_health_check, model_id, load_score, node_stats, last_heartbeat)
+                    VALUES (:url, :active, NOW(), :model_id, :load_score, :stats, NOW())
+                    ON DUPLICATE KEY UPDATE
+                    is_active = VALUES(is_active), last_health_check = NOW(), model_id = VALUES(model_id),
+                    load_score = VALUES(load_score), node_stats = VALUES(node_stats), last_heartbeat = NOW()";
+            $stmt = $this->db->prepare($sql);
+            $stmt->bindValue(':url', $url, PDO::PARAM_STR);
+            $stmt->bindValue(':active', !empty($report['ready']) ? 1 : 0, PDO::PARAM_INT);
+            $stmt->bindValue(':model_id', $report['model_id'] ?? null, isset($report['model_id']) ? PDO::PARAM_STR : PDO::PARAM_NULL);
+            $stmt->bindValue(':load_score', $loadScore, $loadScore === null ? PDO::PARAM_NULL : PDO::PARAM_STR);
+            $stmt->bindValue(':stats', json_encode($report), PDO::PARAM_STR);
+            return $stmt->execute();
+        } catch (Exception $e) {
+            error_log("Error guardando latido de nodo de IA: " . $e->getMessage());
+            return false;
+        }
+    }
+
     /**
      * Limpia los nodos que ya no responden
      */
@@ -95,19 +133,39 @@ class AIService
     }
 
     /**
-     * Obtiene la URL de un nodo activo
+     * Obtiene la URL del nodo activo menos cargado.
+     * Primero los nodos con latido reciente ordenados por carga; los que no
+     * envían latido (o lo perdieron) quedan como respaldo, por último registro.
      */
     public function getActiveAINodeUrl(): ?string
     {
         try {
-            $sql = "SELECT node_url FROM ai_nodes
+            $sql = "SELECT id, node_url, load_score, node_stats FROM ai_nodes
                     WHERE is_active = 1
-                    ORDER BY last_health_check DESC
+                    ORDER BY (last_heartbeat IS NOT NULL
+                              AND last_heartbeat > DATE_SUB(NOW(), INTERVAL " . self::HEARTBEAT_STALE_SECONDS . " SECOND)) DESC,
+                             load_score IS NULL,
+                             load_score ASC,
+                             last_health_check DESC
                     LIMIT 1";
             $stmt = $this->db->prepare($sql);
             $stmt->execute();
             $result = $stmt->fetch(PDO::FETCH_ASSOC);
-            return $result ? $result['node_url'] : null;
+            if (!$result) {
+                return null;
+            }
+
+            // Hasta el próximo latido, cuenta la solicitud asignada para no mandar
+            // todas las que lleguen entretanto al mismo nodo
+            if ($result['load_score'] !== null) {
+                $stats = json_decode($result['node_stats'] ?? '', true);
+                $batchSize = max(1, (int)($stats['max_batch_size'] ?? 1));
+                $update = $this->db->prepare("UPDATE ai_nodes SET load_score = load_score + :step WHERE id = :id");
+                $update->bindValue(':step', (string)(1 / $batchSize), PDO::PARAM_STR);
+                $update->bindValue(':id', (int)$result['id'], PDO::PARAM_INT);
+                $update->execute();
+            }
+            return $result['node_url'];
         } catch (Exception $e) {
             error_log("Error obteniendo nodo activo: " . $e->getMessage());
             return null;
@@ -119,9 +177,11 @@ class AIService
      * AHORA ACEPTA HISTORIAL Y DEVUELVE UN ARRAY [content, tokens]
      *
      * @param array $chatHistory Historial de mensajes (formato OpenAI)
-     * @return array|null ['content' => ..., 'tokens' => ...] o null si falla
+     * @param string|null $chatUuid Si se indica, el nodo publica los tokens en vivo en el canal del chat
+     * @param int|null $chatId Chat de origen: el nodo añade sus tripletas de contexto (RAG)
+     * @return array|null ['content' => ..., 'tokens' => ..., 'stream_id' => ...] o null si falla
      */
-    public function generateResponse(array $chatHistory): ?array
+    public function generateResponse(array $chatHistory, ?string $chatUuid = null, ?int $chatId = null): ?array
     {
         try {
             $nodeUrl = $this->getActiveAINodeUrl();
@@ -153,7 +213,11 @@ class AIService
                 'stream' => false,
                 'max_tokens' => (int)ConfigService::get('ai_max_new_tokens', 3000),
                 'temperature' => (float)ConfigService::get('ai_temperature', 0.7),
-                'top_p' => (float)ConfigService::get('ai_top_p', 0.9)
+                'top_p' => (float)ConfigService::get('ai_top_p', 0.9),
+                'chat_uuid' => $chatUuid,
+                'chat_id' => $chatId,
+                // El razonamiento se descarta al guardar: que no llegue a los borradores en vivo
+                'include_reasoning' => false
             ]);
 
             $ch = curl_init();
@@ -197,7 +261,9 @@ class AIService
             // 4. Devolver un array con los datos parseados
             return [
                 'content' => $this->parseAIContent($rawContent),
-                'tokens' => (int)$totalTokens
+                'tokens' => (int)$totalTokens,
+                // Id del stream en vivo: el cliente sustituye el borrador por el mensaje guardado
+                'stream_id' => $responseData['id'] ?? null
             ];
 
             // =====================================================
@@ -213,6 +279,152 @@ class AIService
         }
     }
 
+    /**
+     * Obtiene el historial reciente de un chat para la IA
+     */
+    public function getChatHistory(int $chatId, int $limit = 10): array
+    {
+        $query = "SELECT user_id, content FROM messages
+                  WHERE chat_id = :chat_id AND deleted = FALSE AND message_type = 'text'
+                  ORDER BY created_at DESC LIMIT :limit";
+        $stmt = $this->db->prepare($query);
+        $stmt->execute([':chat_id' => $chatId, ':limit' => $limit]);
+        $messages = array_reverse($stmt->fetchAll(PDO::FETCH_ASSOC));
+
+        $history = [];
+        foreach ($messages as $msg) {
+            $history[] = [
+                'rol' => $msg['user_id'] ? 'user' : 'assistant',
+                'contenido' => $msg['content']
+            ];
+        }
+        return $history;
+    }
+
+    /**
+     * Encola un trabajo de chat para que lo tome el primer nodo libre (modo cola).
+     * El nodo devuelve el resultado en RESULTS_QUEUE_KEY con los mismos campos
+     * (chat_id, message_id...), que `ai-processor.php --consume` guarda y publica.
+     *
+     * @param object $redis Cliente Predis
+     * @return bool false si no se pudo encolar (el llamador puede lanzar el proceso clásico)
+     */
+    public function enqueueJob($redis, int $chatId, int $messageId): bool
+    {
+        try {
+            $history = $this->getChatHistory($chatId);
+            if (empty($history)) {
+                return false;
+            }
+            $uuidStmt = $this->db->prepare("SELECT uuid FROM chats WHERE id = ?");
+            $uuidStmt->execute([$chatId]);
+            $job = [
+                'chat_id' => $chatId,
+                'message_id' => $messageId,
+                // El nodo publica los tokens en vivo en el canal de este chat
+                'chat_uuid' => $uuidStmt->fetchColumn() ?: null,
+                'mensajes' => $history,
+                'max_tokens' => (int)ConfigService::get('ai_max_new_tokens', 3000),
+                'temperature' => (float)ConfigService::get('ai_temperature', 0.7),
+                'top_p' => (float)ConfigService::get('ai_top_p', 0.9),
+                'include_reasoning' => false,
+                'enqueued_at' => microtime(true)
+            ];
+            $redis->lpush(self::JOBS_QUEUE_KEY, [json_encode($job)]);
+            return true;
+        } catch (Exception $e) {
+            error_log("Error encolando trabajo de IA: " . $e->getMessage());
+            return false;
+        }
+    }
+
+    /**
+     * Lanza el proceso clásico (un ai-processor.php por mensaje) en segundo plano.
+     */
+    public static function spawnJob(int $chatId, int $messageId): void
+    {
+        $launcherScriptPath = __DIR__ . '/../../bin/launch-ai-job.sh';
+        $debugLog = '/tmp/ai_launcher.log';
+        $command = "bash $launcherScriptPath --chat_id=$chatId --message_id=$messageId";
+        shell_exec("$command >> $debugLog 2>&1 &");
+        error_log("✅ AI-DEBUG: Comando SH disparado: " . $command);
+    }
+
+    /**
+     * Saca de la cola los trabajos que ningún nodo tomó en ai_job_ttl_s segundos
+     * (no hay nodos en modo cola o están caídos) y los procesa en modo spawn.
+     * La cola se consume por la derecha, así que los más antiguos están al final.
+     * LREM es atómico: si un nodo se lleva el trabajo a la vez, no se duplica.
+     *
+     * @param object $redis Cliente Predis
+     * @return int Trabajos pasados a modo spawn
+     */
+    public function expireStaleJobs($redis): int
+    {
+        $ttl = (float)ConfigService::get('ai_job_ttl_s', 120);
+        if ($ttl <= 0) {
+            return 0;
+        }
+        $expired = 0;
+        while (($raw = $redis->lindex(self::JOBS_QUEUE_KEY, -1)) !== null) {
+            $job = json_decode($raw, true);
+            $enqueuedAt = is_array($job) ? (float)($job['enqueued_at'] ?? 0) : 0;
+            if ($enqueuedAt > 0 && microtime(true) - $enqueuedAt < $ttl) {
+                break;
+            }
+            if ($redis->lrem(self::JOBS_QUEUE_KEY, -1, $raw) > 0 && !empty($job['chat_id']) && !empty($job['message_id'])) {
+                error_log("⏰ Trabajo de IA sin nodo tras {$ttl}s (chat {$job['chat_id']}): se procesa en modo spawn");
+                self::spawnJob((int)$job['chat_id'], (int)$job['message_id']);
+                $expired++;
+            }
+        }
+        return $expired;
+    }
+
+    /**
+     * Reserva la respuesta a un mensaje del usuario (SET NX, atómico). Un trabajo
+     * devuelto a la cola por un nodo caído puede acabar respondido dos veces: solo
+     * el primer resultado se guarda.
+     *
+     * @param object $redis Cliente Predis
+     * @return bool false si el mensaje ya tiene respuesta
+     */
+    public function claimReply($redis, int $messageId): bool
+    {
+        return (bool)$redis->set(self::REPLIED_KEY_PREFIX . $messageId, time(), 'EX', self::REPLIED_TTL_SECONDS, 'NX');
+    }
+
+    /**
+     * Libera la reserva de claimReply() si la respuesta no se llegó a guardar.
+     *
+     * @param object $redis Cliente Predis
+     */
+    public function releaseReply($redis, int $messageId): void
+    {
+        $redis->del([self::REPLIED_KEY_PREFIX . $messageId]);
+    }
+
+    /**
+     * Convierte el resultado de un nodo en modo cola al formato de generateResponse.
+     *
+     * @return array ['content' => ..., 'tokens' => ...]
+     */
+    public function responseFromResult(array $result): array
+    {
+        if (($result['status'] ?? '') !== 'ok' || empty($result['content'])) {
+            error_log("Error generando respuesta de IA (cola): " . ($result['error'] ?? 'sin contenido'));
+            return [
+                'content' => "Lo siento, la IA no pudo generar una respuesta.",
+                'tokens' => 0
+            ];
+        }
+        return [
+            'content' => $this->parseAIContent($result['content']),
+            'tokens' => (int)($result['usage']['total_tokens'] ?? 0),
+            'stream_id' => $result['request_id'] ?? null
+        ];
+    }
+
     /**
      * NUEVO MÉTODO: Limpia las etiquetas <think> de la respuesta.
      */
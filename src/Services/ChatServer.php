@@ -230,6 +230,12 @@ class ChatServer implements MessageComponentInterface
      */
     public function processRedisMessage(array $redisData)
     {
+        // Tokens en vivo de la IA: se reenvían tal cual, sin registrar cada fragmento
+        if (in_array($redisData['type'] ?? null, ['ai_stream_delta', 'ai_stream_end'], true)) {
+            $this->handleAIStream($redisData);
+            return;
+        }
+
         error_log("📨 Mensaje Redis recibido: " . json_encode($redisData));
 
         // Validar estructura del mensaje
@@ -274,6 +280,7 @@ class ChatServer implements MessageComponentInterface
                 'avatar_url' => $redisData['sender_avatar_url'] ?? null
             ],
             'is_reply' => $isReply,
+            'stream_id' => $redisData['stream_id'] ?? null,
             'replying_to' => $isReply ? [
                 'message_uuid' => $redisData['replying_to_uuid'] ?? null,
                 'content' => $redisData['replied_content'] ?? 'Mensaje original',
@@ -296,6 +303,29 @@ class ChatServer implements MessageComponentInterface
         ]);
     }
 
+    /**
+     * Reenvía a los clientes del chat los fragmentos de la respuesta de la IA
+     * mientras se genera (ai_stream_delta) y su cierre (ai_stream_end)
+     */
+    private function handleAIStream(array $data)
+    {
+        if (!$this->validateRedisMessage($data)) {
+            return;
+        }
+
+        $this->broadcastToChat($data['chat_uuid'], json_encode([
+            'type' => $data['type'],
+            'chat_uuid' => $data['chat_uuid'],
+            'stream_id' => $data['stream_id'],
+            'seq' => $data['seq'] ?? null,
+            'delta' => $data['delta'] ?? null,
+            'content' => $data['content'] ?? null,
+            'finish_reason' => $data['finish_reason'] ?? null,
+            'error' => $data['error'] ?? null,
+            'timestamp' => $data['timestamp'] ?? date('Y-m-d H:i:s')
+        ]), null, false);
+    }
+
     /**
      * Manejar notificaciones en tiempo real
      */
@@ -388,6 +418,19 @@ class ChatServer implements MessageComponentInterface
                 }
                 break;
 
+            case 'ai_stream_delta':
+            case 'ai_stream_end':
+                $required = $message['type'] === 'ai_stream_delta'
+                    ? ['chat_uuid', 'stream_id', 'delta']
+                    : ['chat_uuid', 'stream_id'];
+                foreach ($required as $field) {
+                    if (!isset($message[$field])) {
+                        error_log("❌ ChatServer Validation Fail: Falta '$field' en {$message['type']}.");
+                        return false;
+                    }
+                }
+                break;
+
             case 'new_chat':
                 $required = ['chat_uuid', 'chat_type', 'participants'];
                 foreach ($required as $field) {
@@ -410,10 +453,12 @@ class ChatServer implements MessageComponentInterface
     /**
      * Broadcast a todos los clientes suscritos al chat
      */
-    private function broadcastToChat(string $chatUuid, string $message, ?int $excludeSenderId = null)
+    private function broadcastToChat(string $chatUuid, string $message, ?int $excludeSenderId = null, bool $verbose = true)
     {
         if (!isset($this->chatConnections[$chatUuid]) || empty($this->chatConnections[$chatUuid])) {
-            error_log("⚠️  No hay clientes suscritos al chat: {$chatUuid}");
+            if ($verbose) {
+                error_log("⚠️  No hay clientes suscritos al chat: {$chatUuid}");
+            }
             return;
         }
 
@@ -429,7 +474,9 @@ class ChatServer implements MessageComponentInterface
             try {
                 $client->send($message);
                 $sentCount++;
-                error_log("📤 Mensaje enviado a cliente {$client->resourceId} (usuario: {$client->userId})");
+                if ($verbose) {
+                    error_log("📤 Mensaje enviado a cliente {$client->resourceId} (usuario: {$client->userId})");
+                }
             } catch (Exception $e) {
                 $errorCount++;
                 error_log("❌ Error enviando a cliente {$client->resourceId}: {$e->getMessage()}");
@@ -437,7 +484,9 @@ class ChatServer implements MessageComponentInterface
             }
         }
 
-        error_log("✅ Mensaje enviado a {$sentCount} clientes en chat {$chatUuid}" . ($errorCount > 0 ? " ({$errorCount} errores)" : ""));
+        if ($verbose || $errorCount > 0) {
+            error_log("✅ Mensaje enviado a {$sentCount} clientes en chat {$chatUuid}" . ($errorCount > 0 ? " ({$errorCount} errores)" : ""));
+        }
     }
 
     /**
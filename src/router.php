@@ -24,6 +24,7 @@ use Foxia\Controllers\AdminController;
 use Foxia\Controllers\AIController;
 use Foxia\Middleware\AuthMiddleware;
 use Foxia\Middleware\AdminMiddleware;
+use Foxia\Middleware\NodeApiKeyMiddleware;
 use Foxia\Config\Database;
 use Foxia\Services\ConfigService;
 use Foxia\Services\CsrfService;
@@ -328,6 +329,11 @@ $routes = [
         '/api/ai/register-node' => function () {
             (new Foxia\Controllers\AIController())->registerNode();
         },
+        '/api/ai/node-heartbeat' => function () {
+            if (!NodeApiKeyMiddleware::handle())
+                return;
+            (new Foxia\Controllers\AIController())->nodeHeartbeat();
+        },
         '/api/admin/manage-user' => function () {
             if (!AdminMiddleware::handle())
                 return;
@@ -0,0 +1,204 @@
+# ==============================================================================
+# === PRUEBAS: CARGA DE server.py SIN DEPENDENCIAS PESADAS =====================
+# ==============================================================================
+#
+# server.py importa torch y transformers al cargar el módulo. Si están instalados se
+# usan los reales y las pruebas del planificador ejecutan un modelo diminuto en CPU;
+# si no, se sustituyen por módulos mínimos y esas pruebas se omiten. El resto
+# (fastapi, pydantic, numpy...) se usa de verdad; si falta, se sustituye igual.
+
+import importlib.util
+import os
+import sys
+import time
+import types
+import zlib
+
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+class _Anything:
+    """Objeto que acepta cualquier atributo, llamada o índice (tipos y funciones de torch)"""
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __call__(self, *args, **kwargs):
+        return _Anything()
+
+    def __getattr__(self, name):
+        return _Anything()
+
+    def __getitem__(self, key):
+        return _Anything()
+
+    def __bool__(self):
+        return False
+
+class _StubModule(types.ModuleType):
+    """Módulo cuyos atributos desconocidos son clases vacías instanciables"""
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        value = type(name, (_Anything,), {})
+        setattr(self, name, value)
+        return value
+
+def _no_grad(*args, **kwargs):
+    """Sustituto de torch.no_grad(): decorador identidad"""
+    def decorator(fn):
+        return fn
+    return decorator
+
+def _install_stub(name: str, **attrs):
+    module = _StubModule(name)
+    module.__path__ = []  # Permite importar submódulos (torch.nn...)
+    for key, value in attrs.items():
+        setattr(module, key, value)
+    sys.modules[name] = module
+    return module
+
+def _stub_if_missing(name: str, **attrs):
+    if importlib.util.find_spec(name) is None:
+        _install_stub(name, **attrs)
+
+# Pesados: los reales si están instalados (las pruebas del planificador ejecutan un
+# modelo diminuto en CPU); si falta alguno, módulos mínimos para el resto de pruebas
+REAL_TORCH = all(importlib.util.find_spec(name) is not None for name in ("torch", "transformers"))
+if not REAL_TORCH:
+    _torch = _install_stub("torch", no_grad=_no_grad, float16="float16", bfloat16="bfloat16", float32="float32")
+    _torch.cuda = _install_stub("torch.cuda", is_available=lambda: False, device_count=lambda: 0)
+    _torch.nn = _install_stub("torch.nn")
+    _install_stub("transformers")
+
+requires_torch = pytest.mark.skipif(not REAL_TORCH, reason="necesita torch y transformers reales")
+
+# Ligeros: solo si no están instalados
+# psutil sustituido devuelve números: el muestreador del sistema los redondea y compara
+_stub_if_missing("psutil", cpu_percent=lambda interval=None: 0.0,
+                 virtual_memory=lambda: types.SimpleNamespace(percent=0.0, total=0, available=0, used=0))
+_stub_if_missing("nest_asyncio", apply=lambda *a, **k: None)
+_stub_if_missing("uvicorn")
+if importlib.util.find_spec("sse_starlette") is None:
+    _install_stub("sse_starlette")
+    _install_stub("sse_starlette.sse")
+
+os.environ["FOXIA_REMOTE_CONFIG"] = "0"
+os.environ.setdefault("FOXIA_CACHE_DIR", os.path.join(ROOT, ".pytest_cache", "foxia"))
+
+def _load_server():
+    spec = importlib.util.spec_from_file_location("server", os.path.join(ROOT, "server.py"))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["server"] = module
+    spec.loader.exec_module(module)
+    return module
+
+@pytest.fixture(scope="session")
+def server():
+    """server.py cargado una vez, sin arrancar modelo ni planificador"""
+    return sys.modules.get("server") or _load_server()
+
+# ==============================================================================
+# === DOBLES DE PRUEBA ========================================================
+# ==============================================================================
+
+class FakeTokenizer:
+    """
+    Tokenizer de caracteres con plantilla tipo ChatML: cada carácter es un token,
+    salvo <think>/</think> (un token cada uno, como en los modelos R1).
+    Con `merge` fusiona ese par de caracteres en un token, como haría un BPE entre
+    mensajes, para comprobar la ruta de tokenización completa.
+    """
+
+    SPECIAL = {"<think>": 900001, "</think>": 900002}
+    eos_token_id = 0
+
+    def __init__(self, merge: str = None, generation_prompt: str = "<|im_start|>assistant\n"):
+        self.merge = merge
+        self.generation_prompt = generation_prompt
+        self.encoded = []  # Textos tokenizados, para contar el trabajo hecho
+
+    def apply_chat_template(self, messages, tokenize=False, add_generation_prompt=False):
+        text = "".join(f"<|im_start|>{m['role']}\n{m['content']}<|im_end|>\n" for m in messages)
+        if add_generation_prompt:
+            text += self.generation_prompt
+        return text
+
+    def encode(self, text, add_special_tokens=False):
+        self.encoded.append(text)
+        ids, position = [], 0
+        while position < len(text):
+            special = next((marker for marker in self.SPECIAL if text.startswith(marker, position)), None)
+            if special:
+                ids.append(self.SPECIAL[special])
+                position += len(special)
+            elif self.merge and text.startswith(self.merge, position):
+                ids.append(800000)
+                position += len(self.merge)
+            else:
+                ids.append(ord(text[position]))
+                position += 1
+        return ids
+
+    def __call__(self, text, add_special_tokens=True):
+        return {"input_ids": self.encode(text)}
+
+    def decode(self, ids, skip_special_tokens=True):
+        names = {value: key for key, value in self.SPECIAL.items()}
+        return "".join(names.get(i, chr(i) if i < 800000 else self.merge or "") for i in ids)
+
+class FakeModel:
+    """Solo lo que el motor consulta del modelo: la ventana de contexto"""
+
+    def __init__(self, max_position_embeddings: int = 4096):
+        self.config = types.SimpleNamespace(max_position_embeddings=max_position_embeddings)
+
+class FakeEmbedder:
+    """
+    Embedding pseudoaleatorio fijo por texto (como sentence-transformers, normalizado):
+    textos iguales dan similitud 1 y textos distintos quedan casi ortogonales.
+    `delay_s` simula un modelo lento.
+    """
+
+    dimension = 16
+
+    def __init__(self, delay_s: float = 0.0):
+        self.delay_s = delay_s
+
+    def get_sentence_embedding_dimension(self):
+        return self.dimension
+
+    def encode(self, texts, **kwargs):
+        if self.delay_s:
+            time.sleep(self.delay_s)
+        vectors = []
+        for text in texts:
+            rng = np.random.default_rng(zlib.crc32(text.encode()))
+            vector = rng.standard_normal(self.dimension)
+            vectors.append(vector / np.linalg.norm(vector))
+        return np.asarray(vectors, dtype="float32")
+
+def tiny_causal_lm(seed: int = 0, layers: int = 2, vocab_size: int = 128):
+    """
+    Llama diminuto con pesos aleatorios en CPU. Con `initializer_range` alto la atención
+    y las posiciones (RoPE) deciden el argmax, así que un error de relleno o de
+    position_ids cambia la salida.
+    """
+    import torch
+    from transformers import LlamaConfig, LlamaForCausalLM
+
+    torch.manual_seed(seed)
+    config = LlamaConfig(
+        vocab_size=vocab_size, hidden_size=32, intermediate_size=64, num_hidden_layers=layers,
+        num_attention_heads=4, num_key_value_heads=4, max_position_embeddings=256, initializer_range=0.3
+    )
+    return LlamaForCausalLM(config).eval()
+
+@pytest.fixture
+def engine(server):
+    return server.FoxiaGenerationEngine(FakeModel(), FakeTokenizer())
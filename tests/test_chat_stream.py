@@ -0,0 +1,68 @@
+# ==============================================================================
+# === PRUEBAS: TOKENS EN VIVO AL CANAL DEL CHAT ================================
+# ==============================================================================
+
+import json
+
+from conftest import FakeTokenizer
+
+def collect(publisher, mailbox):
+    """Cierra el publicador (vacía su cola) y devuelve los eventos recibidos"""
+    publisher.close()
+    return [json.loads(message) for message in mailbox]
+
+def test_deltas_arrive_in_order_before_final_event(server):
+    pubsub = server.MemoryPubSub()
+    mailbox = pubsub.subscribe("canal-chat")
+    publisher = server.ChatEventPublisher(pubsub, "canal-chat")
+    # Ventana de tiempo nula: cada trozo de texto sale en su propio delta
+    streamer = server.ChatChannelStreamer(FakeTokenizer(), publisher, "chat-uuid", "chatcmpl-1",
+                                          coalesce_ms=0, coalesce_tokens=64)
+
+    pieces = ["Ho", "la", " mu", "nd", "o"]
+    for index, piece in enumerate(pieces):
+        streamer.on_finalized_text(piece, stream_end=index == len(pieces) - 1)
+    streamer.finish("Hola mundo", "stop", {"completion_tokens": 5})
+
+    events = collect(publisher, mailbox)
+
+    deltas, final = events[:-1], events[-1]
+    assert [event["type"] for event in deltas] == ["ai_stream_delta"] * len(deltas)
+    assert [event["seq"] for event in deltas] == list(range(1, len(pieces) + 1))
+    assert "".join(event["delta"] for event in deltas) == "Hola mundo"
+    assert final["type"] == "ai_stream_end" and final["seq"] == deltas[-1]["seq"]
+    assert final["content"] == "Hola mundo" and final["chat_uuid"] == "chat-uuid"
+
+def test_final_event_survives_a_full_queue(server):
+    pubsub = server.MemoryPubSub()
+    mailbox = pubsub.subscribe("canal-chat")
+    publisher = server.ChatEventPublisher(pubsub, "canal-chat", max_pending=0)
+    streamer = server.ChatChannelStreamer(FakeTokenizer(), publisher, "chat-uuid", "chatcmpl-2", coalesce_tokens=1)
+
+    streamer.on_finalized_text("Hola", stream_end=True)
+    streamer.finish("Hola", "stop")
+
+    events = collect(publisher, mailbox)
+
+    assert [event["type"] for event in events] == ["ai_stream_end"]
+    assert publisher.stats["dropped"] == 1
+
+def test_publisher_is_built_without_worker_queue(server, monkeypatch):
+    # Modo spawn: sin cola de trabajos, el canal llega por chat_stream_redis
+    monkeypatch.setattr(server, "WORKER_QUEUE", "")
+    monkeypatch.setattr(server, "CHAT_STREAM_REDIS", "memory://")
+    monkeypatch.setattr(server, "chat_event_publisher", None)
+
+    server.build_chat_event_publisher()
+
+    assert isinstance(server.chat_event_publisher.client, server.MemoryPubSub)
+    server.chat_event_publisher.close()
+
+def test_no_publisher_without_any_redis(server, monkeypatch):
+    monkeypatch.setattr(server, "WORKER_QUEUE", "")
+    monkeypatch.setattr(server, "CHAT_STREAM_REDIS", "")
+    monkeypatch.setattr(server, "chat_event_publisher", None)
+
+    server.build_chat_event_publisher()
+
+    assert server.chat_event_publisher is None
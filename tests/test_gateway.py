@@ -0,0 +1,120 @@
+# ==============================================================================
+# === PRUEBAS: GATEWAY ENTRE NODOS =============================================
+# ==============================================================================
+
+import asyncio
+
+import pytest
+
+httpx = pytest.importorskip("httpx")
+gateway_module = pytest.importorskip("gateway")
+
+class FakeNode:
+    """Nodo simulado con httpx.MockTransport: registra lo que recibe"""
+
+    def __init__(self, name: str, delay_s: float = 0.0, stream: bool = False):
+        self.name = name
+        self.delay_s = delay_s
+        self.stream = stream
+        self.posts = []
+        self.deletes = []
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        if request.method == "DELETE":
+            self.deletes.append(request.url.path.rsplit("/", 1)[-1])
+            return httpx.Response(200, json={"cancelled": True})
+        self.posts.append(request.headers.get("x-request-id"))
+        await asyncio.sleep(self.delay_s)
+        headers = {"x-request-id": request.headers.get("x-request-id", "")}
+        if self.stream:
+            return httpx.Response(200, headers={**headers, "content-type": "text/event-stream"},
+                                  content=b"data: {}\n\ndata: [DONE]\n\n")
+        return httpx.Response(200, headers=headers, json={"node": self.name})
+
+    def node(self) -> "gateway_module.Node":
+        node = gateway_module.Node(f"http://{self.name}", "clave", 4, 10.0)
+        node.client = httpx.AsyncClient(base_url=node.url, transport=httpx.MockTransport(self.handle))
+        node.healthy = True
+        return node
+
+def make_gateway(nodes, hedge_after_s=0.0):
+    return gateway_module.Gateway(
+        nodes, affinity_slack=4096, affinity_ttl_s=60, affinity_max_entries=100,
+        hedge_after_s=hedge_after_s, hedge_min_s=0.0, hedge_budget=1.0, health_interval_s=5
+    )
+
+BODY = {"mensajes": [{"rol": "user", "contenido": "hola"}], "max_tokens": 16}
+
+def test_request_id_is_forwarded_to_node():
+    fake = FakeNode("a")
+    gateway = make_gateway([fake.node()])
+
+    response = asyncio.run(gateway.forward("/v1/chat/completions", dict(BODY), "chatcmpl-cliente"))
+
+    assert fake.posts == ["chatcmpl-cliente"]
+    assert response.headers["x-request-id"] == "chatcmpl-cliente"
+    assert gateway.request_nodes == {}
+
+def test_losing_hedge_is_cancelled_on_its_node():
+    slow, fast = FakeNode("lento", delay_s=1.0), FakeNode("rapido")
+    gateway = make_gateway([slow.node(), fast.node()], hedge_after_s=0.05)
+    gateway.nodes[1].outstanding_tokens = 10  # El primer intento va al lento
+
+    async def run():
+        response = await gateway.forward("/v1/chat/completions", dict(BODY), "chatcmpl-h")
+        await asyncio.sleep(0.05)  # Deja correr la cancelación en segundo plano
+        return response
+
+    response = asyncio.run(run())
+
+    assert response.headers["X-Foxia-Node"] == "http://rapido"
+    assert slow.deletes == ["chatcmpl-h"] and fast.deletes == []
+    assert gateway.stats["hedge_wins"] == 1
+
+def test_stream_releases_tokens_when_iteration_never_starts():
+    fake = FakeNode("a", stream=True)
+    gateway = make_gateway([fake.node()])
+    node = gateway.nodes[0]
+
+    async def run():
+        response = await gateway.forward_stream("/v1/chat/completions", {**BODY, "stream": True}, "chatcmpl-s")
+        assert node.outstanding_tokens > 0
+        # El cliente se va antes del primer chunk: solo queda la tarea de fondo
+        await response.background()
+        await response.background()  # Idempotente
+        await asyncio.sleep(0.05)
+
+    asyncio.run(run())
+
+    assert node.outstanding_tokens == 0 and node.in_flight == 0
+    assert fake.deletes == ["chatcmpl-s"]
+
+def test_affinity_key_includes_system_prompt_and_conversation():
+    messages = [{"rol": "user", "contenido": "hola"}]
+    with_system = [{"rol": "system", "contenido": "Eres un pirata"}] + messages
+    key = gateway_module.affinity_key
+
+    assert key({"mensajes": messages}) != key({"mensajes": with_system})
+    assert key({"mensajes": messages, "chat_id": 1}) != key({"mensajes": messages, "chat_id": 2})
+    assert key({"mensajes": with_system, "chat_id": 1}) != key({"mensajes": messages, "chat_id": 1})
+    assert key({"mensajes": messages + [{"rol": "assistant", "contenido": "¿qué tal?"}]}) == key({"mensajes": messages})
+    assert key({}) is None
+
+def test_client_disconnect_cancels_generation_on_node():
+    slow = FakeNode("lento", delay_s=1.0)
+    gateway = make_gateway([slow.node()])
+
+    class GoneClient:
+        async def is_disconnected(self):
+            return True
+
+    async def run():
+        response = await gateway.forward("/v1/chat/completions", dict(BODY), "chatcmpl-d", GoneClient())
+        await asyncio.sleep(0.05)
+        return response
+
+    response = asyncio.run(run())
+
+    assert response.status_code == gateway_module.CLIENT_CLOSED_STATUS
+    assert slow.deletes == ["chatcmpl-d"]
+    assert gateway.nodes[0].outstanding_tokens == 0
@@ -0,0 +1,95 @@
+# ==============================================================================
+# === PRUEBAS: LATIDO AL SERVIDOR CENTRAL ======================================
+# ==============================================================================
+
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+class StubRegistry:
+    """
+    Servidor central mínimo: acepta latidos en /api/ai/node-heartbeat solo con la
+    clave correcta (como NodeApiKeyMiddleware) y guarda los nodos como ai_nodes.
+    """
+
+    def __init__(self, api_key: str = "clave-nodo", status: int = 200):
+        self.api_key = api_key
+        self.status = status
+        self.nodes = {}
+        self.rejected = 0
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                if self.path != "/api/ai/node-heartbeat" or self.headers.get("x-api-key") != registry.api_key:
+                    registry.rejected += 1
+                    code = 401
+                else:
+                    code = registry.status
+                    if code == 200:
+                        registry.nodes[body["node_url"]] = {
+                            "is_active": bool(body["ready"]),
+                            "model_id": body["model_id"],
+                            "load_score": body["load_score"]
+                        }
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.end_headers()
+                self.wfile.write(b"{}")
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.endpoint = f"http://127.0.0.1:{self.httpd.server_port}/api/ai/node-heartbeat"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+@pytest.fixture
+def registry():
+    stub = StubRegistry()
+    yield stub
+    stub.close()
+
+def test_heartbeat_endpoint_comes_from_config(server):
+    assert "heartbeat_endpoint" in server.DEFAULT_CONFIG
+    assert server.HEARTBEAT_ENDPOINT == server.DEFAULT_CONFIG["heartbeat_endpoint"]
+
+def test_heartbeat_registers_node_load(server, registry):
+    heartbeat = server.NodeHeartbeat(registry.endpoint, "https://nodo.example", 10, 60, api_key="clave-nodo")
+
+    assert heartbeat.beat()
+    assert registry.nodes["https://nodo.example"]["load_score"] is None
+    assert heartbeat.stats["sent"] == 1
+
+    heartbeat.stop()
+    assert registry.nodes["https://nodo.example"]["is_active"] is False
+
+def test_heartbeat_with_wrong_key_is_rejected_and_backs_off(server, registry):
+    heartbeat = server.NodeHeartbeat(registry.endpoint, "https://nodo.example", 10, 60, api_key="otra")
+
+    assert not heartbeat.beat()
+    assert not heartbeat.beat()
+
+    assert registry.rejected == 2 and not registry.nodes
+    assert heartbeat.failures == 2
+    assert 10 * 4 * 0.8 <= heartbeat.next_delay() <= 60 * 1.2
+    heartbeat.session.close()
+
+def test_heartbeat_recovers_after_registry_errors(server):
+    stub = StubRegistry(status=503)
+    try:
+        heartbeat = server.NodeHeartbeat(stub.endpoint, "https://nodo.example", 10, 60, api_key="clave-nodo")
+        assert not heartbeat.beat()
+        stub.status = 200
+        assert heartbeat.beat()
+        assert heartbeat.failures == 0 and heartbeat.next_delay() == 10
+        assert "https://nodo.example" in stub.nodes
+    finally:
+        stub.close()
@@ -0,0 +1,263 @@
+# ==============================================================================
+# === PRUEBAS: COLA DE TRABAJOS (MODO WORKER) ==================================
+# ==============================================================================
+
+import asyncio
+import json
+import sqlite3
+import time
+
+import pytest
+
+@pytest.fixture
+def queue_path(tmp_path):
+    return str(tmp_path / "jobs.db")
+
+def job_status(path, job_id):
+    connection = sqlite3.connect(path)
+    try:
+        return connection.execute("SELECT status, worker FROM ai_jobs WHERE id = ?", (job_id,)).fetchone()
+    finally:
+        connection.close()
+
+def results(path):
+    connection = sqlite3.connect(path)
+    try:
+        return [json.loads(row[0]) for row in connection.execute("SELECT payload FROM ai_results ORDER BY id")]
+    finally:
+        connection.close()
+
+def test_claim_and_complete(server, queue_path):
+    queue = server.SqliteJobQueue(queue_path, "nodo-a")
+    first = queue.enqueue({"chat_id": 1})
+    second = queue.enqueue({"chat_id": 2})
+
+    claimed = queue.claim(max_jobs=1, timeout_s=0)
+
+    assert [handle for handle, _ in claimed] == [first]
+    assert job_status(queue_path, first) == ("processing", "nodo-a")
+    assert job_status(queue_path, second) == ("pending", None)
+
+    queue.complete(first, {"chat_id": 1, "status": "ok"})
+
+    assert job_status(queue_path, first)[0] == "done"
+    assert results(queue_path) == [{"chat_id": 1, "status": "ok"}]
+    queue.close()
+
+def test_restarted_worker_recovers_its_jobs(server, queue_path):
+    queue = server.SqliteJobQueue(queue_path, "nodo-a")
+    job_id = queue.enqueue({"chat_id": 1})
+    queue.claim(max_jobs=4, timeout_s=0)
+    queue.close()  # El nodo muere con el trabajo a medias
+
+    restarted = server.SqliteJobQueue(queue_path, "nodo-a")
+
+    assert restarted.recover() == 1
+    assert job_status(queue_path, job_id) == ("pending", None)
+    assert [handle for handle, _ in restarted.claim(4, 0)] == [job_id]
+    restarted.close()
+
+def test_crashed_worker_jobs_are_reaped_by_another_worker(server, queue_path):
+    crashed = server.SqliteJobQueue(queue_path, "colab-sesion-1", visibility_timeout_s=0.05)
+    job_id = crashed.enqueue({"chat_id": 1})
+    crashed.claim(max_jobs=1, timeout_s=0)
+    crashed.close()
+
+    # La sesión siguiente arranca con otro nombre de host: recover() no lo encuentra
+    survivor = server.SqliteJobQueue(queue_path, "colab-sesion-2", visibility_timeout_s=0.05)
+    assert survivor.recover() == 0
+
+    time.sleep(0.1)
+    assert survivor.reap() == 1
+
+    assert job_status(queue_path, job_id) == ("pending", None)
+    assert [handle for handle, _ in survivor.claim(1, 0)] == [job_id]
+    survivor.close()
+
+def test_heartbeat_keeps_long_jobs_claimed(server, queue_path):
+    worker = server.SqliteJobQueue(queue_path, "nodo-a", visibility_timeout_s=0.2)
+    other = server.SqliteJobQueue(queue_path, "nodo-b", visibility_timeout_s=0.2)
+    job_id = worker.enqueue({"chat_id": 1})
+    worker.claim(1, 0)
+
+    for _ in range(3):
+        time.sleep(0.1)
+        worker.heartbeat()
+        assert other.reap() == 0
+
+    assert job_status(queue_path, job_id) == ("processing", "nodo-a")
+    worker.close()
+    other.close()
+
+def test_failed_complete_rolls_back(server, queue_path):
+    queue = server.SqliteJobQueue(queue_path, "nodo-a")
+    job_id = queue.enqueue({"chat_id": 1})
+    queue.claim(1, 0)
+    # El resultado se escribe tras marcar el estado: sin su tabla, falla a mitad de transacción
+    queue._connection.execute("ALTER TABLE ai_results RENAME TO ai_results_old")
+
+    with pytest.raises(sqlite3.Error):
+        queue.complete(job_id, {"chat_id": 1})
+
+    # La transacción no quedó abierta: la conexión sigue usable y el trabajo no se marcó
+    queue._connection.execute("ALTER TABLE ai_results_old RENAME TO ai_results")
+    assert job_status(queue_path, job_id)[0] == "processing"
+    queue.enqueue({"chat_id": 2})
+    assert len(queue.claim(4, 0)) == 1
+    queue.complete(job_id, {"chat_id": 1})
+    assert job_status(queue_path, job_id)[0] == "done"
+    queue.close()
+
+def test_complete_after_reap_is_discarded(server, queue_path):
+    slow = server.SqliteJobQueue(queue_path, "nodo-lento", visibility_timeout_s=0.05)
+    other = server.SqliteJobQueue(queue_path, "nodo-b", visibility_timeout_s=0.05)
+    job_id = slow.enqueue({"chat_id": 1})
+    slow.claim(1, 0)
+    time.sleep(0.1)  # Sin latido: la concesión caduca y el otro nodo lo reclama
+    assert other.reap() == 1
+    other.claim(1, 0)
+
+    assert not slow.complete(job_id, {"chat_id": 1, "content": "tarde"})
+    assert not slow.release(job_id)
+    assert other.complete(job_id, {"chat_id": 1, "content": "a tiempo"})
+
+    assert [result["content"] for result in results(queue_path)] == ["a tiempo"]
+    slow.close()
+    other.close()
+
+# --- Redis (fakeredis) ---------------------------------------------------------
+
+@pytest.fixture
+def redis_queue(server, monkeypatch):
+    """Fábrica de RedisJobQueue contra un Redis en memoria compartido por los workers"""
+    fakeredis = pytest.importorskip("fakeredis")
+    pytest.importorskip("lupa")  # complete/release son scripts Lua
+    import redis
+
+    redis_server = fakeredis.FakeServer()
+    monkeypatch.setattr(redis.Redis, "from_url", lambda url, **kwargs: fakeredis.FakeRedis(server=redis_server, decode_responses=True))
+
+    queues = []
+    def make(worker_id, visibility_timeout_s=120.0):
+        queue = server.RedisJobQueue("redis://fake", "foxia:ai-jobs", "foxia:ai-results", worker_id, visibility_timeout_s)
+        queues.append(queue)
+        return queue
+    yield make
+    for queue in queues:
+        queue.close()
+
+def push_jobs(queue, *chat_ids):
+    """LPUSH como el servidor central (AIService::enqueueJob)"""
+    for chat_id in chat_ids:
+        queue.client.lpush(queue.jobs_key, json.dumps({"chat_id": chat_id}))
+
+def claimed_chats(claimed):
+    return [json.loads(raw)["chat_id"] for _, raw in claimed]
+
+def redis_results(queue):
+    return [json.loads(raw) for raw in reversed(queue.client.lrange(queue.results_key, 0, -1))]
+
+def test_redis_claim_and_complete(redis_queue):
+    queue = redis_queue("nodo-a")
+    push_jobs(queue, 1, 2, 3)
+
+    claimed = queue.claim(max_jobs=2, timeout_s=0)
+
+    assert claimed_chats(claimed) == [1, 2]
+    assert queue.client.llen(queue.processing_key) == 2
+    assert queue.complete(claimed[0][0], {"chat_id": 1, "status": "ok"})
+    assert redis_results(queue) == [{"chat_id": 1, "status": "ok"}]
+    assert queue.client.lrange(queue.processing_key, 0, -1) == [claimed[1][0]]
+
+def test_redis_crashed_worker_jobs_are_reaped_and_late_result_discarded(redis_queue):
+    slow = redis_queue("colab-sesion-1", visibility_timeout_s=0.05)
+    survivor = redis_queue("colab-sesion-2", visibility_timeout_s=0.05)
+    push_jobs(slow, 1)
+    slow.heartbeat()
+    (handle, _), = slow.claim(1, 0)
+
+    survivor.heartbeat()
+    assert survivor.reap() == 0  # Concesión vigente
+    time.sleep(0.1)
+    survivor.heartbeat()
+    assert survivor.reap() == 1
+    assert slow.client.zscore(slow.leases_key, "colab-sesion-1") is None
+
+    # El nodo lento termina tarde: su resultado no se publica ni duplica el trabajo
+    assert not slow.complete(handle, {"chat_id": 1, "content": "tarde"})
+    assert not slow.release(handle)
+    assert slow.client.llen(slow.jobs_key) == 1
+
+    claimed = survivor.claim(1, 0)
+    assert claimed_chats(claimed) == [1]
+    assert survivor.complete(claimed[0][0], {"chat_id": 1, "content": "a tiempo"})
+    assert [result["content"] for result in redis_results(survivor)] == ["a tiempo"]
+
+def test_redis_heartbeat_keeps_long_jobs_claimed(redis_queue):
+    worker = redis_queue("nodo-a", visibility_timeout_s=0.2)
+    other = redis_queue("nodo-b", visibility_timeout_s=0.2)
+    push_jobs(worker, 1)
+    worker.heartbeat()
+    worker.claim(1, 0)
+
+    for _ in range(3):
+        time.sleep(0.1)
+        worker.heartbeat()
+        assert other.reap() == 0
+
+    assert worker.client.llen(worker.processing_key) == 1
+
+def test_redis_release_puts_job_back_first(redis_queue):
+    queue = redis_queue("nodo-a")
+    push_jobs(queue, 1, 2)
+    (handle, _), = queue.claim(1, 0)
+
+    assert queue.release(handle)
+
+    assert queue.client.llen(queue.processing_key) == 0
+    assert claimed_chats(queue.claim(2, 0)) == [1, 2]
+
+def test_redis_restarted_worker_recovers_its_jobs_in_order(redis_queue):
+    queue = redis_queue("nodo-a")
+    push_jobs(queue, 1, 2, 3)
+    queue.claim(2, 0)  # El nodo muere con dos trabajos a medias
+
+    restarted = redis_queue("nodo-a")
+
+    assert restarted.recover() == 2
+    assert claimed_chats(restarted.claim(3, 0)) == [1, 2, 3]
+
+def make_worker(server, queue, outcomes):
+    """JobWorker con `execute` simulado: no hace falta modelo ni planificador"""
+    class Worker(server.JobWorker):
+        async def execute(self, job):
+            outcome = outcomes[job["chat_id"]]
+            if isinstance(outcome, Exception):
+                raise outcome
+            return {"status": "ok", "content": outcome}
+    return Worker(queue, concurrency=2, lease_interval_s=1.0)
+
+def test_worker_processes_jobs_and_requeues_when_saturated(server, queue_path):
+    queue = server.SqliteJobQueue(queue_path, "nodo-a")
+    ok_id = queue.enqueue({"chat_id": 1, "message_id": 10, "mensajes": [{"rol": "user", "contenido": "hola"}]})
+    busy_id = queue.enqueue({"chat_id": 2, "message_id": 20, "mensajes": []})
+    worker = make_worker(server, queue, {1: "¡Hola!", 2: server.RequeueJob("cola llena", retry_after=0)})
+
+    async def run():
+        task = asyncio.create_task(worker.run())
+        for _ in range(100):
+            await asyncio.sleep(0.02)
+            if worker.stats["completed"] and worker.stats["requeued"]:
+                break
+        worker.stop()
+        await asyncio.wait_for(task, timeout=3)
+
+    asyncio.run(run())
+
+    published = results(queue_path)
+    assert published[0]["message_id"] == 10 and published[0]["content"] == "¡Hola!"
+    assert "mensajes" not in published[0]
+    assert job_status(queue_path, ok_id)[0] == "done"
+    assert worker.stats["requeued"] >= 1
+    assert job_status(queue_path, busy_id)[0] in ("pending", "processing")
+    queue.close()
@@ -0,0 +1,154 @@
+# ==============================================================================
+# === PRUEBAS: CONOCIMIENTO (RAG) ==============================================
+# ==============================================================================
+
+import asyncio
+import json
+import os
+import sqlite3
+
+import pytest
+
+from conftest import FakeEmbedder
+
+pytest.importorskip("faiss")
+
+FIXTURE = os.path.join(os.path.dirname(__file__), "fixtures", "knowledge.json")
+
+def make_index(server, embedder=None, min_score=0.9, timeout_s=1.0):
+    return server.KnowledgeIndex(embedder or FakeEmbedder(), top_k=3, min_score=min_score,
+                                 timeout_s=timeout_s, ivf_threshold=20000)
+
+def make_request(server, text, **fields):
+    return server.ChatCompletionRequest(mensajes=[{"rol": "user", "contenido": text}], **fields)
+
+def sqlite_fixture(path):
+    """Base SQLite con las tablas de foxia.sql cargada desde el fixture JSON"""
+    with open(FIXTURE, encoding="utf-8") as f:
+        data = json.load(f)
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE global_knowledge_triplets (id INTEGER PRIMARY KEY, subject TEXT, predicate TEXT, "
+                       "object TEXT, category TEXT, description TEXT, is_active INTEGER, updated_at TEXT)")
+    connection.execute("CREATE TABLE chat_context_triplets (id INTEGER PRIMARY KEY, chat_id INTEGER, subject TEXT, "
+                       "predicate TEXT, object TEXT, confidence_score REAL, created_at TEXT, expires_at TEXT)")
+    for table in ("global_knowledge_triplets", "chat_context_triplets"):
+        for row in data[table]:
+            columns = ", ".join(row)
+            connection.execute(f"INSERT INTO {table} ({columns}) VALUES ({', '.join('?' * len(row))})", list(row.values()))
+    connection.commit()
+    connection.close()
+
+def test_json_source_indexes_active_triplets(server):
+    index = make_index(server)
+    source = server.triplet_source(FIXTURE)
+
+    assert server.refresh_knowledge(index, source)
+
+    assert sorted(index.global_triplets) == [1, 2]
+    assert [t["object"] for t in index.retrieve("fox-ia es un asistente de chat")] == ["un asistente de chat"]
+    # Sin cambios en el fichero no se vuelve a indexar
+    assert not server.refresh_knowledge(index, source)
+
+def test_sqlite_source_is_incremental_and_detects_deletes(server, tmp_path):
+    path = str(tmp_path / "knowledge.db")
+    sqlite_fixture(path)
+    index = make_index(server)
+    source = server.triplet_source(path)
+
+    server.refresh_knowledge(index, source)
+    version = index.version
+    assert sorted(index.context_triplets) == [10, 11]
+    assert index.retrieve("el proyecto se llama atlas", chat_id=1)[0]["object"] == "atlas"
+    assert index.retrieve("el proyecto se llama atlas", chat_id=2) == []
+
+    connection = sqlite3.connect(path)
+    connection.execute("DELETE FROM global_knowledge_triplets WHERE id = 2")
+    connection.commit()
+    connection.close()
+
+    assert server.refresh_knowledge(index, source)
+    assert sorted(index.global_triplets) == [1]
+    assert index.version > version
+    assert not server.refresh_knowledge(index, source)
+
+def test_retrieve_gives_up_on_timeout(server):
+    index = make_index(server, FakeEmbedder(delay_s=0.2), timeout_s=0.01)
+
+    assert index.retrieve("consulta lenta") == []
+    assert index.stats["timeouts"] == 1
+
+def test_retrieve_drops_queries_when_busy(server):
+    index = make_index(server)
+    index._pending = index._max_pending
+
+    assert index.retrieve("fox-ia es un asistente de chat") == []
+    assert index.stats["busy"] == 1
+    assert index._executor._work_queue.qsize() == 0
+
+def test_chats_with_different_context_get_different_answers(server, engine, monkeypatch):
+    index = make_index(server, min_score=-1.0)
+    server.refresh_knowledge(index, server.triplet_source(FIXTURE))
+    monkeypatch.setattr(server, "knowledge_base", index)
+    cache = server.SemanticResponseCache(FakeEmbedder(), threshold=0.9, ttl_s=60, max_entries=16, max_user_turns=2)
+    monkeypatch.setattr(server, "semantic_cache", cache)
+    question = "¿Cómo se llama el proyecto?"
+
+    prompts = {}
+    for chat_id in (1, 2):
+        input_ids, _ = engine.build_prompt(make_request(server, question).messages, 64, chat_id=chat_id)
+        prompts[chat_id] = engine.tokenizer.decode(input_ids)
+    assert "atlas" in prompts[1] and "boreal" not in prompts[1]
+    assert "boreal" in prompts[2] and "atlas" not in prompts[2]
+
+    async def answer(chat_id, content):
+        request = make_request(server, question, chat_id=chat_id)
+        cached = await server.lookup_semantic_cache(request)
+        if cached is not None:
+            return cached["content"]
+        pending = server.store_semantic_cache(request, content, {"total_tokens": 1})
+        if pending is not None:
+            await pending
+        return content
+
+    assert asyncio.run(answer(1, "Se llama atlas.")) == "Se llama atlas."
+    assert asyncio.run(answer(2, "Se llama boreal.")) == "Se llama boreal."
+    assert cache.stats["stores"] == 0
+
+def test_knowledge_update_invalidates_semantic_cache(server, monkeypatch):
+    index = make_index(server)
+    monkeypatch.setattr(server, "knowledge_base", index)
+    cache = server.SemanticResponseCache(FakeEmbedder(), threshold=0.9, ttl_s=60, max_entries=16, max_user_turns=2)
+    monkeypatch.setattr(server, "semantic_cache", cache)
+    request = make_request(server, "¿Qué es FoxIA?")
+
+    async def store():
+        await server.store_semantic_cache(request, "Un asistente.", {"total_tokens": 1})
+    asyncio.run(store())
+    assert asyncio.run(server.lookup_semantic_cache(request)) is not None
+
+    server.refresh_knowledge(index, server.triplet_source(FIXTURE))
+
+    assert asyncio.run(server.lookup_semantic_cache(request)) is None
+
+def test_next_turn_reuses_the_previous_prompt_with_rag(server, engine, monkeypatch):
+    index = make_index(server)
+    server.refresh_knowledge(index, server.triplet_source(FIXTURE))
+    monkeypatch.setattr(server, "knowledge_base", index)
+    history = [server.Message(rol="user", contenido="Hola"), server.Message(rol="assistant", contenido="¡Hola!")]
+    # Cada pregunta recupera una tripleta distinta: el conocimiento cambia entre turnos
+    turn = history + [server.Message(rol="user", contenido="fox-ia es un asistente de chat")]
+    next_turn = turn + [
+        server.Message(rol="assistant", contenido="Sí."),
+        server.Message(rol="user", contenido="el soporte atiende de lunes a viernes. horario de 9 a 18"),
+    ]
+
+    first, _ = engine.build_prompt(turn, 64)
+    second, _ = engine.build_prompt(next_turn, 64)
+
+    assert "- fox-ia es un asistente de chat" in engine.tokenizer.decode(first)
+    assert "lunes a viernes (horario" in engine.tokenizer.decode(second)
+    shared = 0
+    while shared < min(len(first), len(second)) and first[shared] == second[shared]:
+        shared += 1
+    # La caché de prefijos reutiliza cabecera e historial; solo se recalcula el último turno
+    assert shared >= len(engine.prompt_ids(history)) - len(engine._generation_prompt_ids())
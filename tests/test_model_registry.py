@@ -0,0 +1,59 @@
+# ==============================================================================
+# === PRUEBAS: REGISTRO DE MODELOS =============================================
+# ==============================================================================
+
+import time
+
+class FakeRuntime:
+    """Runtime sin modelo: solo id, huella de memoria y solicitudes en curso"""
+
+    def __init__(self, model_id: str, gigabytes: int):
+        self.model_id = model_id
+        self.footprint_bytes = gigabytes * 1024**3
+        self.released = False
+        self.reserved = 0
+
+    def reserve(self):
+        self.reserved += 1
+
+    def unreserve(self):
+        self.reserved -= 1
+
+    def in_flight(self):
+        return self.reserved
+
+    def release(self):
+        self.released = True
+
+def test_eviction_keeps_default_and_new_model(server):
+    registry = server.ModelRegistry(FakeRuntime("base", 4), memory_budget_bytes=10 * 1024**3)
+    registry.runtimes["old"] = FakeRuntime("old", 3)
+    registry.runtimes["new"] = FakeRuntime("new", 5)
+
+    registry._evict_over_budget(keep="new")
+
+    assert list(registry.runtimes) == ["base", "new"]
+
+def test_eviction_never_drops_model_just_loaded(server):
+    registry = server.ModelRegistry(FakeRuntime("base", 4), memory_budget_bytes=6 * 1024**3)
+    registry.runtimes["new"] = FakeRuntime("new", 5)
+
+    registry._evict_over_budget(keep="new")
+
+    assert list(registry.runtimes) == ["base", "new"]
+
+def test_retired_model_waits_for_requests_resolved_before_the_swap(server):
+    registry = server.ModelRegistry(FakeRuntime("base", 4))
+    registry.runtimes["old"] = old = FakeRuntime("old", 3)
+
+    # La solicitud ya eligió "old" pero aún construye el prompt cuando se descarga
+    assert registry.resolve("old", reserve=True) is old
+    registry.unload("old")
+    time.sleep(0.7)
+    assert not old.released and registry.retiring == [old]
+
+    old.unreserve()
+    deadline = time.time() + 3
+    while not old.released and time.time() < deadline:
+        time.sleep(0.1)
+    assert old.released
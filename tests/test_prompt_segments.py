@@ -0,0 +1,35 @@
+from conftest import FakeModel, FakeTokenizer
+
+def conversation(server, *turns):
+    return [
+        server.Message(rol="user" if index % 2 == 0 else "assistant", contenido=text)
+        for index, text in enumerate(turns)
+    ]
+
+def test_segmented_prompt_matches_full_template(server, engine):
+    assert engine.segmented_prompts
+    messages = conversation(server, "Hola", "¡Hola! ¿En qué ayudo?", "Explica `x = 1`\n")
+    for role in server.ROLE_PROMPTS:
+        full = engine.tokenizer(engine.format_messages(messages, role=role))["input_ids"]
+        assert engine.prompt_ids(messages, role=role) == full
+
+def test_new_turn_only_tokenizes_the_new_message(server, engine):
+    messages = conversation(server, "primer mensaje", "respuesta", "segundo mensaje")
+    engine.prompt_ids(messages)
+    engine.tokenizer.encoded.clear()
+
+    engine.prompt_ids(messages + conversation(server, "x", "otra respuesta")[1:])
+
+    assert engine.tokenizer.encoded
+    assert all("otra respuesta" in text for text in engine.tokenizer.encoded)
+
+def test_message_count_is_exact_with_segments(server, engine):
+    message = server.Message(rol="user", contenido="¿Cuántos tokens?")
+    assert engine.count_message_tokens(message) == len(engine.message_ids(message))
+
+def test_template_with_merges_across_messages_falls_back(server):
+    engine = server.FoxiaGenerationEngine(FakeModel(), FakeTokenizer(merge="\n<"))
+    assert not engine.segmented_prompts
+
+    messages = conversation(server, "Hola", "Qué tal")
+    assert engine.prompt_ids(messages) == engine.tokenizer(engine.format_messages(messages))["input_ids"]
@@ -0,0 +1,49 @@
+# ==============================================================================
+# === PRUEBAS: PRESUPUESTO DE RAZONAMIENTO <think> =============================
+# ==============================================================================
+
+import pytest
+
+from conftest import FakeModel, FakeTokenizer
+
+THINK, END_THINK = FakeTokenizer.SPECIAL["<think>"], FakeTokenizer.SPECIAL["</think>"]
+
+@pytest.fixture
+def scheduler(server):
+    return server.GenerationScheduler(FakeModel(), FakeTokenizer(), max_batch_size=1,
+                                      max_batch_tokens=4096, max_queue_size=4)
+
+def generate(scheduler, request):
+    """
+    Modelo que razonaría sin fin: tras <think> solo emite "p" salvo que el
+    planificador le imponga tokens; una vez cerrado el bloque contesta "r".
+    """
+    token = THINK
+    while not scheduler._append_token(request, token):
+        if request._forced_tokens:
+            token = request._forced_tokens.popleft()
+        elif END_THINK in request.output_ids:
+            token = ord("r")
+        else:
+            token = ord("p")
+    return request.output_ids
+
+def test_default_budget_leaves_room_for_the_answer(server):
+    assert server.DEFAULT_CONFIG["reasoning_budget"] < server.DEFAULT_CONFIG["max_new_tokens"]
+
+@pytest.mark.parametrize("budget,max_new_tokens", [(1024, 1024), (512, 1024), (200, 64)])
+def test_capped_reasoning_still_produces_an_answer(server, scheduler, budget, max_new_tokens):
+    request = server.GenerationRequest([1, 2, 3], max_new_tokens=max_new_tokens, temperature=0.7,
+                                       top_p=0.9, repetition_penalty=1.0, reasoning_budget=budget)
+
+    output = generate(scheduler, request)
+
+    assert request.reasoning_truncated
+    assert request.reasoning_budget <= max_new_tokens - min(server.REASONING_ANSWER_RESERVE, max_new_tokens // 2)
+    answer = output[output.index(END_THINK) + 1:]
+    assert scheduler.tokenizer.decode(answer).strip()
+    assert request.finish_reason == "length"
+
+def test_zero_budget_means_no_limit(server):
+    assert server.effective_reasoning_budget(0, 1024) == 0
+    assert server.effective_reasoning_budget(2048, 1024) == 1024 - server.REASONING_ANSWER_RESERVE
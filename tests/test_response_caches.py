@@ -0,0 +1,61 @@
+# ==============================================================================
+# === PRUEBAS: CACHÉS DE RESPUESTAS ============================================
+# ==============================================================================
+
+import asyncio
+import json
+import types
+
+import pytest
+
+from conftest import FakeEmbedder
+
+pytest.importorskip("faiss")
+
+@pytest.fixture
+def semantic_cache(server, monkeypatch):
+    cache = server.SemanticResponseCache(FakeEmbedder(), threshold=0.9, ttl_s=60, max_entries=16, max_user_turns=2)
+    monkeypatch.setattr(server, "semantic_cache", cache)
+    return cache
+
+def make_request(server, text="¿Qué es FoxIA?", **fields):
+    return server.ChatCompletionRequest(mensajes=[{"rol": "user", "contenido": text}], **fields)
+
+def store_and_wait(server, request, content):
+    async def run():
+        pending = server.store_semantic_cache(request, content, {"total_tokens": 3})
+        if pending is not None:
+            await pending
+    asyncio.run(run())
+
+def test_semantic_cache_hits_similar_question(server, semantic_cache):
+    store_and_wait(server, make_request(server), "Un asistente.")
+
+    hit = asyncio.run(server.lookup_semantic_cache(make_request(server, "qué es foxia")))
+
+    assert hit is not None and hit["content"] == "Un asistente."
+
+@pytest.mark.parametrize("fields", [{"seed": 7}, {"temperature": 0.0}, {"cache": False}])
+def test_semantic_cache_bypassed_for_reproducible_requests(server, semantic_cache, fields):
+    store_and_wait(server, make_request(server), "Un asistente.")
+    store_and_wait(server, make_request(server, "Otra pregunta", **fields), "No debe guardarse.")
+
+    assert asyncio.run(server.lookup_semantic_cache(make_request(server, **fields))) is None
+    assert semantic_cache.stats["bypassed"] == 1
+    assert semantic_cache.stats["stores"] == 1
+
+def test_semantic_hit_skips_prompt_preparation(server, semantic_cache, monkeypatch):
+    store_and_wait(server, make_request(server), "Un asistente.")
+    monkeypatch.setattr(server, "resolve_runtime", lambda model: types.SimpleNamespace(model_id=server.MODEL_ID, unreserve=lambda: None))
+
+    async def prepare_input_ids(request, runtime):
+        raise AssertionError("un acierto semántico no debe construir el prompt (RAG, tokenización)")
+    monkeypatch.setattr(server, "prepare_input_ids", prepare_input_ids)
+
+    response = asyncio.run(server.handle_standard_request(make_request(server, "qué es foxia")))
+    streamed = asyncio.run(server.handle_streaming_request(make_request(server, "qué es foxia", stream=True)))
+
+    body = json.loads(response.body)
+    assert body["cache"] == "semantic" and body["choices"][0]["message"]["content"] == "Un asistente."
+    assert streamed.headers["content-type"].startswith("text/event-stream")
+    assert semantic_cache.stats["hits"] == 2
@@ -0,0 +1,98 @@
+# ==============================================================================
+# === PRUEBAS: PLANIFICADOR CON CONTINUOUS BATCHING ============================
+# ==============================================================================
+
+import pytest
+
+from conftest import FakeTokenizer, requires_torch, tiny_causal_lm
+
+pytestmark = requires_torch
+
+@pytest.fixture(scope="module")
+def model():
+    return tiny_causal_lm()
+
+def reference(model, prompt, max_new_tokens):
+    """Salida de model.generate greedy para un solo prompt, sin batch ni relleno"""
+    import torch
+    output = model.generate(torch.tensor([prompt]), max_new_tokens=max_new_tokens, do_sample=False,
+                            eos_token_id=FakeTokenizer.eos_token_id, pad_token_id=FakeTokenizer.eos_token_id)
+    return output[0, len(prompt):].tolist()
+
+def make_scheduler(server, model, prefix_cache=None):
+    return server.GenerationScheduler(model, FakeTokenizer(), max_batch_size=8, max_batch_tokens=4096,
+                                      max_queue_size=16, prefix_cache=prefix_cache)
+
+def greedy(server, request_id, prompt, max_new_tokens):
+    return server.GenerationRequest(prompt, max_new_tokens=max_new_tokens, temperature=0.0, top_p=1.0,
+                                    repetition_penalty=1.0, request_id=request_id)
+
+def step(scheduler):
+    """Una vuelta del bucle del planificador (_run) sin hilo, para intercalar llegadas"""
+    scheduler._drop_cancelled()
+    scheduler._admit_waiting()
+    if scheduler.active:
+        scheduler._decode_step()
+
+@pytest.mark.parametrize("with_prefix_cache", [False, True])
+def test_batched_output_matches_single_greedy_generate(server, model, with_prefix_cache):
+    prefix_cache = server.PrefixKVCache(max_bytes=64 * 1024**2, max_entries=16) if with_prefix_cache else None
+    scheduler = make_scheduler(server, model, prefix_cache)
+    prompts = {
+        "a": ([5, 17, 33, 9, 41], 12),
+        "b": ([7, 3, 88, 21, 60, 12, 45, 99, 30, 2, 64], 4),  # Termina pronto: su fila sale del batch
+        "c": ([5, 17, 33, 9, 41, 70, 71], 10),  # Llega a mitad, más corto que el batch y con el prefijo de "a"
+        "d": (list(range(40, 60)), 8),  # Llega a mitad, más largo: rellena el batch
+        "e": ([11, 12, 13], 30),  # Se cancela con el batch en marcha
+    }
+    requests = {name: greedy(server, name, prompt, n) for name, (prompt, n) in prompts.items()}
+
+    scheduler.submit(requests["a"])
+    scheduler.submit(requests["b"])
+    scheduler.submit(requests["e"])
+    for _ in range(3):
+        step(scheduler)
+    scheduler.submit(requests["c"])
+    step(scheduler)
+    scheduler.submit(requests["d"])
+    for _ in range(2):
+        step(scheduler)
+    assert [r.request_id for r in scheduler.active] == ["a", "e", "c", "d"]
+    assert not bool(scheduler._attention_mask.all())  # Filas de longitudes distintas: hay relleno
+
+    scheduler.cancel("e")
+    while scheduler.requests:
+        step(scheduler)
+
+    for name in "abcd":
+        prompt, max_new_tokens = prompts[name]
+        assert requests[name].output_ids == reference(model, prompt, max_new_tokens), name
+        assert requests[name].finish_reason in ("stop", "length")
+
+    cancelled = requests["e"]
+    assert cancelled.finish_reason == "cancelled"
+    assert 0 < len(cancelled.output_ids) < 30
+    assert cancelled.output_ids == reference(model, prompts["e"][0], 30)[:len(cancelled.output_ids)]
+    assert scheduler.active == [] and scheduler._past is None
+    if with_prefix_cache:
+        assert requests["c"].cached_tokens > 0
+
+def test_cancelled_row_leaves_the_rest_aligned(server, model):
+    scheduler = make_scheduler(server, model)
+    short = greedy(server, "corta", [9, 8, 7], 20)
+    long = greedy(server, "larga", list(range(20, 36)), 20)
+    scheduler.submit(long)
+    scheduler.submit(short)
+    for _ in range(4):
+        step(scheduler)
+
+    # La fila larga ocupa todas las columnas; al cancelarla solo queda el relleno de la corta
+    scheduler.cancel("larga")
+    step(scheduler)
+    assert scheduler.active == [short]
+    assert scheduler._attention_mask.shape[1] == short._position
+    assert bool(scheduler._attention_mask.all())
+
+    while scheduler.requests:
+        step(scheduler)
+    assert short.output_ids == reference(model, [9, 8, 7], 20)
@@ -0,0 +1,72 @@
+# ==============================================================================
+# === PRUEBAS: DECODIFICACIÓN ESPECULATIVA =====================================
+# ==============================================================================
+
+import pytest
+
+from conftest import FakeTokenizer, requires_torch, tiny_causal_lm
+
+pytestmark = requires_torch
+
+class ThinkTokenizer(FakeTokenizer):
+    """FakeTokenizer con <think>/</think> dentro del vocabulario del modelo diminuto"""
+
+    SPECIAL = {"<think>": 120, "</think>": 121}
+
+@pytest.fixture(scope="module")
+def target():
+    return tiny_causal_lm(seed=0)
+
+@pytest.fixture(scope="module", params=["mismo", "otro"])
+def draft(request, target):
+    # "mismo": el borrador acierta siempre (aceptación total y token bonus);
+    # "otro": pesos distintos, casi todo se rechaza y hay que deshacer
+    return target if request.param == "mismo" else tiny_causal_lm(seed=1, layers=1)
+
+def make_scheduler(server, model, draft_model=None, tokenizer=None, speculative_tokens=4):
+    return server.GenerationScheduler(model, tokenizer or FakeTokenizer(), max_batch_size=4, max_batch_tokens=4096,
+                                      max_queue_size=8, draft_model=draft_model, speculative_tokens=speculative_tokens)
+
+def run(server, scheduler, prompt, max_new_tokens, **fields):
+    request = server.GenerationRequest(prompt, max_new_tokens=max_new_tokens, temperature=0.0, top_p=1.0,
+                                       repetition_penalty=1.0, **fields)
+    scheduler.submit(request)
+    # Misma elección de paso que GenerationScheduler._run, sin hilo
+    while scheduler.requests:
+        scheduler._drop_cancelled()
+        scheduler._admit_waiting()
+        if not scheduler.active:
+            continue
+        if scheduler.draft_model is not None and len(scheduler.active) == 1 and bool(scheduler._attention_mask.all()):
+            scheduler._speculative_step()
+        else:
+            scheduler._decode_step()
+    return request
+
+@pytest.mark.parametrize("speculative_tokens", [1, 4])
+def test_greedy_speculative_matches_plain_greedy(server, target, draft, speculative_tokens):
+    prompt = [5, 17, 33, 9, 41, 2]
+    plain = run(server, make_scheduler(server, target), prompt, 40)
+    scheduler = make_scheduler(server, target, draft, speculative_tokens=speculative_tokens)
+
+    speculative = run(server, scheduler, prompt, 40)
+
+    assert speculative.output_ids == plain.output_ids
+    assert speculative.finish_reason == plain.finish_reason
+    assert scheduler.stats["speculative_steps"] > 0
+    if draft is target:
+        assert speculative.draft_accepted == speculative.draft_proposed
+        assert speculative.target_steps < len(speculative.output_ids)
+
+@pytest.mark.parametrize("budget", [3, 4, 6])
+def test_speculation_stops_at_the_reasoning_budget(server, target, budget):
+    prompt = [5, 17, 33, ThinkTokenizer.SPECIAL["<think>"]]  # La plantilla abre el <think>
+    fields = {"reasoning_budget": budget}
+    plain = run(server, make_scheduler(server, target, tokenizer=ThinkTokenizer()), prompt, 40, **fields)
+    # Con el borrador idéntico se aceptan los 4 borradores por paso: el presupuesto se agota a mitad
+    # de un paso salvo cuando cae justo en el borde (6)
+    speculative = run(server, make_scheduler(server, target, target, tokenizer=ThinkTokenizer()), prompt, 40, **fields)
+
+    assert plain.reasoning_truncated
+    assert speculative.output_ids == plain.output_ids
+    assert speculative.reasoning_tokens == plain.reasoning_tokens
@@ -0,0 +1,72 @@
+# ==============================================================================
+# === PRUEBAS: AGRUPACIÓN DE TOKENS EN EL STREAM ===============================
+# ==============================================================================
+
+import asyncio
+
+import pytest
+
+from conftest import FakeTokenizer, requires_torch
+
+pytestmark = requires_torch
+
+def put_text(streamer, text):
+    """Entrega el texto token a token, como el planificador (un id por paso)"""
+    import torch
+    for char in text:
+        streamer.put(torch.tensor([ord(char)]))
+
+def skip_prompt(streamer):
+    import torch
+    streamer.put(torch.tensor([[1, 2, 3]]))  # El planificador entrega primero el prompt
+    return streamer
+
+def make_streamer(server, coalesce_ms, coalesce_tokens):
+    return skip_prompt(server.AsyncTextStreamer(FakeTokenizer(), asyncio.get_running_loop(), coalesce_ms=coalesce_ms,
+                                                coalesce_tokens=coalesce_tokens, skip_special_tokens=True))
+
+async def drain(streamer):
+    items = []
+    while (item := await asyncio.wait_for(streamer.queue.get(), timeout=1.0)) is not None:
+        items.append(item)
+    return items
+
+def test_window_counts_generated_tokens(server):
+    async def run():
+        streamer = make_streamer(server, coalesce_ms=60000, coalesce_tokens=6)
+        # Cada 6 ids generados sale el texto ya completo (palabras enteras)
+        await asyncio.to_thread(put_text, streamer, "abc defgh ij ")
+        streamer.end()
+        return await drain(streamer)
+
+    assert asyncio.run(run()) == ["abc ", "defgh ", "ij "]
+
+def test_pending_text_is_sent_when_the_window_closes(server):
+    async def run():
+        streamer = make_streamer(server, coalesce_ms=20, coalesce_tokens=100)
+        await asyncio.to_thread(put_text, streamer, "Hola ")
+        # Sin más tokens (prefill de otra solicitud, token lento): el temporizador lo envía
+        first = await asyncio.wait_for(streamer.queue.get(), timeout=1.0)
+        await asyncio.to_thread(put_text, streamer, "mundo")
+        streamer.end()
+        return first, await drain(streamer)
+
+    first, rest = asyncio.run(run())
+    assert first == "Hola "
+    assert rest == ["mundo"]
+
+def test_chat_channel_flushes_on_timer(server):
+    pubsub = server.MemoryPubSub()
+    mailbox = pubsub.subscribe("canal-chat")
+    publisher = server.ChatEventPublisher(pubsub, "canal-chat")
+
+    async def run():
+        streamer = skip_prompt(server.ChatChannelStreamer(FakeTokenizer(), publisher, "chat-uuid", "chatcmpl-t",
+                                                          loop=asyncio.get_running_loop(), coalesce_ms=20,
+                                                          coalesce_tokens=100))
+        await asyncio.to_thread(put_text, streamer, "Hola ")
+        await asyncio.sleep(0.2)
+
+    asyncio.run(run())
+    publisher.close()
+    assert len(mailbox) == 1 and '"delta": "Hola "' in mailbox[0]